@@ -0,0 +1,571 @@
+"""Rough benchmarks for the data pipeline which don't need our databases
+
+Run with python -m datapages.benchmark"""
+import argparse
+import collections
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import requests
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from .common import DomainConfig
+from .enametadata import ReportTransport, XMLViewTransport, parse_run_ids
+from .regenerate_data import (SAMPLE_COLUMNS, SpeciesRouter, _join_samples_by_merging,
+                              add_canonical_data, build_relevant_data, join_vrtrack_sequencescape,
+                              merge_data, merge_ena_status, stream_relevant_data)
+from .synthetic import SyntheticData
+from .write_data import write_domain_data_files
+
+logger = logging.getLogger(__name__)
+
+def _default_config_path(filename):
+    datapages_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(os.path.dirname(datapages_dir), 'page_config', filename)
+
+def _random_word(rng, length=8):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+def synthetic_species_names(domain_config, number_of_rows, seed=1):
+    """Species names like those in vrtrack for a domain config
+
+    Most rows are a configured species (or alias) followed by a random
+    epithet, some are only the configured name and the rest don't belong
+    to any configured species"""
+    rng = random.Random(seed)
+    prefixes = []
+    for species in domain_config.species_list:
+        prefixes += [species] + domain_config.aliases(species)
+    unique_names = []
+    for prefix in prefixes:
+        unique_names.append(prefix)
+        unique_names += ["%s %s" % (prefix, _random_word(rng)) for _ in range(5)]
+    unique_names += ["%s %s" % (_random_word(rng).capitalize(), _random_word(rng))
+                     for _ in range(len(prefixes))]
+    return pd.Series([rng.choice(unique_names) for _ in range(number_of_rows)])
+
+def route_species_row_by_row(species_names, domain_config):
+    """How build_relevant_data used to find the rows for each species"""
+    lowercase_cache = species_names.map(lambda name: name.lower())
+    species_rows = {}
+    for species in domain_config.species_list:
+        if not domain_config.is_visible(species):
+            continue
+        mask = lowercase_cache.map(lambda el: el.startswith(species.lower()))
+        for alias in domain_config.aliases(species):
+            alias_mask = lowercase_cache.map(lambda el:
+                                             el.startswith(alias.lower()))
+            mask = mask | alias_mask
+        species_rows[species] = np.flatnonzero(mask.values)
+    return species_rows
+
+def _timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+def benchmark_species_routing(domain_config, number_of_rows):
+    species_names = synthetic_species_names(domain_config, number_of_rows)
+    expected, row_by_row_time = _timed(route_species_row_by_row, species_names, domain_config)
+    router = SpeciesRouter(domain_config)
+    routed, router_time = _timed(router.route, species_names)
+    same = (expected.keys() == routed.keys() and
+            all(np.array_equal(expected[species], routed[species]) for species in expected))
+    if not same:
+        raise AssertionError("SpeciesRouter found different rows to the row by row method")
+    return {
+        'rows': number_of_rows,
+        'species': len(routed),
+        'row_by_row_seconds': row_by_row_time,
+        'router_seconds': router_time,
+        'speedup': row_by_row_time / router_time if router_time else float('inf')
+    }
+
+def join_vrtrack_sequencescape_by_merging(vrtrack, sequencescape):
+    """How join_vrtrack_sequencescape used to work, merging every lane with
+    the samples by ERS number and by name"""
+    sequencescape_study_data = sequencescape[['project_ssid', 'study_title', 'study_name']].drop_duplicates()
+    joint_data = pd.merge(vrtrack, sequencescape_study_data, how='left',
+                          on='project_ssid', sort=False, suffixes=('_v', '_ss'))
+    sequencescape_sample_data = sequencescape[SAMPLE_COLUMNS].drop_duplicates()
+    return _join_samples_by_merging(joint_data, sequencescape_sample_data).reset_index(drop=True)
+
+def _maybe(rng, value, probability):
+    return value if rng.random() >= probability else None
+
+def synthetic_join_inputs(number_of_lanes, seed=1):
+    """Lanes from vrtrack and studies from sequencescape for them
+
+    Most samples can be matched on their ERS number; some only by name
+    and some not at all.  A few ERS numbers and names are shared by more
+    than one sample and some details are missing."""
+    rng = random.Random(seed)
+    number_of_samples = max(1, number_of_lanes // 2)
+    number_of_projects = max(1, number_of_lanes // 500)
+    samples = []
+    for i in range(number_of_samples):
+        accession = "ERS%07d" % rng.randrange(number_of_samples * 50)
+        samples.append({
+            'name': "sample_%s" % rng.randrange(number_of_samples * 50),
+            'accession': accession,
+            'project_ssid': rng.randrange(number_of_projects)
+        })
+    lanes = []
+    for i in range(number_of_lanes):
+        sample = rng.choice(samples)
+        lanes.append({
+            'internal_project_name': "project %s" % sample['project_ssid'],
+            'internal_sample_name': sample['name'],
+            'lane_name': "%s_%s#%s" % (rng.randrange(30000), rng.randrange(8), i),
+            'run_accession': "ERR%07d" % i,
+            'withdrawn': int(rng.random() < 0.02),
+            'project_ssid': sample['project_ssid'],
+            'sample_accession': _maybe(rng, sample['accession'], 0.1),
+            'study_accession': "ERP%06d" % sample['project_ssid'],
+            'species_name': "Species %s" % (sample['project_ssid'] % 20)
+        })
+    studies = []
+    for sample in samples:
+        if rng.random() < 0.05:
+            continue
+        studies.append({
+            'project_ssid': sample['project_ssid'],
+            'study_accession': "ERP%06d" % sample['project_ssid'],
+            'study_title': _maybe(rng, "Study of project %s" % sample['project_ssid'], 0.2),
+            'study_name': "project_%s" % sample['project_ssid'],
+            'sample_strain': _maybe(rng, "strain %s" % rng.randrange(1000), 0.5),
+            'sample_public_name': _maybe(rng, "public %s" % sample['name'], 0.3),
+            'sample_name': sample['name'],
+            'sample_common_name': "Species %s" % (sample['project_ssid'] % 20),
+            'sample_organism': "Species %s" % (sample['project_ssid'] % 20),
+            'sample_supplier_name': _maybe(rng, "supplier %s" % sample['name'], 0.3),
+            'sample_accession': _maybe(rng, sample['accession'], 0.1)
+        })
+    return pd.DataFrame(lanes), pd.DataFrame(studies)
+
+def _peak_memory(function, *args):
+    """Returns the most memory allocated while running function(*args)"""
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def _timed_with_memory(function, *args):
+    """Returns the result of function(*args), how long it took and the most
+    memory it allocated
+
+    Tracing allocations slows down stages which allocate lots of small
+    objects far more than others, so function is timed without tracing
+    and then run again, traced, for the memory."""
+    result, seconds = _timed(function, *args)
+    return result, seconds, _peak_memory(function, *args)
+
+def benchmark_join(number_of_lanes):
+    vrtrack, sequencescape = synthetic_join_inputs(number_of_lanes)
+    expected, merging_time, merging_peak = _timed_with_memory(
+        join_vrtrack_sequencescape_by_merging, vrtrack, sequencescape)
+    joined, lookup_time, lookup_peak = _timed_with_memory(
+        join_vrtrack_sequencescape, vrtrack, sequencescape)
+    pd.testing.assert_frame_equal(joined, expected, check_dtype=False)
+    return {
+        'lanes': number_of_lanes,
+        'merging_seconds': merging_time,
+        'merging_peak_mb': merging_peak / 1e6,
+        'lookup_seconds': lookup_time,
+        'lookup_peak_mb': lookup_peak / 1e6
+    }
+
+def _species_json(data):
+    return json.dumps({key: value for key, value in data.items() if key != 'updated'},
+                      sort_keys=True)
+
+def check_streamed_data(relevant_data, streamed_data):
+    """Goes through the streamed data one species at a time, checking that
+    it is the same as relevant_data"""
+    expected = iter(relevant_data)
+    for species, data in streamed_data:
+        expected_species, expected_data = next(expected)
+        if species != expected_species or _species_json(data) != _species_json(expected_data):
+            raise ValueError("Streamed data for %s is different" % species)
+    if next(expected, None) is not None:
+        raise ValueError("Some species weren't streamed")
+
+def benchmark_pipeline(domain_config, number_of_lanes, synthetic_options, workers=1):
+    """Times each stage from merging the data to writing the files
+
+    merge_data is timed as a whole and then the stages within it are
+    timed one at a time on the same data.  Each stage is run twice, once
+    to time it and once to trace the memory it allocates.  The species data is built in
+    full before it is written so that the two stages can be told apart.
+    The data is also streamed one species at a time and checked against
+    the species data built in full."""
+    generator = SyntheticData(domain_config.species_list, **synthetic_options)
+    lane_details, ena_run_details, studies = generator.generate(number_of_lanes)
+    stages = collections.OrderedDict()
+
+    def run_stage(name, function, *args):
+        logger.info("Running %s" % name)
+        result, seconds, peak = _timed_with_memory(function, *args)
+        stages[name] = {'seconds': seconds, 'peak_mb': peak / 1e6}
+        return result
+
+    joint_data = run_stage('merge_data', merge_data, lane_details, ena_run_details, studies)
+    vrtrack_details = lane_details.copy()
+    vrtrack_details['withdrawn'] = vrtrack_details['withdrawn'] == 1
+    joined = run_stage('join_vrtrack_sequencescape', join_vrtrack_sequencescape,
+                       vrtrack_details, studies)
+    run_stage('add_canonical_data', add_canonical_data, joined)
+    run_stage('merge_ena_status', merge_ena_status, joined, ena_run_details)
+    del(joined, vrtrack_details)
+
+    relevant_data = run_stage('build_relevant_data',
+                              lambda: list(build_relevant_data(joint_data, domain_config)))
+    # Compare with the peaks of merge_data and build_relevant_data
+    run_stage('stream_relevant_data',
+              lambda: check_streamed_data(relevant_data,
+                                          stream_relevant_data(lane_details, ena_run_details,
+                                                               studies, domain_config)))
+    output_dir_root = tempfile.mkdtemp(prefix='datapages_benchmark_')
+    try:
+        run_stage('write_domain_data_files',
+                  lambda: write_domain_data_files(relevant_data, os.path.join(output_dir_root, 'site'),
+                                                  domain_config.domain_name, workers=workers))
+    finally:
+        shutil.rmtree(output_dir_root)
+    return {
+        'lanes': number_of_lanes,
+        'joint_rows': len(joint_data.index),
+        'synthetic_options': synthetic_options,
+        'workers': workers,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'stages': stages
+    }
+
+def compare_with_baseline(results, baseline, tolerance, min_seconds=0.05, min_mb=1.0):
+    """Returns a description of each stage which is slower, or uses
+    more memory, than in the baseline by more than tolerance"""
+    if results['lanes'] != baseline['lanes']:
+        logger.warning("Comparing %s lanes with a baseline of %s lanes" % (results['lanes'],
+                                                                           baseline['lanes']))
+    regressions = []
+    for name, stage in results['stages'].items():
+        baseline_stage = baseline['stages'].get(name)
+        if baseline_stage is None:
+            continue
+        for measure, unit, minimum in [('seconds', 's', min_seconds), ('peak_mb', 'MB', min_mb)]:
+            value, baseline_value = stage[measure], baseline_stage[measure]
+            if value > baseline_value * (1 + tolerance) and value - baseline_value > minimum:
+                regressions.append("%s took %.2f%s, up from %.2f%s" % (name, value, unit,
+                                                                       baseline_value, unit))
+    return regressions
+
+_STARTUP_SCRIPT = """
+import json, sys, time
+start = time.time()
+from datapages.update_projects import main
+sys.argv = ['datapages_update_projects'] + json.loads(sys.argv[1])
+try:
+    main()
+except SystemExit:
+    pass
+print(json.dumps({'seconds': time.time() - start, 'modules': sorted(sys.modules)}))
+"""
+
+HEAVY_MODULES = ['numpy', 'pandas', 'pymysql', 'requests']
+TEMPLATE_MODULES = ['jinja2', 'markdown', 'yaml']
+
+def _run_update_projects(arguments):
+    package_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_dir,
+                                                                  os.environ.get('PYTHONPATH')])))
+    output = subprocess.check_output([sys.executable, '-c', _STARTUP_SCRIPT, json.dumps(arguments)],
+                                     env=env, stderr=subprocess.DEVNULL)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def benchmark_startup(domain_config_path, repeats=5):
+    """Times datapages_update_projects -h and --html-only in new
+    interpreters and lists any modules they imported but shouldn't have"""
+    temp_dir = tempfile.mkdtemp(prefix='datapages_startup_')
+    try:
+        global_config_path = os.path.join(temp_dir, 'global_config.yml')
+        with open(global_config_path, 'w') as global_config_file:
+            for key in ['DATAPAGES_VRTRACK_HOST', 'DATAPAGES_VRTRACK_RO_USER',
+                        'DATAPAGES_SEQUENCESCAPE_HOST', 'DATAPAGES_SEQUENCESCAPE_RO_USER',
+                        'DATAPAGES_SEQUENCESCAPE_DATABASE']:
+                print("%s: unused" % key, file=global_config_file)
+            print("DATAPAGES_VRTRACK_PORT: 1", file=global_config_file)
+            print("DATAPAGES_SEQUENCESCAPE_PORT: 1", file=global_config_file)
+        site_dir = os.path.join(temp_dir, 'site')
+        with open(domain_config_path, 'r') as domain_config_file:
+            os.makedirs(os.path.join(site_dir, DomainConfig(domain_config_file).domain_name))
+        commands = [
+            ('-h', ['-h'], HEAVY_MODULES + TEMPLATE_MODULES),
+            ('--html-only', ['--global-config', global_config_path, '-q', '-d', site_dir,
+                             '--html-only', domain_config_path], HEAVY_MODULES)
+        ]
+        results = collections.OrderedDict()
+        for name, arguments, unexpected_modules in commands:
+            runs = [_run_update_projects(arguments) for _ in range(repeats)]
+            results[name] = {
+                'seconds': min(run['seconds'] for run in runs),
+                'unexpected_modules': [module for module in unexpected_modules
+                                       if module in runs[0]['modules']]
+            }
+        return results
+    finally:
+        shutil.rmtree(temp_dir)
+
+def synthetic_runs_by_study(number_of_studies, runs_per_study=50, seed=1):
+    """Run accessions for each study, some in ranges and some not, with a
+    few studies which have none"""
+    rng = random.Random(seed)
+    runs_by_study = collections.OrderedDict()
+    next_run = 1
+    for study_number in range(number_of_studies):
+        runs = []
+        if rng.random() > 0.05:
+            for _ in range(rng.randint(1, runs_per_study * 2)):
+                next_run += rng.choice([1, 1, 1, 5])
+                runs.append("ERR%06d" % next_run)
+        runs_by_study["ERP%06d" % study_number] = runs
+    return runs_by_study
+
+def _run_ranges(runs):
+    ranges = []
+    for run in runs:
+        number = int(run[3:])
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join("ERR%06d" % first if first == last else "ERR%06d-ERR%06d" % (first, last)
+                    for first, last in ranges)
+
+def _study_xml(study_accession, runs, padding):
+    links = ['<STUDY_LINK><URL_LINK><LABEL>Project page</LABEL><URL>http://example.org/%s</URL>'
+             '</URL_LINK></STUDY_LINK>' % study_accession,
+             '<STUDY_LINK><XREF_LINK><DB>ENA-SAMPLE</DB><ID>ERS000001-ERS000100</ID></XREF_LINK></STUDY_LINK>']
+    if runs:
+        links.append('<STUDY_LINK><XREF_LINK><DB>ENA-RUN</DB><ID>%s</ID></XREF_LINK></STUDY_LINK>' %
+                     _run_ranges(runs))
+    return ('<STUDY accession="%s"><IDENTIFIERS><PRIMARY_ID>%s</PRIMARY_ID></IDENTIFIERS>'
+            '<DESCRIPTOR><STUDY_TITLE>A study</STUDY_TITLE><STUDY_ABSTRACT>%s</STUDY_ABSTRACT></DESCRIPTOR>'
+            '<STUDY_LINKS>%s</STUDY_LINKS>'
+            '<STUDY_ATTRIBUTES><STUDY_ATTRIBUTE><TAG>ENA-SPOT-COUNT</TAG><VALUE>1000</VALUE>'
+            '</STUDY_ATTRIBUTE></STUDY_ATTRIBUTES></STUDY>' %
+            (study_accession, study_accession, escape(padding), "".join(links)))
+
+class StandInENA(object):
+    """A local web server which answers like the ENA's XML view and portal
+    search, for synthetic studies, so lookups can be benchmarked offline"""
+    def __init__(self, runs_by_study, abstract_length=2000):
+        self.runs_by_study = runs_by_study
+        self.padding = "Lorem ipsum " * (abstract_length // 12)
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, content, content_type):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                accessions = unquote(self.path.split('/')[-1]).split('&')[0].split(',')
+                self._respond(stand_in.xml(accessions), 'application/xml')
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+                query = parse_qs(body)['query'][0]
+                accessions = [part.split('"')[1] for part in query.split(' OR ')]
+                self._respond(stand_in.report(accessions), 'text/plain')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def xml(self, study_accessions):
+        studies = [_study_xml(accession, self.runs_by_study[accession], self.padding)
+                   for accession in study_accessions if accession in self.runs_by_study]
+        return ('<?xml version="1.0" encoding="UTF-8"?><ROOT>%s</ROOT>' % "".join(studies)).encode('utf-8')
+
+    def report(self, study_accessions):
+        lines = ["run_accession\tstudy_accession\tsecondary_study_accession"]
+        for accession in dict.fromkeys(study_accessions):
+            for run in self.runs_by_study.get(accession, []):
+                lines.append("%s\tPRJEB%s\t%s" % (run, accession[3:], accession))
+        return ("\n".join(lines) + "\n").encode('utf-8')
+
+    def url(self, path):
+        return "http://127.0.0.1:%s%s" % (self.server.server_port, path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+def get_run_accessions_from_whole_response(url, study_accessions):
+    """How ENADetails used to read the XML view, parsing the whole response
+    once it had all arrived"""
+    response = requests.get("%s%s&display=xml" % (url, ",".join(study_accessions)), timeout=60)
+    response.raise_for_status()
+    sample_accessions = []
+    for study in ElementTree.fromstring(response.content).findall('STUDY'):
+        run_ids_element = study.find('./STUDY_LINKS/STUDY_LINK/XREF_LINK/[DB="ENA-RUN"]/ID')
+        if run_ids_element is None:
+            continue
+        sample_accessions += [{'study_accession': study.attrib['accession'], 'run_accession': run}
+                              for run in parse_run_ids(run_ids_element.text)]
+    return sample_accessions
+
+def _batches(values, size):
+    return [values[i:i+size] for i in range(0, len(values), size)]
+
+def benchmark_ena(number_of_studies, runs_per_study=50):
+    """Looks up synthetic studies in a StandInENA by parsing whole XML
+    responses, by streaming them and with the portal search report
+
+    Returns the time taken and the most memory allocated by one request
+    for each, and fails if they don't find the same runs.  The requests
+    are made again, traced, for the memory."""
+    runs_by_study = synthetic_runs_by_study(number_of_studies, runs_per_study)
+    study_accessions = list(runs_by_study)
+    expected = sorted((study, run) for study, runs in runs_by_study.items() for run in runs)
+    results = collections.OrderedDict()
+    with StandInENA(runs_by_study) as stand_in:
+        xml_url = stand_in.url('/ena/data/view/')
+        methods = [
+            ('whole xml', 20, lambda batch: get_run_accessions_from_whole_response(xml_url, batch)),
+            ('streamed xml', 20, XMLViewTransport(xml_url).get_run_accessions),
+            ('streamed xml', 200, XMLViewTransport(xml_url).get_run_accessions),
+            ('report', 200, ReportTransport(stand_in.url('/ena/portal/api/search')).get_run_accessions)
+        ]
+        for name, batch_size, get_run_accessions in methods:
+            found = []
+            start = time.time()
+            for batch in _batches(study_accessions, batch_size):
+                found += get_run_accessions(batch)
+            seconds = time.time() - start
+            peak_bytes = max(_peak_memory(get_run_accessions, batch)
+                             for batch in _batches(study_accessions, batch_size))
+            if sorted((run['study_accession'], run['run_accession']) for run in found) != expected:
+                raise ValueError("Looking up runs with %s found different runs" % name)
+            results["%s, %s studies per request" % (name, batch_size)] = {
+                'seconds': seconds,
+                'requests': len(_batches(study_accessions, batch_size)),
+                'peak_request_mb': peak_bytes / 1e6
+            }
+    return results
+
+def parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--domain-config', type=argparse.FileType(mode='r'),
+                        default=_default_config_path('prokaryotes.yml'),
+                        help="Domain config to route species for (default prokaryotes.yml)")
+    parser.add_argument('--rows', type=int, default=200000,
+                        help="Number of synthetic lanes to route to species")
+    parser.add_argument('--join-lanes', type=int, default=200000,
+                        help="Number of synthetic lanes to join with sequencescape")
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help="Benchmark each stage from merge_data to write_domain_data_files instead")
+    parser.add_argument('--lanes', type=int, default=100000,
+                        help="Number of synthetic lanes for --pipeline")
+    parser.add_argument('--duplicate-rate', type=float, default=0.01,
+                        help="Fraction of sequencescape samples which are duplicated")
+    parser.add_argument('--species-skew', type=float, default=1.0,
+                        help="How unevenly studies are spread across species (0 for evenly)")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Seed for the synthetic data")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes to write species data with in --pipeline")
+    parser.add_argument('--startup', action='store_true', default=False,
+                        help="Check how quickly datapages_update_projects -h and --html-only start instead")
+    parser.add_argument('--ena', action='store_true', default=False,
+                        help="Compare ways of looking up runs in a stand-in for the ENA instead")
+    parser.add_argument('--studies', type=int, default=2000,
+                        help="Number of synthetic studies to look up with --ena")
+    parser.add_argument('--output', help="Save the --pipeline results to this JSON file")
+    parser.add_argument('--baseline', type=argparse.FileType(mode='r'),
+                        help="Fail if any stage is slower or uses more memory than in these saved results")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Fraction by which a stage can exceed the baseline (default 0.25)")
+    return parser.parse_args()
+
+def run_pipeline_benchmark(args, domain_config):
+    synthetic_options = {
+        'duplicate_rate': args.duplicate_rate,
+        'species_skew': args.species_skew,
+        'seed': args.seed
+    }
+    results = benchmark_pipeline(domain_config, args.lanes, synthetic_options, args.workers)
+    for name, stage in results['stages'].items():
+        logger.info("%s: %.2fs, %.0fMB peak" % (name, stage['seconds'], stage['peak_mb']))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        regressions = compare_with_baseline(results, json.load(args.baseline), args.tolerance)
+        for regression in regressions:
+            logger.error(regression)
+        if regressions:
+            sys.exit(1)
+
+def main():
+    args = parse()
+    logging.basicConfig(level=logging.INFO)
+    if args.startup:
+        results = benchmark_startup(args.domain_config.name)
+        for name, result in results.items():
+            logger.info("%s took %.2fs" % (name, result['seconds']))
+            if result['unexpected_modules']:
+                logger.error("%s imported %s" % (name, ", ".join(result['unexpected_modules'])))
+        if any(result['unexpected_modules'] for result in results.values()):
+            sys.exit(1)
+        return
+    if args.ena:
+        results = benchmark_ena(args.studies)
+        for name, result in results.items():
+            logger.info("%s: %.2fs for %s requests, at most %.1fMB allocated by one" %
+                        (name, result['seconds'], result['requests'], result['peak_request_mb']))
+        return
+    domain_config = DomainConfig(args.domain_config)
+    if args.pipeline:
+        run_pipeline_benchmark(args, domain_config)
+        return
+    result = benchmark_species_routing(domain_config, args.rows)
+    logger.info("Routed %(rows)s rows to %(species)s species: %(row_by_row_seconds).2fs row by row, "
+                "%(router_seconds).2fs with SpeciesRouter (%(speedup).0fx faster)" % result)
+    result = benchmark_join(args.join_lanes)
+    logger.info("Joined %(lanes)s lanes with sequencescape: %(merging_seconds).2fs and %(merging_peak_mb).0fMB "
+                "by merging, %(lookup_seconds).2fs and %(lookup_peak_mb).0fMB by lookup" % result)
+
+if __name__ == '__main__':
+    main()
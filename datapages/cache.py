@@ -0,0 +1,111 @@
+import logging
+import pandas as pd
+import pickle
+import sqlite3
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+class CacheStore(object):
+    """Keeps data from each source for each domain in an sqlite file
+
+    Lists of records are stored column by column as a compressed
+    DataFrame so that entries are small and can be loaded one at a time.
+    Each save happens in a single transaction so several runs can share
+    the same file."""
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=300)
+        try:
+            with self.connection:
+                self.connection.execute("""CREATE TABLE IF NOT EXISTS cache_entries (
+                    name TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    saved REAL NOT NULL,
+                    PRIMARY KEY (name, source)
+                )""")
+        except sqlite3.DatabaseError:
+            self.connection.close()
+            raise
+
+    def _encode(self, value):
+        if isinstance(value, pd.DataFrame):
+            return 'frame', value
+        if isinstance(value, (list, tuple)) and value and all(isinstance(el, dict) for el in value):
+            return 'records', pd.DataFrame(list(value))
+        return 'pickle', value
+
+    def _decode(self, format, value):
+        if format == 'records':
+            # Turn the DataFrame back into python objects rather than numpy ones
+            return value.astype(object).where(value.notnull(), None).to_dict('records')
+        return value
+
+    def save(self, name, data):
+        """Replaces the cached data for each source in data"""
+        now = time.time()
+        rows = []
+        for source, value in data.items():
+            format, encoded = self._encode(value)
+            blob = zlib.compress(pickle.dumps(encoded, protocol=pickle.HIGHEST_PROTOCOL))
+            rows.append((name, source, format, blob, now))
+        with self.connection:
+            self.connection.executemany("""INSERT OR REPLACE INTO cache_entries
+                                           (name, source, format, data, saved)
+                                           VALUES (?, ?, ?, ?, ?)""", rows)
+
+    def load(self, name, source):
+        row = self.connection.execute("""SELECT format, data FROM cache_entries
+                                         WHERE name = ? AND source = ?""",
+                                      (name, source)).fetchone()
+        if row is None:
+            raise ValueError("Could not load %s for %s from %s" % (source, name, self.path))
+        format, blob = row
+        return self._decode(format, pickle.loads(zlib.decompress(blob)))
+
+    def sources(self, name):
+        rows = self.connection.execute("""SELECT source FROM cache_entries
+                                          WHERE name = ? ORDER BY source""", (name,))
+        return [source for source, in rows]
+
+    def close(self):
+        self.connection.close()
+
+def cache_data(cache_path, name, data):
+    """Just for testing"""
+    try:
+        store = CacheStore(cache_path)
+    except sqlite3.DatabaseError:
+        raise ValueError("%s isn't a cache store; it may be an old pickle cache which needs removing" %
+                         cache_path)
+    try:
+        store.save(name, data)
+    finally:
+        store.close()
+
+def _reload_pickled_cache_data(cache_path, name):
+    with open(cache_path, 'rb') as cache_file:
+        cache = pickle.load(cache_file)
+    try:
+        data = cache[name]
+    except KeyError:
+        raise ValueError("Could not load %s from %s" % (name, cache_path))
+    return data
+
+def reload_cache_data(cache_path, name):
+    try:
+        store = CacheStore(cache_path)
+    except sqlite3.DatabaseError:
+        logger.warning("%s isn't a cache store, trying to load it as an old pickle cache" % cache_path)
+        return _reload_pickled_cache_data(cache_path, name)
+    try:
+        sources = store.sources(name)
+        if not sources:
+            raise ValueError("Could not load %s from %s" % (name, cache_path))
+        data = {source: store.load(name, source) for source in sources}
+    finally:
+        store.close()
+    return data
@@ -1,12 +1,37 @@
+import hashlib
 import logging
-import markdown
 import os
 import pickle
 import sys
-import yaml
+import tempfile
 
+from argparse import ArgumentTypeError
 from boltons.strutils import slugify
-from jinja2 import Template
+
+# markdown, yaml and jinja2 (through .templates) are imported when they are
+# first needed so that commands which don't use them start quicker
+
+# Change this whenever DomainConfig renders things differently so that
+# previously compiled configs aren't used
+COMPILED_CONFIG_VERSION = 2
+# Templates whose output is kept in compiled configs; a change to any of
+# them, or an override in the templates directory, means rendering again
+COMPILED_CONFIG_TEMPLATES = ['fragments/links.html']
+
+_markdown_converter = None
+
+def render_markdown(content):
+    global _markdown_converter
+    if _markdown_converter is None:
+        import markdown
+        _markdown_converter = markdown.Markdown(extensions=['markdown.extensions.tables'])
+    return _markdown_converter.reset().convert(content)
+
+def load_yaml(stream):
+    import yaml
+    # The C loader is much faster for big configs like prokaryotes.yml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(stream, Loader=loader)
 
 def _is_dir(path):
     if not os.path.isdir(path):
@@ -33,31 +58,20 @@ def _could_read(path):
         raise ArgumentTypeError("Bad path to %s" % path)
     return os.path.abspath(path)
 
-def species_filename(species):
-    return slugify(species).lower()+'.json'
-
-def cache_data(cache_path, name, data):
-    """Just for testing"""
+def _at_least_one(value):
     try:
-        with open(cache_path, 'rb') as cache_file:
-            cache = pickle.load(cache_file)
-    except EOFError:
-        cache={}
-    except FileNotFoundError:
-        cache={}
+        number = int(value)
+    except ValueError:
+        raise ArgumentTypeError("Expected a whole number, not %s" % value)
+    if number < 1:
+        raise ArgumentTypeError("Expected at least 1, not %s" % value)
+    return number
 
-    cache[name] = data
-    with open(cache_path, 'wb') as cache_file:
-        pickle.dump(cache, cache_file)
+def species_filename(species):
+    return slugify(species).lower()+'.json'
 
-def reload_cache_data(cache_path, name):
-    with open(cache_path, 'rb') as cache_file:
-        cache = pickle.load(cache_file)
-    try:
-        data = cache[name]
-    except KeyError:
-        raise ValueError("Could not load %s from %s" % (name, cache_path))
-    return data
+def species_metadata_filename(species):
+    return slugify(species).lower()+'.meta.json'
 
 def get_config(config_file):
     """Creates a dictionary like object, preferably from config,
@@ -75,12 +89,28 @@ def get_config(config_file):
 
     optional_keys = [
         'DATAPAGES_LOAD_CACHE_PATH',
-        'DATAPAGES_SAVE_CACHE_PATH'
+        'DATAPAGES_SAVE_CACHE_PATH',
+        'DATAPAGES_ENA_CONCURRENCY',
+        'DATAPAGES_ENA_REQUESTS_PER_SECOND',
+        'DATAPAGES_ENA_CACHE_PATH',
+        'DATAPAGES_ENA_CACHE_TTL_HOURS',
+        'DATAPAGES_ENA_TRANSPORT',
+        'DATAPAGES_ENA_URL',
+        'DATAPAGES_ENA_BATCH_SIZE',
+        'DATAPAGES_SEQUENCESCAPE_BULK',
+        'DATAPAGES_SEQUENCESCAPE_CONNECTIONS',
+        'DATAPAGES_MYSQL_CONNECTIONS_PER_HOST',
+        'DATAPAGES_VRTRACK_SNAPSHOT_PATH',
+        'DATAPAGES_VRTRACK_FULL_REFRESH_HOURS',
+        'DATAPAGES_CONFIG_CACHE_DIR',
+        'DATAPAGES_TEMPLATE_CACHE_DIR',
+        'DATAPAGES_METRICS_PATH'
     ]
 
+    import yaml
     try:
         config_file.seek(0)
-        config_from_file = yaml.load(config_file)
+        config_from_file = load_yaml(config_file)
     except IOError:
         logging.warn("Could not load config from %s, using environment variables" % config_file.name)
         config_from_file = {}
@@ -115,9 +145,71 @@ def get_config(config_file):
 
     return config
 
+def _compiled_config_prefix(source_name):
+    return "domain_config_v%s_%s_" % (COMPILED_CONFIG_VERSION, slugify(os.path.basename(source_name)))
+
+def _compiled_config_path(cache_dir, source_name, content):
+    from .templates import get_template_source
+    content_hash = hashlib.sha256(content.encode('utf-8'))
+    for template_name in COMPILED_CONFIG_TEMPLATES:
+        content_hash.update(b'\0')
+        content_hash.update(get_template_source(template_name).encode('utf-8'))
+    return os.path.join(cache_dir, "%s%s.pickle" % (_compiled_config_prefix(source_name),
+                                                    content_hash.hexdigest()))
+
+def _load_compiled_config(cache_dir, source_name, content):
+    try:
+        with open(_compiled_config_path(cache_dir, source_name, content), 'rb') as compiled_file:
+            return pickle.load(compiled_file)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+
+def _remove_stale_compiled_configs(cache_dir, source_name, compiled_path):
+    """Removes configs compiled from earlier versions of the same file, or
+    by earlier versions of DomainConfig"""
+    prefix = _compiled_config_prefix(source_name)
+    current_prefix = "domain_config_v%s_" % COMPILED_CONFIG_VERSION
+    compiled_filename = os.path.basename(compiled_path)
+    for filename in os.listdir(cache_dir):
+        if (filename == compiled_filename or not filename.startswith('domain_config_v') or
+                not filename.endswith('.pickle')):
+            continue
+        # Hashes all have the same length, which tells this file apart from
+        # one whose name starts the same way
+        same_source = (filename.startswith(prefix) and
+                       len(filename) == len(compiled_filename))
+        if same_source or not filename.startswith(current_prefix):
+            try:
+                os.remove(os.path.join(cache_dir, filename))
+            except FileNotFoundError:
+                pass
+
+def _save_compiled_config(cache_dir, source_name, content, compiled):
+    os.makedirs(cache_dir, exist_ok=True)
+    compiled_path = _compiled_config_path(cache_dir, source_name, content)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as compiled_file:
+        pickle.dump(compiled, compiled_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(compiled_file.name, compiled_path)
+    _remove_stale_compiled_configs(cache_dir, source_name, compiled_path)
+
 class DomainConfig(object):
-    def __init__(self, config_file):
-        self.data = yaml.load(config_file)
+    """Config for a domain and its species
+
+    If a cache_dir is given, the parsed config and the HTML rendered for
+    each species are stored there, keyed on a hash of the config and the
+    templates used to render it, so that later runs with the same config
+    can skip parsing and rendering.  Only the latest compiled copy of each
+    config file is kept."""
+    def __init__(self, config_file, cache_dir=None):
+        content = config_file.read()
+        source_name = getattr(config_file, 'name', 'domain_config')
+        compiled = _load_compiled_config(cache_dir, source_name, content) if cache_dir else None
+        if compiled:
+            self.data = compiled['data']
+            self.rendered = compiled['rendered']
+        else:
+            self.data = load_yaml(content)
+            self.rendered = {}
         self.type = self.data['metadata'].get('type', 'unknown')
         if self.type != 'domain':
             message = "Expected %s to contain domain config, got %s; skipping" % (config_file.name, self.type)
@@ -127,6 +219,12 @@ class DomainConfig(object):
         self.list_data = self.data['metadata'].get('list_data', False)
         self.domain_name = self.data['metadata']['name']
         self.domain_title = self.data['metadata']['title']
+        if cache_dir and not compiled:
+            self.render_domain_description()
+            for species in self.species_list:
+                self._rendered_species(species)
+            _save_compiled_config(cache_dir, source_name, content, {'data': self.data,
+                                                                    'rendered': self.rendered})
 
     def is_visible(self, species):
         species_data = self.data['species'].get(species, {})
@@ -137,40 +235,43 @@ class DomainConfig(object):
         return species_data.get('aliases', [])
 
     def render_domain_description(self):
-        description = self.data['metadata']['description']
-        html = markdown.markdown(description,
-                                 extensions=['markdown.extensions.tables'])
-        return html
+        if 'domain_description' not in self.rendered:
+            description = self.data['metadata']['description']
+            self.rendered['domain_description'] = render_markdown(description)
+        return self.rendered['domain_description']
+
+    def _rendered_species(self, species):
+        from .templates import get_template
+        rendered_species = self.rendered.setdefault('species', {})
+        if species not in rendered_species:
+            species_data = self.data['species'].get(species, {})
+            rendered_species[species] = {
+                'description': render_markdown(species_data.get('description', '')),
+                'published_data_description': render_markdown(
+                    species_data.get('published_data_description', '')),
+                'links': get_template('fragments/links.html').render(
+                    links=species_data.get('links', []))
+            }
+        return rendered_species[species]
 
     def render_description(self, species):
-        species_data = self.data['species'].get(species, {})
-        markdown_content = species_data.get('description', '')
-        html = markdown.markdown(markdown_content,
-                                 extensions=['markdown.extensions.tables'])
-        return html
+        return self._rendered_species(species)['description']
 
     def render_published_data_description(self, species):
-        species_data = self.data['species'].get(species, {})
-        markdown_content = species_data.get('published_data_description', '')
-        html = markdown.markdown(markdown_content,
-                                 extensions=['markdown.extensions.tables'])
-        return html
+        return self._rendered_species(species)['published_data_description']
 
     def pubmed_ids(self, species):
         species_data = self.data['species'].get(species, {})
         return species_data.get('pubmed_ids', [])
 
     def render_links(self, species):
-        species_data = self.data['species'].get(species, {})
-        links = species_data.get('links', [])
-        template = Template("""\
-{% if links -%}
-<h4>Relevant Links</h4>
-<ul>
-  {%- for link in links %}
-  <li><a href="{{ link['url'] }}">{{ link['text'] }}</a></li>
-  {%- endfor %}
-</ul>
-{%- endif %}""")
-        html = template.render(links=links)
-        return html
+        return self._rendered_species(species)['links']
+
+    def species_metadata(self, species):
+        """The details shown alongside a species' data"""
+        return {
+            'description': self.render_description(species),
+            'published_data_description': self.render_published_data_description(species),
+            'pubmed_ids': self.pubmed_ids(species),
+            'links': self.render_links(species)
+        }
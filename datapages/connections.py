@@ -0,0 +1,178 @@
+"""Shares a few MySQL connections per host between the databases we read
+
+All of the vrtrack databases live on the same server, so rather than
+connecting to each of them in turn we keep a small pool of connections to
+each host and switch schema with select_db.  Connections which have been
+idle for a while are pinged before they are handed out and replaced if
+they have gone away.
+
+Connections are opened with autocommit so that a pooled connection never
+reads from a snapshot left behind by an earlier query.  A connection which
+was in use when an exception was raised is closed rather than reused, in
+case it was left half way through reading a result."""
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+import pymysql
+
+from .metrics import measure
+
+logger = logging.getLogger(__name__)
+
+class PooledConnection(object):
+    def __init__(self, connection, database):
+        self.connection = connection
+        self.database = database
+        self.last_used = time.time()
+
+class ConnectionPool(object):
+    """Up to max_connections connections to one server as one user
+
+    connection() blocks while all of them are in use, so it is safe to call
+    from as many threads as you like"""
+    def __init__(self, host, port, user, max_connections=4, ping_after_seconds=60):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.max_connections = max(1, max_connections)
+        self.ping_after_seconds = ping_after_seconds
+        self.idle = []
+        self.open_connections = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def _connect(self, database):
+        logger.info("Connecting to %s:%s" % (self.host, self.port))
+        with measure('mysql connect', host=self.host) as record:
+            record.requests += 1
+            connection = pymysql.connect(
+                host=self.host,
+                port=self.port,
+                user=self.user,
+                db=database,
+                autocommit=True
+            )
+        return PooledConnection(connection, database)
+
+    def _take_idle(self, database):
+        # Prefer a connection which is already using this database
+        for i, pooled in enumerate(self.idle):
+            if pooled.database == database:
+                return self.idle.pop(i)
+        return self.idle.pop()
+
+    def _acquire(self, database):
+        with self.condition:
+            while (not self.closed and not self.idle and
+                   self.open_connections >= self.max_connections):
+                self.condition.wait()
+            if self.closed:
+                raise ValueError("Connection pool for %s:%s is closed" % (self.host, self.port))
+            if self.idle:
+                return self._take_idle(database)
+            self.open_connections += 1
+        try:
+            return self._connect(database)
+        except BaseException:
+            self._forget()
+            raise
+
+    def _forget(self):
+        with self.condition:
+            self.open_connections -= 1
+            self.condition.notify()
+
+    def _discard(self, pooled):
+        try:
+            pooled.connection.close()
+        except pymysql.err.Error:
+            pass
+        self._forget()
+
+    def _release(self, pooled):
+        pooled.last_used = time.time()
+        with self.condition:
+            if not self.closed:
+                self.idle.append(pooled)
+                self.condition.notify()
+                return
+        self._discard(pooled)
+
+    def _check(self, pooled, database):
+        """Makes sure the connection is alive and using database"""
+        if not pooled.connection.open:
+            raise pymysql.err.InterfaceError("Connection has been closed")
+        if time.time() - pooled.last_used > self.ping_after_seconds:
+            pooled.connection.ping(False)
+        if pooled.database != database:
+            pooled.connection.select_db(database)
+            pooled.database = database
+
+    @contextmanager
+    def connection(self, database):
+        pooled = self._acquire(database)
+        try:
+            self._check(pooled, database)
+        except pymysql.err.Error as e:
+            logger.warning("Reconnecting to %s:%s (%s)" % (self.host, self.port, e))
+            try:
+                pooled.connection.close()
+            except pymysql.err.Error:
+                pass
+            try:
+                pooled = self._connect(database)
+            except BaseException:
+                self._forget()
+                raise
+        try:
+            yield pooled.connection
+        except BaseException:
+            self._discard(pooled)
+            raise
+        self._release(pooled)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.condition.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
+
+class ConnectionManager(object):
+    """Keeps a ConnectionPool for each host, port and user
+
+    Use it as a context manager, or call close(), to close every connection
+    when you're done"""
+    def __init__(self, max_connections_per_host=4, ping_after_seconds=60):
+        self.max_connections_per_host = max_connections_per_host
+        self.ping_after_seconds = ping_after_seconds
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def pool(self, host, port, user):
+        key = (host, port, user)
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(host, port, user,
+                                                 self.max_connections_per_host,
+                                                 self.ping_after_seconds)
+            return self.pools[key]
+
+    def connection(self, host, port, user, database):
+        return self.pool(host, port, user).connection(database)
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = list(self.pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
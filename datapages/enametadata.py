@@ -1,64 +1,343 @@
+import json
 import logging
 import re
 import requests
+import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree
 
+from .metrics import measure
+
+class TokenBucket(object):
+    """Limits the rate of requests shared between several threads"""
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last_update) * self.rate)
+                self.last_update = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class ENACache(object):
+    """Stores the run accessions for each study in an sqlite database
+
+    Entries younger than ttl seconds are used instead of asking the ENA"""
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.max_parameters = 500
+        # The cache may be used from a different thread to the one that
+        # created it, but never from more than one at once
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS study_runs (
+                study_accession TEXT PRIMARY KEY,
+                run_accessions TEXT NOT NULL,
+                fetched REAL NOT NULL
+            )""")
+
+    def get(self, study_accessions):
+        """Returns dicts of fresh and stale run accessions keyed by study"""
+        now = time.time()
+        fresh, stale = {}, {}
+        SIZE=self.max_parameters
+        for i in range(0, len(study_accessions), SIZE):
+            accn_group = study_accessions[i:i+SIZE]
+            query = """SELECT study_accession, run_accessions, fetched
+                       FROM study_runs
+                       WHERE study_accession IN (%s)""" % ",".join("?" * len(accn_group))
+            for study_accession, run_accessions, fetched in self.connection.execute(query, accn_group):
+                if now - fetched < self.ttl:
+                    fresh[study_accession] = json.loads(run_accessions)
+                else:
+                    stale[study_accession] = json.loads(run_accessions)
+        return fresh, stale
+
+    def update(self, runs_by_study):
+        now = time.time()
+        rows = [(study_accession, json.dumps(run_accessions), now)
+                for study_accession, run_accessions in runs_by_study.items()]
+        with self.connection:
+            self.connection.executemany("""INSERT OR REPLACE INTO study_runs
+                                           (study_accession, run_accessions, fetched)
+                                           VALUES (?, ?, ?)""", rows)
+
+    def close(self):
+        self.connection.close()
+
+def parse_id_range(id_range):
+    try:
+        (alpha, first_num, second_num) = re.match(r'^([a-zA-Z]+)([0-9]+)-\1([0-9]+)$', id_range).groups()
+        num_digits = len(first_num)
+        first_num, second_num = int(first_num), int(second_num)
+    except AttributeError:
+        if re.match(r'[a-zA-Z]+[0-9]+', id_range):
+            return [id_range]
+        else:
+            raise
+    else:
+        return [alpha+str(num).zfill(num_digits) for num in range(first_num, second_num+1)]
+
+def parse_run_ids(run_ids_string):
+    run_ranges = run_ids_string.split(",")
+    runs_ids = []
+    for id_range in run_ranges:
+        runs_ids += parse_id_range(id_range)
+    return runs_ids
+
+class XMLViewTransport(object):
+    """Finds the runs for a batch of studies with the ENA's XML view
+
+    The response is parsed as it arrives rather than once it has all been
+    read.  Only each study's identifiers and the elements leading to its
+    ENA-RUN xref are kept, and each study is thrown away once its runs have been found, so at most
+    one study's elements are held at a time.  The runs found are still
+    collected into a list, which grows with the batch and is most of the
+    memory a request uses.
+
+    The ENA may answer with a study's primary accession when asked for its
+    project, so runs are given the accession we asked for if the study has
+    it as one of its identifiers."""
+    # Identifiers and elements on the path to the ENA-RUN xref; everything
+    # else is dropped
+    KEPT_ELEMENTS = {'STUDY', 'IDENTIFIERS', 'PRIMARY_ID', 'SECONDARY_ID',
+                     'STUDY_LINKS', 'STUDY_LINK', 'XREF_LINK', 'DB', 'ID'}
+
+    def __init__(self, url="http://www.ebi.ac.uk/ena/data/view/", max_accessions=20, timeout=60):
+        self.url = url
+        # The accessions are part of the URL so batches can't be very big
+        self.max_accessions = max_accessions
+        self.timeout = timeout
+        self.chunk_size = 64 * 1024
+
+    def get_run_accessions(self, study_accessions):
+        url = "%s%s&display=xml" % (self.url, ",".join(study_accessions))
+        with requests.get(url, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            return list(self._parse(response.iter_content(self.chunk_size),
+                                    set(study_accessions)))
+
+    def _parse(self, chunks, wanted=()):
+        parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        depth = 0
+        root = None
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1 and element.tag == 'STUDY':
+                    for run in self._study_runs(element, wanted):
+                        yield run
+                    root.clear()
+                elif element.tag not in self.KEPT_ELEMENTS:
+                    element.clear()
+        parser.close()
+
+    def _study_runs(self, study, wanted=()):
+        study_accession = study.attrib['accession']
+        identifiers = [identifier.text for identifier in study.iterfind('./IDENTIFIERS/*')]
+        for identifier in [study_accession] + identifiers:
+            if identifier in wanted:
+                study_accession = identifier
+                break
+        run_ids_element = study.find('./STUDY_LINKS/STUDY_LINK/XREF_LINK/[DB="ENA-RUN"]/ID')
+        if run_ids_element is None:
+            return []
+        return [{'study_accession': study_accession, 'run_accession': run_accession}
+                for run_accession in parse_run_ids(run_ids_element.text)]
+
+class ReportTransport(object):
+    """Finds the runs for a batch of studies with the ENA portal's search,
+    which returns one line of tab separated values per run
+
+    The studies are sent in the body of the request, so batches can be
+    much bigger than with the XML view, and the response is read a line at
+    a time.  Studies may be given by their project (PRJ) or study (ERP)
+    accession."""
+    def __init__(self, url="https://www.ebi.ac.uk/ena/portal/api/search", max_accessions=200,
+                 timeout=60):
+        self.url = url
+        self.max_accessions = max_accessions
+        self.timeout = timeout
+
+    def _query(self, study_accessions):
+        return " OR ".join('study_accession="%s" OR secondary_study_accession="%s"' %
+                           (accession, accession) for accession in study_accessions)
+
+    def get_run_accessions(self, study_accessions):
+        wanted = set(study_accessions)
+        parameters = {
+            'result': 'read_run',
+            'query': self._query(study_accessions),
+            'fields': 'run_accession,study_accession,secondary_study_accession',
+            'format': 'tsv',
+            'limit': 0
+        }
+        with requests.post(self.url, data=parameters, timeout=self.timeout,
+                           stream=True) as response:
+            response.raise_for_status()
+            lines = response.iter_lines(decode_unicode=True)
+            header = next(lines, '').split('\t')
+            run_accessions = []
+            for line in lines:
+                if not line:
+                    continue
+                run = dict(zip(header, line.split('\t')))
+                # Runs can have several secondary accessions; each run is
+                # returned for whichever of its accessions we asked for
+                run_studies = (run.get('secondary_study_accession') or '').split(';')
+                run_studies.append(run.get('study_accession'))
+                for study_accession in run_studies:
+                    if study_accession in wanted:
+                        run_accessions.append({'study_accession': study_accession,
+                                               'run_accession': run['run_accession']})
+                        break
+            return run_accessions
+
+TRANSPORTS = {
+    'xml': XMLViewTransport,
+    'report': ReportTransport
+}
+
 class ENADetails(object):
-    def __init__(self):
-        self.url_template = "http://www.ebi.ac.uk/ena/data/view/%s&display=xml"
-        self.max_accessions = 20
-        self.wait = 1
+    """Finds the runs for studies in the ENA
+
+    Requests are made through transport, XMLViewTransport by default, which
+    can be pointed at a stand-in for the ENA or swapped for ReportTransport
+    (or anything else with max_accessions and get_run_accessions)"""
+    def __init__(self, concurrency=1, requests_per_second=1, max_retries=3, cache=None,
+                 transport=None):
+        if transport is None:
+            transport = XMLViewTransport()
+        self.transport = transport
+        self.concurrency = concurrency
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff = 2
+        self.cache = cache
         self.logger = logging.getLogger(__name__)
-    
+
     def get_run_accessions(self, study_accessions):
+        if self.cache is None:
+            return self._request_run_accessions(study_accessions)
+
+        fresh, stale = self.cache.get(study_accessions)
+        self.logger.info("Found %s of %s studies in the ena cache, %s of them stale" %
+                         (len(fresh) + len(stale), len(study_accessions), len(stale)))
+        accessions_to_request = [accession for accession in study_accessions
+                                 if accession not in fresh]
+        try:
+            requested = self._request_run_accessions(accessions_to_request)
+        except requests.exceptions.RequestException as e:
+            if any(accession not in stale for accession in accessions_to_request):
+                raise
+            # Everything we wanted is in the cache, it's just old
+            self.logger.warning("Could not refresh %s studies from the ena (%s), using cached details" %
+                                (len(stale), e))
+            fresh.update(stale)
+            requested = []
+        else:
+            # Studies without any runs are cached too so that we don't keep asking for them
+            runs_by_study = {accession: [] for accession in accessions_to_request}
+            unrequested = set()
+            for run in requested:
+                if run['study_accession'] in runs_by_study:
+                    runs_by_study[run['study_accession']].append(run['run_accession'])
+                else:
+                    unrequested.add(run['study_accession'])
+            if unrequested:
+                # We can't tell which of the studies we asked for these runs
+                # belong to, so only studies we found runs for are cached
+                self.logger.warning("The ena returned runs for %s studies we didn't ask for, "
+                                    "not caching studies without runs" % len(unrequested))
+                runs_by_study = {accession: runs for accession, runs in runs_by_study.items() if runs}
+            self.cache.update(runs_by_study)
+
+        sample_accessions = [{'study_accession': study_accession, 'run_accession': run_accession}
+                             for study_accession in study_accessions if study_accession in fresh
+                             for run_accession in fresh[study_accession]]
+        return sample_accessions + requested
+
+    def _request_run_accessions(self, study_accessions):
         self.logger.info("Getting details from the ena")
-        SIZE=self.max_accessions
-        accn_groups = (study_accessions[i:i+SIZE] for i in range(0,len(study_accessions),SIZE))
-        accn_group = next(accn_groups, [])
-        sample_accessions = self._get_run_accessions_for_group(accn_group)
-        number_of_groups = int((len(study_accessions)-1) / SIZE)
-        for i, accn_group in enumerate(accn_groups):
+        SIZE=self.transport.max_accessions
+        accn_groups = [study_accessions[i:i+SIZE] for i in range(0,len(study_accessions),SIZE)]
+        number_of_groups = len(accn_groups)
+        rate_limiter = TokenBucket(self.requests_per_second)
+
+        def get_group(indexed_group):
+            i, accn_group = indexed_group
             self.logger.info("  Making request %s of %s" % (i+1, number_of_groups))
-            time.sleep(self.wait)
-            sample_accessions += self._get_run_accessions_for_group(accn_group)
+            return self._get_run_accessions_with_retries(accn_group, rate_limiter)
+
+        sample_accessions = []
+        # map returns results in the order of the groups, so the output
+        # doesn't depend on how many requests are made at once
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            for group_accessions in executor.map(get_group, enumerate(accn_groups)):
+                sample_accessions += group_accessions
         return sample_accessions       
-    
+
+    def _should_retry(self, error):
+        if isinstance(error, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout)):
+            return True
+        response = getattr(error, 'response', None)
+        if response is None:
+            return False
+        return response.status_code == 429 or response.status_code >= 500
+
+    def _retry_delay(self, error, attempt):
+        response = getattr(error, 'response', None)
+        if response is not None:
+            try:
+                return float(response.headers['Retry-After'])
+            except (KeyError, ValueError):
+                pass
+        return self.backoff ** attempt
+
+    def _get_run_accessions_with_retries(self, study_accessions, rate_limiter):
+        for attempt in range(self.max_retries + 1):
+            rate_limiter.acquire()
+            try:
+                return self._get_run_accessions_for_group(study_accessions)
+            except requests.exceptions.RequestException as e:
+                if attempt == self.max_retries or not self._should_retry(e):
+                    raise
+                delay = self._retry_delay(e, attempt)
+                self.logger.warning("Request to the ena failed (%s), retrying in %ss" % (e, delay))
+                time.sleep(delay)
+
     def _get_run_accessions_for_group(self, study_accessions):
-        sample_accessions = []
         if not study_accessions:
             return []
-        studies_accessions_string = ",".join(study_accessions)
-        studies_response = requests.get(self.url_template % studies_accessions_string)
-        studies_response.raise_for_status()
-        studies_tree = ElementTree.fromstring(studies_response.content)
-        for study in studies_tree.findall('STUDY'):
-            study_accession = study.attrib['accession']
-            run_ids_element = study.find('./STUDY_LINKS/STUDY_LINK/XREF_LINK/[DB="ENA-RUN"]/ID')
-            if run_ids_element is None:
-                continue
-            run_ids_range_string = run_ids_element.text
-            run_ids_list = self.parse_run_ids(run_ids_range_string)
-            sample_accessions += [{'study_accession': study_accession, 'run_accession': run_accession}
-                                  for run_accession in run_ids_list]
-        return sample_accessions       
-            
+        with measure('ena batch') as record:
+            record.requests += 1
+            sample_accessions = self.transport.get_run_accessions(study_accessions)
+            record.rows += len(study_accessions)
+        return sample_accessions
+
     def parse_id_range(self, id_range):
-        try:
-            (alpha, first_num, second_num) = re.match(r'^([a-zA-Z]+)([0-9]+)-\1([0-9]+)$', id_range).groups()
-            num_digits = len(first_num)
-            first_num, second_num = int(first_num), int(second_num)
-        except AttributeError:
-            if re.match(r'[a-zA-Z]+[0-9]+', id_range):
-                return [id_range]
-            else:
-                raise
-        else:
-            return [alpha+str(num).zfill(num_digits) for num in range(first_num, second_num+1)]
+        return parse_id_range(id_range)
 
     def parse_run_ids(self, run_ids_string):
-        run_ranges = run_ids_string.split(",")
-        runs_ids = []
-        for id_range in run_ranges:
-            runs_ids += self.parse_id_range(id_range)
-        return runs_ids
+        return parse_run_ids(run_ids_string)
@@ -0,0 +1,177 @@
+"""Records how long each stage of a run takes, and how much it did
+
+Wrap a stage in `with measure('name') as record:` and add to record.rows and
+record.requests as it goes.  Stages with the same name and labels are added
+up, e.g. every batch of requests to the ena.  Stages inherit the labels of
+the stages they are run within (in the same thread), so the stages run for
+each domain can be told apart; pass current_labels() on to stages run in
+other threads.  Generators do their work as they are consumed, so wrap them
+in measure_each() to record it as a stage of its own.
+
+A stage's CPU time includes that of any worker processes which finished
+during it, and its memory is how much it raised the process's peak
+resident memory, so stages which didn't need more memory than earlier
+ones record nothing.
+
+write_metrics() saves everything in a JSON file, or a Prometheus textfile
+if the filename ends in .prom"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+MEASURES = [
+    ('calls', 'Number of times the stage was run'),
+    ('wall_seconds', 'Wall time spent in the stage'),
+    ('cpu_seconds', 'CPU time used by the thread running the stage and the worker processes it waited for'),
+    ('rows', 'Number of rows the stage fetched, processed or wrote'),
+    ('requests', 'Number of network requests or queries the stage made'),
+    ('peak_rss_increase_bytes', 'How much the stage raised the peak resident memory of the process')
+]
+
+def peak_rss_bytes():
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def children_cpu_seconds():
+    """CPU time of the child processes which have finished"""
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class StageRecord(object):
+    def __init__(self):
+        self.rows = 0
+        self.requests = 0
+
+class Metrics(object):
+    def __init__(self):
+        self.started = time.time()
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _current_labels(self):
+        return getattr(self.local, 'labels', {})
+
+    @contextmanager
+    def stage(self, name, **labels):
+        parent_labels = self._current_labels()
+        stage_labels = dict(parent_labels, **labels)
+        self.local.labels = stage_labels
+        record = StageRecord()
+        start, cpu_start = time.time(), time.thread_time()
+        children_cpu_start, peak_rss_start = children_cpu_seconds(), peak_rss_bytes()
+        try:
+            yield record
+        finally:
+            wall_seconds = time.time() - start
+            cpu_seconds = (time.thread_time() - cpu_start +
+                           children_cpu_seconds() - children_cpu_start)
+            peak_rss_increase = peak_rss_bytes() - peak_rss_start
+            self.local.labels = parent_labels
+            self._add(name, stage_labels, wall_seconds, cpu_seconds, peak_rss_increase, record)
+
+    def _add(self, name, labels, wall_seconds, cpu_seconds, peak_rss_increase, record):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            stage_metrics = self.stages.setdefault(key, {measure: 0 for measure, _ in MEASURES})
+            stage_metrics['calls'] += 1
+            stage_metrics['wall_seconds'] += wall_seconds
+            stage_metrics['cpu_seconds'] += cpu_seconds
+            stage_metrics['rows'] += record.rows
+            stage_metrics['requests'] += record.requests
+            stage_metrics['peak_rss_increase_bytes'] += peak_rss_increase
+
+    def as_dict(self):
+        with self.lock:
+            stages = [dict(stage_metrics, stage=name, labels=dict(labels))
+                      for (name, labels), stage_metrics in self.stages.items()]
+        return {
+            'started': self.started,
+            'wall_seconds': time.time() - self.started,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stages': stages
+        }
+
+    def as_prometheus(self):
+        metrics = self.as_dict()
+        lines = []
+        for measure_name, description in MEASURES:
+            lines.append("# HELP datapages_stage_%s %s" % (measure_name, description))
+            lines.append("# TYPE datapages_stage_%s gauge" % measure_name)
+            for stage_metrics in metrics['stages']:
+                labels = dict(stage_metrics['labels'], stage=stage_metrics['stage'])
+                label_string = ",".join('%s="%s"' % (key, _escape_label(value))
+                                        for key, value in sorted(labels.items()))
+                lines.append("datapages_stage_%s{%s} %s" % (measure_name, label_string,
+                                                            stage_metrics[measure_name]))
+        for measure_name, description in [('started', 'When the last run started, in seconds since the epoch'),
+                                     ('wall_seconds', 'How long the last run took'),
+                                     ('peak_rss_bytes', 'Peak resident memory of the last run')]:
+            lines.append("# HELP datapages_run_%s %s" % (measure_name, description))
+            lines.append("# TYPE datapages_run_%s gauge" % measure_name)
+            lines.append("datapages_run_%s %s" % (measure_name, metrics[measure_name]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes the metrics atomically so that they can be scraped at any time"""
+        if path.endswith('.prom'):
+            content = self.as_prometheus()
+        else:
+            content = json.dumps(self.as_dict(), indent=2)
+        temp_path = "%s.tmp" % path
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(temp_path, path)
+        logger.info("Wrote metrics to %s" % path)
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+_metrics = Metrics()
+
+def get_metrics():
+    return _metrics
+
+def reset_metrics():
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+def measure(name, **labels):
+    return _metrics.stage(name, **labels)
+
+def current_labels():
+    """The labels of the stages this thread is running within"""
+    return dict(_metrics._current_labels())
+
+def measure_each(name, iterable, **labels):
+    """Yields the items of iterable, adding the time taken to produce each
+    one to the stage"""
+    iterator = iter(iterable)
+    while True:
+        with measure(name, **labels) as record:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            record.rows += 1
+        yield item
+
+def write_metrics(path):
+    _metrics.write(path)
@@ -1,5 +1,6 @@
 import collections
 import logging
+import numpy as np
 import os
 import pandas as pd
 import pickle
@@ -7,10 +8,13 @@ import yaml
 
 from datetime import datetime
 
-from .common import cache_data, reload_cache_data
-from .vrtrack import Vrtrack
-from .enametadata import ENADetails
+from .cache import cache_data, reload_cache_data
+from .connections import ConnectionManager
+from .vrtrack import Vrtrack, LaneSnapshots
+from .enametadata import ENADetails, ENACache, TRANSPORTS
+from .metrics import measure
 from .sequencescape import Sfind
+from .stages import StageGraph
 
 DbDetails = collections.namedtuple('DbDetails', 'host, port, database, user')
 logger = logging.getLogger(__name__)
@@ -31,36 +35,183 @@ def get_sequencescape_db_details(config):
         config['DATAPAGES_SEQUENCESCAPE_RO_USER']
     )
 
-def get_all_data(vrtrack_db_details_list, sequencescape_db_details):
-    lane_details = []
+def _is_true(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def get_sequencescape_options(config):
+    return {
+        'bulk': _is_true(config.get('DATAPAGES_SEQUENCESCAPE_BULK')),
+        'connections': int(config.get('DATAPAGES_SEQUENCESCAPE_CONNECTIONS') or 1)
+    }
+
+def get_connection_options(config):
+    return {
+        'max_connections_per_host': int(config.get('DATAPAGES_MYSQL_CONNECTIONS_PER_HOST') or 4)
+    }
+
+def get_lane_snapshots(config):
+    if not config.get('DATAPAGES_VRTRACK_SNAPSHOT_PATH'):
+        return None
+    full_refresh_hours = config.get('DATAPAGES_VRTRACK_FULL_REFRESH_HOURS')
+    if full_refresh_hours is None or full_refresh_hours == '':
+        full_refresh_hours = 168
+    return LaneSnapshots(config['DATAPAGES_VRTRACK_SNAPSHOT_PATH'],
+                         float(full_refresh_hours) * 60 * 60)
+
+def get_ena_transport(config):
+    transport_name = config.get('DATAPAGES_ENA_TRANSPORT') or 'xml'
+    try:
+        transport_class = TRANSPORTS[transport_name]
+    except KeyError:
+        raise ValueError("Unknown DATAPAGES_ENA_TRANSPORT %s, expected one of %s" %
+                         (transport_name, ", ".join(sorted(TRANSPORTS))))
+    options = {}
+    if config.get('DATAPAGES_ENA_URL'):
+        options['url'] = config['DATAPAGES_ENA_URL']
+    if config.get('DATAPAGES_ENA_BATCH_SIZE'):
+        options['max_accessions'] = int(config['DATAPAGES_ENA_BATCH_SIZE'])
+    return transport_class(**options)
+
+def get_ena_details(config):
+    if config.get('DATAPAGES_ENA_CACHE_PATH'):
+        ttl_hours = float(config.get('DATAPAGES_ENA_CACHE_TTL_HOURS') or 72)
+        cache = ENACache(config['DATAPAGES_ENA_CACHE_PATH'], ttl_hours * 60 * 60)
+    else:
+        cache = None
+    return ENADetails(
+        concurrency=int(config.get('DATAPAGES_ENA_CONCURRENCY') or 1),
+        requests_per_second=float(config.get('DATAPAGES_ENA_REQUESTS_PER_SECOND') or 1),
+        cache=cache,
+        transport=get_ena_transport(config)
+    )
+
+def _unique_values(lane_details, column):
+    return lane_details[column].dropna().unique().tolist()
+
+def _combine_lanes(lane_details_list):
+    return pd.concat(lane_details_list, ignore_index=True)
+
+def get_data_by_database(vrtrack_db_details_list, sequencescape_db_details, ena=None,
+                         sequencescape_options=None, connection_options=None,
+                         lane_snapshots=None):
+    """Returns the lanes from each vrtrack database with the ena and
+    sequencescape details for all of them
+
+    Every query shares a small pool of connections to each database host,
+    which is closed before returning.  If lane_snapshots is given only the
+    lanes which changed since the last run are read from vrtrack."""
+    if ena is None:
+        ena = ENADetails()
+    if sequencescape_options is None:
+        sequencescape_options = {}
+    if connection_options is None:
+        connection_options = {}
+    # Let sequencescape use as many connections as it has been asked to
+    connection_options = dict(connection_options)
+    connection_options['max_connections_per_host'] = max(
+        connection_options.get('max_connections_per_host', 4),
+        sequencescape_options.get('connections', 1))
+    connection_manager = ConnectionManager(**connection_options)
+
+    def lanes_getter(vrtrack_db_details):
+        def get_lanes(inputs):
+            vrtrack = Vrtrack(vrtrack_db_details.host, vrtrack_db_details.port,
+                              vrtrack_db_details.database, vrtrack_db_details.user,
+                              connection_manager=connection_manager)
+            if lane_snapshots is not None:
+                return vrtrack.get_lanes_incrementally(lane_snapshots)
+            return vrtrack.get_lanes_dataframe()
+        return get_lanes
+
+    def combine_lanes(inputs):
+        return _combine_lanes([inputs[stage_name] for stage_name in vrtrack_stage_names.values()])
+
+    def get_ena_run_details(inputs):
+        study_accessions = _unique_values(inputs['lanes'], 'study_accession')
+        return ena.get_run_accessions(study_accessions)
+
+    def get_studies(inputs):
+        project_ssids = _unique_values(inputs['lanes'], 'project_ssid')
+        sfind = Sfind(sequencescape_db_details.host,
+                      sequencescape_db_details.port,
+                      sequencescape_db_details.database,
+                      sequencescape_db_details.user,
+                      connection_manager=connection_manager,
+                      **sequencescape_options)
+        return sfind.get_studies(project_ssids)
+
+    # The vrtrack databases are independent of each other; ena and
+    # sequencescape only need to know which lanes we found
+    graph = StageGraph()
+    vrtrack_stage_names = collections.OrderedDict()
     for vrtrack_db_details in vrtrack_db_details_list:
-      vrtrack = Vrtrack(vrtrack_db_details.host, vrtrack_db_details.port,
-                        vrtrack_db_details.database, vrtrack_db_details.user)
-      lane_details += vrtrack.get_lanes()
-    project_ssids = list({lane['project_ssid'] for lane in lane_details})
-    study_accessions = list({lane['study_accession'] for lane in lane_details})
-    ena = ENADetails()
-    ena_run_details = ena.get_run_accessions(study_accessions)
-    sfind = Sfind(sequencescape_db_details.host,
-                  sequencescape_db_details.port,
-                  sequencescape_db_details.database,
-                  sequencescape_db_details.user)
-    studies = sfind.get_studies(project_ssids)
+        if vrtrack_db_details.database in vrtrack_stage_names:
+            continue
+        stage_name = "vrtrack %s" % vrtrack_db_details.database
+        graph.add(stage_name, lanes_getter(vrtrack_db_details))
+        vrtrack_stage_names[vrtrack_db_details.database] = stage_name
+    graph.add('lanes', combine_lanes, vrtrack_stage_names.values())
+    graph.add('ena', get_ena_run_details, ['lanes'])
+    graph.add('sequencescape', get_studies, ['lanes'])
+    with connection_manager:
+        results = graph.run()
+    lanes_by_database = {database: results[stage_name] for database, stage_name
+                         in vrtrack_stage_names.items()}
+    return lanes_by_database, results['ena'], results['sequencescape']
+
+def get_all_data(vrtrack_db_details_list, sequencescape_db_details, ena=None,
+                 sequencescape_options=None, connection_options=None, lane_snapshots=None):
+    lanes_by_database, ena_run_details, studies = get_data_by_database(vrtrack_db_details_list,
+                                                                       sequencescape_db_details,
+                                                                       ena, sequencescape_options,
+                                                                       connection_options,
+                                                                       lane_snapshots)
+    lane_details = _combine_lanes([lanes_by_database[vrtrack_db_details.database]
+                                   for vrtrack_db_details in vrtrack_db_details_list])
     return lane_details, ena_run_details, studies
 
-def join_vrtrack_sequencescape(vrtrack, sequencescape):
-    logger.info("Joining vrtrack and sequencescape data")
-    # Sequencescape has our 'public' names for things, like the study title
-    # We want to use these in preference to the details in the vrtrack database
-    sequencescape_study_data = sequencescape[['project_ssid', 'study_title', 'study_name']].drop_duplicates()
-    joint_data = pd.merge(vrtrack, sequencescape_study_data, how='left',
-                          on='project_ssid', sort=False, suffixes=('_v', '_ss'))
-    del(sequencescape_study_data)
+def _domain_slice(domain_config, lanes_by_database, ena_run_details, studies):
+    lane_details = _combine_lanes([lanes_by_database[database]
+                                   for database in domain_config.databases])
+    study_accessions = set(_unique_values(lane_details, 'study_accession'))
+    project_ssids = set(_unique_values(lane_details, 'project_ssid'))
+    domain_ena_run_details = [run for run in ena_run_details
+                              if run['study_accession'] in study_accessions]
+    domain_studies = [study for study in studies
+                      if study['project_ssid'] in project_ssids]
+    return lane_details, domain_ena_run_details, domain_studies
 
-    sequencescape_sample_data = sequencescape[['sample_name', 'sample_accession', 'sample_common_name',
-                                               'sample_organism', 'sample_public_name', 'sample_strain',
-                                               'sample_supplier_name']].drop_duplicates()
+def get_data_for_domains(global_config, domain_configs):
+    """Fetches data for several domains, querying each source once
 
+    Returns a dictionary of domain_name => (lane_details, ena_run_details, studies)
+    with the same data get_all_data would have found for each domain"""
+    databases = []
+    for domain_config in domain_configs:
+        databases += [database for database in domain_config.databases
+                      if database not in databases]
+    logger.info("Loading data for %s domains from %s vrtrack databases" %
+                (len(domain_configs), len(databases)))
+    vrtrack_db_details_list = get_vrtrack_db_details_list(global_config, databases)
+    sequencescape_db_details = get_sequencescape_db_details(global_config)
+    ena = get_ena_details(global_config)
+    sequencescape_options = get_sequencescape_options(global_config)
+    connection_options = get_connection_options(global_config)
+    lane_snapshots = get_lane_snapshots(global_config)
+    lanes_by_database, ena_run_details, studies = get_data_by_database(vrtrack_db_details_list,
+                                                                       sequencescape_db_details,
+                                                                       ena, sequencescape_options,
+                                                                       connection_options,
+                                                                       lane_snapshots)
+    return {domain_config.domain_name: _domain_slice(domain_config, lanes_by_database,
+                                                     ena_run_details, studies)
+            for domain_config in domain_configs}
+
+SAMPLE_COLUMNS = ['sample_name', 'sample_accession', 'sample_common_name',
+                  'sample_organism', 'sample_public_name', 'sample_strain',
+                  'sample_supplier_name']
+
+def _join_samples_by_merging(joint_data, sequencescape_sample_data):
     # Many entries in sequencescape share an ERS number with their entry in vrtrack
     # Use this as the joining key
     data_joined_by_sample_accession = pd.merge(joint_data.reset_index(),
@@ -81,8 +232,69 @@ def join_vrtrack_sequencescape(vrtrack, sequencescape):
     data_joined_by_sample_name.set_index('index', inplace=True)
 
     # Merge the two matches, by default keeping the match based on ERS number
-    assert sorted(data_joined_by_sample_accession.columns) == sorted(data_joined_by_sample_name.columns),             "Weird things happen if these don't have the same columns"
-    joint_data = data_joined_by_sample_accession.combine_first(data_joined_by_sample_name)
+    assert sorted(data_joined_by_sample_accession.columns) == sorted(data_joined_by_sample_name.columns), \
+           "Weird things happen if these don't have the same columns"
+    return data_joined_by_sample_accession.combine_first(data_joined_by_sample_name)
+
+def _take(values, positions):
+    """values[positions] with NaN wherever the position is -1"""
+    values = np.append(np.asarray(values, dtype=object), np.nan)
+    return values[positions]
+
+def _join_samples_by_lookup(joint_data, sequencescape_sample_data):
+    """Looks up each lane's sample by ERS number, then by name, using one
+    hash index per key rather than merging all of the lanes twice
+
+    Each lookup key must be unique in sequencescape_sample_data"""
+    samples_with_accession = sequencescape_sample_data[sequencescape_sample_data['sample_accession'].notnull()]
+    by_accession = samples_with_accession.drop_duplicates('sample_accession').set_index('sample_accession')
+    by_name = sequencescape_sample_data.drop_duplicates('sample_name').set_index('sample_name', drop=False)
+    accession_positions = by_accession.index.get_indexer(joint_data['sample_accession'])
+    name_positions = by_name.index.get_indexer(joint_data['internal_sample_name'])
+
+    joint_data = joint_data.rename(columns={'sample_accession': 'sample_accession_v'})
+    for column in SAMPLE_COLUMNS:
+        if column == 'sample_accession':
+            continue
+        # Details from the match on ERS number win, column by column
+        by_accession_values = _take(by_accession[column], accession_positions)
+        by_name_values = _take(by_name[column], name_positions)
+        values = np.where(pd.isnull(by_accession_values), by_name_values, by_accession_values)
+        joint_data[column] = pd.Series(values, index=joint_data.index)
+    sample_accession_ss = np.where(joint_data['sample_accession_v'].isnull(),
+                                   _take(by_name['sample_accession'], name_positions),
+                                   joint_data['sample_accession_v'].values)
+    joint_data['sample_accession_ss'] = pd.Series(sample_accession_ss, index=joint_data.index)
+    return joint_data
+
+def _ambiguous_lanes(lanes, sequencescape_sample_data):
+    """Lanes whose ERS number or name match more than one sample"""
+    accessions = sequencescape_sample_data['sample_accession'].dropna()
+    names = sequencescape_sample_data['sample_name']
+    return (lanes['sample_accession'].isin(accessions[accessions.duplicated()]) |
+            lanes['internal_sample_name'].isin(names[names.duplicated()]))
+
+def join_vrtrack_sequencescape(vrtrack, sequencescape):
+    logger.info("Joining vrtrack and sequencescape data")
+    # Sequencescape has our 'public' names for things, like the study title
+    # We want to use these in preference to the details in the vrtrack database
+    sequencescape_study_data = sequencescape[['project_ssid', 'study_title', 'study_name']].drop_duplicates()
+    joint_data = pd.merge(vrtrack, sequencescape_study_data, how='left',
+                          on='project_ssid', sort=False, suffixes=('_v', '_ss'))
+    del(sequencescape_study_data)
+
+    sequencescape_sample_data = sequencescape[SAMPLE_COLUMNS].drop_duplicates()
+
+    # Lanes whose ERS number or name match more than one sample can turn into
+    # several rows so they are still merged; everything else is looked up
+    ambiguous = _ambiguous_lanes(joint_data, sequencescape_sample_data)
+    if not ambiguous.any():
+        return _join_samples_by_lookup(joint_data, sequencescape_sample_data)
+
+    merged = _join_samples_by_merging(joint_data[ambiguous], sequencescape_sample_data)
+    looked_up = _join_samples_by_lookup(joint_data[~ambiguous], sequencescape_sample_data)
+    joint_data = pd.concat([looked_up, merged[looked_up.columns]])
+    joint_data.sort_index(kind='mergesort', inplace=True)
     return joint_data.reset_index(drop=True)
 
 def _get_default_columns(joint_data, column, default_columns, otherwise='Unknown'):
@@ -124,9 +336,18 @@ def merge_data(lane_details, ena_run_details, studies):
     vrtrack_details['withdrawn'] = vrtrack_details['withdrawn'] == 1
     ena_details = pd.DataFrame(ena_run_details)
     ss_details = pd.DataFrame(studies)
-    joint_data = join_vrtrack_sequencescape(vrtrack_details, ss_details)
-    add_canonical_data(joint_data)
-    joint_data = merge_ena_status(joint_data, ena_details)
+    with measure('join_vrtrack_sequencescape') as record:
+        joint_data = join_vrtrack_sequencescape(vrtrack_details, ss_details)
+        record.rows += len(joint_data.index)
+    return _add_canonical_data_and_ena_status(joint_data, ena_details)
+
+def _add_canonical_data_and_ena_status(joint_data, ena_details):
+    with measure('add_canonical_data') as record:
+        add_canonical_data(joint_data)
+        record.rows += len(joint_data.index)
+    with measure('merge_ena_status') as record:
+        joint_data = merge_ena_status(joint_data, ena_details)
+        record.rows += len(joint_data.index)
     return joint_data
 
 def generate_empty_data(domain_config):
@@ -144,40 +365,103 @@ def generate_empty_data(domain_config):
     for species in domain_config.species_list:
         if not domain_config.is_visible(species):
             continue
-        yield (species, {
+        data = {
             'columns': prefered_column_names,
             'count': 0,
-            'data': [],
-            'description': domain_config.render_description(species),
-            'published_data_description': domain_config.render_published_data_description(species),
-            'pubmed_ids': domain_config.pubmed_ids(species),
-            'links': domain_config.render_links(species),
-            'species': species,
-            'updated': now.isoformat()
-        })
+            'data': []
+        }
+        data.update(domain_config.species_metadata(species))
+        data.update(species=species, updated=now.isoformat())
+        yield (species, data)
 
-def build_relevant_data(joint_data, domain_config):
-    logger.info("Reformatting data for export")
-    now = datetime.now()
-    column_name_map = collections.OrderedDict([
-        ('species_name', 'Species'),
-        ('canonical_study_name', 'Study Name'),
-        ('study_accession', 'Study Accession'),
-        ('canonical_sample_name', 'Sample Name'),
-        ('canonical_strain', 'Strain'),
-        ('run_accession', 'Run Accession'),
-        ('sample_accession_v', 'Sample Accession')
-    ])
-    original_column_names = list(column_name_map.keys())
-    prefered_column_names = [column_name_map[key] for key in
-                             original_column_names]
+class SpeciesRouter(object):
+    """Works out which rows belong to each visible species in one pass
+
+    A row belongs to a species if its species name starts with the
+    name of the species, or one of its aliases, ignoring case.  Each
+    distinct species name in the data is only looked up once."""
+    def __init__(self, domain_config):
+        self.species_list = []
+        self.species_by_prefix = collections.defaultdict(set)
+        for species in domain_config.species_list:
+            if not domain_config.is_visible(species):
+                continue
+            self.species_list.append(species)
+            # Some species have common names which they
+            # may also be referred to by.
+            for name in [species] + domain_config.aliases(species):
+                self.species_by_prefix[name.lower()].add(species)
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.species_by_prefix})
+
+    def matching_species(self, name):
+        matches = set()
+        for length in self.prefix_lengths:
+            if length > len(name):
+                break
+            matches.update(self.species_by_prefix.get(name[:length], ()))
+        return matches
 
+    def route(self, species_names):
+        """Returns the positions of the rows for each species, in order"""
+        # Only the distinct names are lowercased, rather than every row's
+        codes, unique_names = pd.factorize(species_names.fillna(''))
+        lowercase_codes, unique_names = pd.factorize(pd.Index(unique_names, dtype=object).str.lower())
+        codes = lowercase_codes[codes]
+        rows_by_code = np.split(np.argsort(codes, kind='stable'),
+                                np.cumsum(np.bincount(codes, minlength=len(unique_names)))[:-1])
+        codes_by_species = {species: [] for species in self.species_list}
+        for code, name in enumerate(unique_names):
+            for species in self.matching_species(name):
+                codes_by_species[species].append(code)
+        species_rows = {}
+        for species, species_codes in codes_by_species.items():
+            if species_codes:
+                rows = np.sort(np.concatenate([rows_by_code[code] for code in species_codes]))
+            else:
+                rows = np.array([], dtype=np.intp)
+            species_rows[species] = rows
+        return species_rows
+
+EXPORTED_COLUMNS = collections.OrderedDict([
+    ('species_name', 'Species'),
+    ('canonical_study_name', 'Study Name'),
+    ('study_accession', 'Study Accession'),
+    ('canonical_sample_name', 'Sample Name'),
+    ('canonical_strain', 'Strain'),
+    ('run_accession', 'Run Accession'),
+    ('sample_accession_v', 'Sample Accession')
+])
+
+def _exported_rows(joint_data):
     tmp = joint_data[(joint_data['withdrawn'] == False) &
                      joint_data['run_in_ena'] &
                      joint_data['study_in_ena']]
-    tmp = tmp[original_column_names]
-    tmp.columns = prefered_column_names
-    lowercase_cache = tmp.apply(lambda row: row['Species'].lower(), axis=1)
+    tmp = tmp[list(EXPORTED_COLUMNS.keys())]
+    tmp.columns = list(EXPORTED_COLUMNS.values())
+    return tmp
+
+def _species_data(species, rows, domain_config, now):
+    data = {
+        'columns': list(EXPORTED_COLUMNS.values()),
+        'count': len(rows),
+        'data': rows
+    }
+    data.update(domain_config.species_metadata(species))
+    data.update(species=species, updated=now.isoformat())
+    return data
+
+def route_species_rows(exported, domain_config):
+    """Returns the positions of the exported rows for each visible species"""
+    with measure('species routing') as record:
+        species_rows = SpeciesRouter(domain_config).route(exported['Species'])
+        record.rows += len(exported.index)
+    return species_rows
+
+def build_relevant_data(joint_data, domain_config):
+    logger.info("Reformatting data for export")
+    now = datetime.now()
+    tmp = _exported_rows(joint_data)
+    species_rows = route_species_rows(tmp, domain_config)
     for species in domain_config.species_list:
         # Species can be temporarily hidden by setting
         # show: false
@@ -185,47 +469,172 @@ def build_relevant_data(joint_data, domain_config):
         if not domain_config.is_visible(species):
             continue
 
-        mask = lowercase_cache.map(lambda el: el.startswith(species.lower()))
-        # Some species have common names which they
-        # may also be referred to by.
-        for alias in domain_config.aliases(species):
-            alias_mask = lowercase_cache.map(lambda el:
-                                             el.startswith(alias.lower()))
-            mask = mask | alias_mask
-        species_data = tmp[mask]
-        yield (species, {
-            'columns': prefered_column_names,
-            'count': len(species_data.index),
-            'data': species_data.values.tolist(),
-            'description': domain_config.render_description(species),
-            'published_data_description': domain_config.render_published_data_description(species),
-            'pubmed_ids': domain_config.pubmed_ids(species),
-            'links': domain_config.render_links(species),
-            'species': species,
-            'updated': now.isoformat()
-        })
-
-def generate_data(global_config, domain_config):
+        species_data = tmp.iloc[species_rows[species]]
+        yield (species, _species_data(species, species_data.values.tolist(),
+                                      domain_config, now))
+
+class RowsByValue(object):
+    """Finds the rows with any of some values in a column without going
+    through the whole column each time
+
+    Row positions are sorted by value once so that the rows for each value
+    are next to each other."""
+    def __init__(self, column):
+        codes, uniques = pd.factorize(column)
+        self.values = pd.Index(uniques)
+        # Missing values have code -1 so they sort first and are skipped
+        self.order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        self.starts = np.concatenate([[0], np.cumsum(counts)]) + np.count_nonzero(codes < 0)
+
+    def positions(self, values):
+        codes = self.values.get_indexer(pd.unique(values))
+        codes = codes[codes >= 0]
+        starts, lengths = self.starts[codes], self.starts[codes + 1] - self.starts[codes]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return self.order[np.repeat(starts, lengths) + offsets]
+
+class DetailsForLanes(object):
+    """Picks out the ena runs and sequencescape rows which could be joined
+    to some of the lanes, keeping them in their original order
+
+    Sequencescape samples are joined on their ERS number or name, whichever
+    project they are in, so every row sharing either with one of the lanes
+    is kept; otherwise a duplicate could be missed."""
+    def __init__(self, ena_details, ss_details):
+        self.ena_details = ena_details
+        self.ss_details = ss_details
+        self.ena_by_value = [(column, RowsByValue(ena_details[column]))
+                             for column in ['run_accession', 'study_accession']]
+        self.ss_by_value = [(column, RowsByValue(ss_details[ss_column])) for column, ss_column in
+                            [('project_ssid', 'project_ssid'),
+                             ('sample_accession', 'sample_accession'),
+                             ('internal_sample_name', 'sample_name')]]
+
+    def _rows(self, details, by_value, lanes):
+        positions = [rows.positions(lanes[column].dropna()) for column, rows in by_value]
+        return details.iloc[np.unique(np.concatenate(positions))]
+
+    def ena_details_for(self, lanes):
+        return self._rows(self.ena_details, self.ena_by_value, lanes)
+
+    def ss_details_for(self, lanes):
+        return self._rows(self.ss_details, self.ss_by_value, lanes)
+
+def _join_lanes(lanes, ambiguous, ambiguous_joint_data, details):
+    """Joins some lanes with sequencescape, in the order of their
+    lane_position, using rows already joined for the ambiguous ones"""
+    plain_lanes = lanes[~ambiguous]
+    joint_data = join_vrtrack_sequencescape(plain_lanes, details.ss_details_for(plain_lanes))
+    ambiguous_rows = ambiguous_joint_data[
+        ambiguous_joint_data['lane_position'].isin(lanes['lane_position'][ambiguous])]
+    joint_data = pd.concat([joint_data, ambiguous_rows[joint_data.columns]])
+    joint_data.sort_values('lane_position', kind='mergesort', inplace=True)
+    return joint_data.reset_index(drop=True)
+
+def _species_batches(domain_config, species_rows, batch_size):
+    """Groups the visible species into batches of at most batch_size lanes,
+    or of one species if it has more lanes than that"""
+    batch, batch_lanes = [], 0
+    for species in domain_config.species_list:
+        if not domain_config.is_visible(species):
+            continue
+        species_lanes = len(species_rows[species])
+        if batch and batch_lanes + species_lanes > batch_size:
+            yield batch
+            batch, batch_lanes = [], 0
+        batch.append(species)
+        batch_lanes += species_lanes
+    if batch:
+        yield batch
+
+def stream_relevant_data(lane_details, ena_run_details, studies, domain_config,
+                         batch_size=20000):
+    """Yields the same as build_relevant_data(merge_data(...)) but joins
+    the data a few species at a time
+
+    Lanes are split by species before they are joined with everything else,
+    so only the joined data for at most batch_size lanes (or the largest
+    species) is held in memory rather than that for the whole domain.
+    Small species are joined together to save on the overhead of each join.
+    The sources, and the joined rows of lanes matching more than one sample,
+    are held throughout."""
+    logger.info("Streaming data for export a few species at a time")
+    now = datetime.now()
+    lane_details = pd.DataFrame(lane_details)
+    lane_details['withdrawn'] = lane_details['withdrawn'] == 1
+    lane_details['lane_position'] = np.arange(len(lane_details.index))
+    ena_details = pd.DataFrame(ena_run_details, columns=['study_accession', 'run_accession'])
+    ss_details = pd.DataFrame(studies)
+
+    # Lanes matching more than one sample are merged, which gives rows that
+    # depend on the other lanes merged at the same time, so they are joined
+    # all together as merge_data would.  There are usually only a few.
+    ambiguous = _ambiguous_lanes(lane_details, ss_details[SAMPLE_COLUMNS].drop_duplicates()).values
+    with measure('join_vrtrack_sequencescape') as record:
+        ambiguous_joint_data = join_vrtrack_sequencescape(lane_details[ambiguous], ss_details)
+        record.rows += len(ambiguous_joint_data.index)
+    details = DetailsForLanes(ena_details, ss_details)
+
+    with measure('species routing') as record:
+        species_rows = SpeciesRouter(domain_config).route(lane_details['species_name'])
+        record.rows += len(lane_details.index)
+    for batch in _species_batches(domain_config, species_rows, batch_size):
+        # Lanes can belong to more than one species but are only joined once
+        positions = np.unique(np.concatenate([species_rows[species] for species in batch]))
+        if len(positions):
+            lanes = lane_details.iloc[positions]
+            with measure('join_vrtrack_sequencescape') as record:
+                joint_data = _join_lanes(lanes, ambiguous[positions], ambiguous_joint_data, details)
+                record.rows += len(joint_data.index)
+            joint_data = _add_canonical_data_and_ena_status(joint_data,
+                                                            details.ena_details_for(lanes))
+            exported = _exported_rows(joint_data)
+            exported_positions = joint_data.loc[exported.index, 'lane_position']
+            del(joint_data, lanes)
+        for species in batch:
+            if len(positions):
+                species_mask = exported_positions.isin(species_rows[species]).values
+                rows = exported[species_mask].values.tolist()
+            else:
+                rows = []
+            yield (species, _species_data(species, rows, domain_config, now))
+
+def fetch_source_data(global_config, domain_config, fetched_data=None):
+    """Returns (lane_details, ena_run_details, studies) for the domain
+
+    They come from the cache if DATAPAGES_LOAD_CACHE_PATH is set, otherwise
+    from fetched_data if it is given, otherwise from the databases."""
     if global_config.get('DATAPAGES_LOAD_CACHE_PATH'):
         cache_path = global_config.get('DATAPAGES_LOAD_CACHE_PATH')
         logging.warn("Loading cached data from %s" % cache_path)
         data = reload_cache_data(cache_path, domain_config.domain_name)
         project_ssids = data['project_ssids']
         ena_run_details = data['ena_run_details']
-        lane_details = data['lane_details']
+        # Older caches have a list of dicts rather than a DataFrame
+        lane_details = pd.DataFrame(data['lane_details'])
         studies = data['ss_studies']
+    elif fetched_data is not None:
+        lane_details, ena_run_details, studies = fetched_data
     else:
         logging.info("Loading data from databases")
         vrtrack_db_details_list = get_vrtrack_db_details_list(global_config,
                                                          domain_config.databases)
         sequencescape_db_details = get_sequencescape_db_details(global_config)
+        ena = get_ena_details(global_config)
+        sequencescape_options = get_sequencescape_options(global_config)
+        connection_options = get_connection_options(global_config)
+        lane_snapshots = get_lane_snapshots(global_config)
         lane_details, ena_run_details, studies = get_all_data(vrtrack_db_details_list,
-                                                              sequencescape_db_details)
+                                                              sequencescape_db_details,
+                                                              ena, sequencescape_options,
+                                                              connection_options,
+                                                              lane_snapshots)
 
     if global_config.get('DATAPAGES_SAVE_CACHE_PATH'):
         cache_path = global_config.get('DATAPAGES_SAVE_CACHE_PATH')
         logging.warn("Saving data to cache in %s" % cache_path)
-        project_ssids = list({lane['project_ssid'] for lane in lane_details})
+        project_ssids = _unique_values(lane_details, 'project_ssid')
         data = {
             'project_ssids': project_ssids,
             'ena_run_details': ena_run_details,
@@ -234,6 +643,26 @@ def generate_data(global_config, domain_config):
         }
         cache_data(cache_path, domain_config.domain_name, data)
 
+    return lane_details, ena_run_details, studies
+
+def exported_rows(global_config, domain_config, fetched_data=None):
+    """Returns the rows which would be exported for the domain, before they
+    are split up by species"""
+    lane_details, ena_run_details, studies = fetch_source_data(global_config, domain_config,
+                                                               fetched_data)
+    return _exported_rows(merge_data(lane_details, ena_run_details, studies))
+
+def generate_data(global_config, domain_config, fetched_data=None, streaming=False):
+    """Returns a generator of the data for each species in the domain
+
+    fetched_data can be (lane_details, ena_run_details, studies) from
+    get_data_for_domains, otherwise they are fetched for this domain.
+    If streaming is set, the data is joined a few species at a time."""
+    lane_details, ena_run_details, studies = fetch_source_data(global_config, domain_config,
+                                                               fetched_data)
+    if streaming:
+        return stream_relevant_data(lane_details, ena_run_details, studies, domain_config)
+
     joint_data = merge_data(lane_details, ena_run_details, studies)
 
     relevant_data = build_relevant_data(joint_data, domain_config)
@@ -2,36 +2,130 @@ import logging
 import pymysql
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
+from .connections import ConnectionManager
+from .metrics import measure
+
 class Sfind(object):
-    def __init__(self, host, port, database, user):
+    def __init__(self, host, port, database, user, bulk=False, connections=1,
+                 connection_manager=None):
         self.logger = logging.getLogger(__name__)
-        self.logger.info("Connecting to sequencescape on %s:%s" % (host, port))
-        self.connection = pymysql.connect(
-            host=host,
-            port=port,
-            user=user,
-            db=database
-        )
+        self.host = host
+        self.port = port
+        self.user = user
+        self.owns_connection_manager = connection_manager is None
+        if connection_manager is None:
+            connection_manager = ConnectionManager(max_connections_per_host=connections)
+        self.connection_manager = connection_manager
         self.max_ssids = 20
         self.wait = 1
         self.database = database
+        # In bulk mode we try to look everything up in one query and
+        # otherwise resize batches to take about target_batch_seconds
+        self.bulk = bulk
+        self.connections = connections
+        self.max_bulk_ssids = 2000
+        self.target_batch_seconds = 2
+
+    def _connection(self):
+        return self.connection_manager.connection(self.host, self.port, self.user, self.database)
+
+    def close(self):
+        if self.owns_connection_manager:
+            self.connection_manager.close()
 
     def get_studies(self, project_ssids):
         self.logger.info("Getting sequencescape details from %s" %
                          self.database)
+        if self.bulk:
+            return self._get_studies_in_bulk(project_ssids)
         SIZE=self.max_ssids
         ssid_groups = (project_ssids[i:i+SIZE] for i in range(0,len(project_ssids),SIZE))
         ssid_group = next(ssid_groups, [])
-        studies = self._get_studies_for_group(ssid_group)
-        for ssid_group in ssid_groups:
-            time.sleep(self.wait)
-            studies += self._get_studies_for_group(ssid_group)
+        with self._connection() as connection:
+            studies = self._get_studies_for_group(ssid_group, connection)
+            for ssid_group in ssid_groups:
+                time.sleep(self.wait)
+                studies += self._get_studies_for_group(ssid_group, connection)
         return studies       
-    
-    def _get_studies_for_group(self, project_ssids):
+
+    def _get_studies_in_bulk(self, project_ssids):
+        try:
+            return self._get_studies_using_temporary_table(project_ssids)
+        except (pymysql.err.OperationalError, pymysql.err.ProgrammingError,
+                pymysql.err.InternalError) as e:
+            self.logger.warning("Could not use a temporary table in %s (%s), using batches instead" %
+                                (self.database, e))
+
+        if self.connections <= 1 or len(project_ssids) <= self.max_ssids:
+            return self._get_studies_in_adaptive_batches(project_ssids)
+
+        # Split the ssids into one contiguous slice per connection so that
+        # the results come back in the same order as a serial lookup.  Each
+        # slice borrows a connection from the pool
+        number_of_slices = min(self.connections, len(project_ssids))
+        SIZE = -(-len(project_ssids) // number_of_slices)
+        ssid_slices = [project_ssids[i:i+SIZE] for i in range(0, len(project_ssids), SIZE)]
+        with ThreadPoolExecutor(max_workers=len(ssid_slices)) as executor:
+            slice_results = executor.map(self._get_studies_in_adaptive_batches, ssid_slices)
+            studies = []
+            for slice_studies in slice_results:
+                studies += slice_studies
+        return studies
+
+    def _next_batch_size(self, size, duration):
+        if duration < self.target_batch_seconds / 2:
+            return min(size * 2, self.max_bulk_ssids)
+        elif duration > self.target_batch_seconds:
+            return max(size // 2, self.max_ssids)
+        return size
+
+    def _get_studies_in_adaptive_batches(self, project_ssids):
+        studies = []
+        size = self.max_ssids
+        i = 0
+        with self._connection() as connection:
+            while i < len(project_ssids):
+                ssid_group = project_ssids[i:i+size]
+                start = time.time()
+                studies += self._get_studies_for_group(ssid_group, connection)
+                size = self._next_batch_size(size, time.time() - start)
+                i += len(ssid_group)
+        return studies
+
+    def _get_studies_using_temporary_table(self, project_ssids):
         if not project_ssids:
             return []
-        query = """SELECT  study.internal_id as project_ssid,
+        SIZE=self.max_bulk_ssids
+        # The temporary table only exists on this connection so every query
+        # which uses it has to be made before it goes back to the pool
+        with self._connection() as connection, \
+                connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""CREATE TEMPORARY TABLE datapages_project_ssids
+                              (internal_id INT PRIMARY KEY)""")
+            try:
+                for i in range(0, len(project_ssids), SIZE):
+                    cursor.executemany("INSERT IGNORE INTO datapages_project_ssids VALUES (%s)",
+                                       project_ssids[i:i+SIZE])
+                query = self._studies_query(
+                    "study.internal_id IN (SELECT internal_id FROM datapages_project_ssids)")
+                with measure('sequencescape bulk query', database=self.database) as record:
+                    record.requests += 1
+                    cursor.execute(query)
+                    studies = list(cursor.fetchall())
+                    record.rows += len(studies)
+            finally:
+                cursor.execute("DROP TEMPORARY TABLE IF EXISTS datapages_project_ssids")
+        # Put the studies in the order they were asked for, as batches would
+        positions = {}
+        for position, project_ssid in enumerate(project_ssids):
+            positions.setdefault(project_ssid, position)
+        studies.sort(key=lambda study: positions.get(study['project_ssid'], len(positions)))
+        return studies
+
+    def _studies_query(self, study_condition):
+        return """SELECT  study.internal_id as project_ssid,
         study.accession_number as study_accession,
         study.study_title as study_title,
         study.name as study_name,
@@ -45,10 +139,18 @@ class Sfind(object):
 FROM    current_studies study,
         current_study_samples study_sample,
         current_samples sample
-WHERE   study.internal_id IN %s AND
+WHERE   %s AND
         study_sample.study_internal_id=study.internal_id AND
-        sample.internal_id=study_sample.sample_internal_id"""
-        with self.connection.cursor(pymysql.cursors.DictCursor) as cursor:
+        sample.internal_id=study_sample.sample_internal_id""" % study_condition
+
+    def _get_studies_for_group(self, project_ssids, connection):
+        if not project_ssids:
+            return []
+        query = self._studies_query("study.internal_id IN %s")
+        with measure('sequencescape batch', database=self.database) as record, \
+                connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            record.requests += 1
             cursor.execute(query, (project_ssids,))
             studies = cursor.fetchall()
+            record.rows += len(studies)
         return studies
@@ -0,0 +1,58 @@
+import collections
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .metrics import current_labels, measure
+
+Stage = collections.namedtuple('Stage', 'name, function, depends_on')
+logger = logging.getLogger(__name__)
+
+class StageGraph(object):
+    """Runs functions in threads as soon as the stages they depend on are done
+
+    Each stage's function is called with a dictionary of the results of the
+    stages it depends on.  run() returns a dictionary of every stage's result
+    and leaves the wall time each stage took in timings.  Stages are measured
+    with the metrics labels of the thread calling run()."""
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.stages = collections.OrderedDict()
+        self.timings = collections.OrderedDict()
+
+    def add(self, name, function, depends_on=()):
+        if name in self.stages:
+            raise ValueError("Stage %s has already been added" % name)
+        self.stages[name] = Stage(name, function, list(depends_on))
+
+    def _run_stage(self, stage, inputs, labels):
+        logger.info("Starting %s" % stage.name)
+        start = time.time()
+        with measure(stage.name, **labels):
+            result = stage.function(inputs)
+        duration = time.time() - start
+        logger.info("Finished %s in %.1fs" % (stage.name, duration))
+        return result, duration
+
+    def run(self):
+        results = {}
+        labels = current_labels()
+        pending = collections.OrderedDict(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [stage for stage in pending.values() if
+                         all(dependency in results for dependency in stage.depends_on)]
+                for stage in ready:
+                    del pending[stage.name]
+                    inputs = {dependency: results[dependency] for dependency in stage.depends_on}
+                    running[executor.submit(self._run_stage, stage, inputs, labels)] = stage.name
+                if not running:
+                    message = "Cannot run %s, check their dependencies" % ", ".join(pending)
+                    raise ValueError(message)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], self.timings[name] = future.result()
+        return results
@@ -0,0 +1,121 @@
+"""Synthetic vrtrack, sequencescape and ENA data for benchmarks
+
+The data has the same columns as the results of the queries in vrtrack.py,
+sequencescape.py and enametadata.py so that it can be passed to merge_data
+without access to our databases."""
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+EPITHETS = ['enterica', 'aureus', 'pneumoniae', 'coli', 'typhi', 'pyogenes',
+            'agalactiae', 'suis', 'difficile', 'tuberculosis', 'falciparum', 'mansoni']
+
+def _labels(prefix, numbers, width=0):
+    return (prefix + pd.Series(numbers).astype(str).str.zfill(width)).values
+
+def _with_missing(rng, values, rate):
+    values = values.astype(object)
+    values[rng.random(len(values)) < rate] = None
+    return values
+
+class SyntheticData(object):
+    """Generates lane_details, studies and ena_run_details
+
+    Lanes are spread over samples, samples over studies and studies over
+    species, with the number of studies per species following a power law
+    (species_skew=0 spreads them evenly).  Most species names start with one
+    of species_list; unknown_species_rate of them don't match any.
+
+    duplicate_rate is the fraction of sequencescape samples which appear
+    twice with different details, missing_rate the fraction of optional
+    details which are null.  withdrawn_rate and not_in_ena_rate control how
+    many lanes are left out of the exported data."""
+    def __init__(self, species_list, lanes_per_sample=2, samples_per_study=200,
+                 duplicate_rate=0.01, missing_rate=0.1, withdrawn_rate=0.02,
+                 not_in_ena_rate=0.05, unknown_species_rate=0.1, species_skew=1.0, seed=1):
+        self.species_list = list(species_list)
+        self.lanes_per_sample = lanes_per_sample
+        self.samples_per_study = samples_per_study
+        self.duplicate_rate = duplicate_rate
+        self.missing_rate = missing_rate
+        self.withdrawn_rate = withdrawn_rate
+        self.not_in_ena_rate = not_in_ena_rate
+        self.unknown_species_rate = unknown_species_rate
+        self.species_skew = species_skew
+        self.seed = seed
+
+    def _species_names(self, rng, number_of_studies):
+        known_names = []
+        for species in self.species_list:
+            known_names.append(species)
+            known_names += ["%s %s" % (species, epithet) for epithet in
+                            rng.choice(EPITHETS, size=2, replace=False)]
+        known_names = np.array(known_names, dtype=object)
+        weights = 1.0 / np.arange(1, len(known_names) + 1) ** self.species_skew
+        rng.shuffle(weights)
+        species_names = rng.choice(known_names, size=number_of_studies, p=weights / weights.sum())
+        unknown = rng.random(number_of_studies) < self.unknown_species_rate
+        species_names[unknown] = _labels('Unknownia sp. ', np.flatnonzero(unknown))
+        return species_names
+
+    def generate(self, number_of_lanes):
+        """Returns (lane_details, ena_run_details, studies) as DataFrames"""
+        logger.info("Generating synthetic data for %s lanes" % number_of_lanes)
+        rng = np.random.default_rng(self.seed)
+        number_of_samples = max(1, number_of_lanes // self.lanes_per_sample)
+        number_of_studies = max(1, number_of_samples // self.samples_per_study)
+
+        study_ids = np.arange(number_of_studies)
+        study_accessions = _labels('ERP', study_ids, 6)
+        study_species = self._species_names(rng, number_of_studies)
+        study_titles = _with_missing(rng, _labels('A study of project ', study_ids), self.missing_rate)
+        study_in_ena = rng.random(number_of_studies) >= self.not_in_ena_rate
+
+        sample_studies = rng.integers(number_of_studies, size=number_of_samples)
+        sample_names = _labels('sample_', np.arange(number_of_samples))
+        sample_accessions = _labels('ERS', np.arange(number_of_samples), 7)
+
+        lane_ids = np.arange(number_of_lanes)
+        lane_samples = rng.integers(number_of_samples, size=number_of_lanes)
+        lane_studies = sample_studies[lane_samples]
+        run_accessions = _labels('ERR', lane_ids, 7)
+        lane_details = pd.DataFrame({
+            'internal_project_name': _labels('project ', lane_studies),
+            'internal_sample_name': sample_names[lane_samples],
+            'lane_name': _labels('%s_1#' % self.seed, lane_ids),
+            'run_accession': run_accessions,
+            'withdrawn': (rng.random(number_of_lanes) < self.withdrawn_rate).astype(int),
+            'project_ssid': lane_studies,
+            'sample_accession': _with_missing(rng, sample_accessions[lane_samples], self.missing_rate),
+            'study_accession': study_accessions[lane_studies],
+            'species_name': study_species[lane_studies]
+        })
+
+        studies = pd.DataFrame({
+            'project_ssid': sample_studies,
+            'study_accession': study_accessions[sample_studies],
+            'study_title': study_titles[sample_studies],
+            'study_name': _labels('project_', sample_studies),
+            'sample_strain': _with_missing(rng, _labels('strain ', rng.integers(1000, size=number_of_samples)),
+                                           self.missing_rate),
+            'sample_public_name': _with_missing(rng, _labels('public_', np.arange(number_of_samples)),
+                                                self.missing_rate),
+            'sample_name': sample_names,
+            'sample_common_name': study_species[sample_studies],
+            'sample_organism': study_species[sample_studies],
+            'sample_supplier_name': _with_missing(rng, sample_names.copy(), self.missing_rate),
+            'sample_accession': _with_missing(rng, sample_accessions, self.missing_rate)
+        })
+        duplicates = studies[rng.random(number_of_samples) < self.duplicate_rate].copy()
+        duplicates['sample_strain'] = _labels('other strain ', np.arange(len(duplicates)))
+        studies = pd.concat([studies, duplicates], ignore_index=True)
+
+        in_ena = study_in_ena[lane_studies] & (rng.random(number_of_lanes) >= self.not_in_ena_rate)
+        ena_run_details = pd.DataFrame({
+            'study_accession': study_accessions[lane_studies[in_ena]],
+            'run_accession': run_accessions[in_ena]
+        })
+        return lane_details, ena_run_details, studies
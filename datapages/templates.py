@@ -0,0 +1,68 @@
+import logging
+import os
+
+from jinja2 import ChoiceLoader, DictLoader, Environment, FileSystemBytecodeCache, \
+                   FileSystemLoader
+
+logger = logging.getLogger(__name__)
+
+# Small templates rendered for each species rather than whole pages
+FRAGMENTS = {
+    'fragments/links.html': """\
+{% if links -%}
+<h4>Relevant Links</h4>
+<ul>
+  {%- for link in links %}
+  <li><a href="{{ link['url'] }}">{{ link['text'] }}</a></li>
+  {%- endfor %}
+</ul>
+{%- endif %}"""
+}
+
+def _templates_dir():
+    datapages_dir = os.path.dirname(os.path.realpath(__file__))
+    parent_dir = os.path.dirname(datapages_dir)
+    return os.path.join(parent_dir, 'templates')
+
+class TemplateService(object):
+    """One jinja environment for the page templates and fragments
+
+    The environment keeps every template it has compiled so each is only
+    compiled once per process; the bytecode cache means later processes
+    can usually skip compiling them altogether."""
+    def __init__(self, bytecode_cache_dir=None, templates_dir=None):
+        self.templates_dir = templates_dir or _templates_dir()
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+        else:
+            bytecode_cache = FileSystemBytecodeCache()
+        loader = ChoiceLoader([FileSystemLoader(self.templates_dir),
+                               DictLoader(FRAGMENTS)])
+        self.environment = Environment(loader=loader, bytecode_cache=bytecode_cache)
+
+    def get_template(self, filename):
+        return self.environment.get_template(filename)
+
+    def get_source(self, filename):
+        """The template's source, from templates_dir if it is overridden there"""
+        source, _, _ = self.environment.loader.get_source(self.environment, filename)
+        return source
+
+_template_service = None
+
+def configure_template_service(bytecode_cache_dir=None):
+    global _template_service
+    _template_service = TemplateService(bytecode_cache_dir)
+    return _template_service
+
+def get_template_service():
+    if _template_service is None:
+        configure_template_service()
+    return _template_service
+
+def get_template(filename):
+    return get_template_service().get_template(filename)
+
+def get_template_source(filename):
+    return get_template_service().get_source(filename)
@@ -8,12 +8,15 @@ import yaml
 
 from argparse import ArgumentTypeError, FileType
 
-from .common import cache_data, reload_cache_data, \
-                    _is_dir, _could_write, _could_read, \
-                    get_config
+from .cache import cache_data, reload_cache_data
+from .common import _is_dir, _could_write, _could_read, get_config, load_yaml
+from .templates import configure_template_service
 from .update_projects_html import get_template
 from .regenerate_data import get_vrtrack_db_details_list, get_sequencescape_db_details, \
-                             get_all_data, _get_default_columns
+                             get_sequencescape_options, get_connection_options, \
+                             get_lane_snapshots, \
+                             get_ena_details, get_all_data, \
+                             _get_default_columns, _unique_values
 
 logger = logging.getLogger('datapages')
 
@@ -253,7 +256,7 @@ def build_relevant_nctc_data(joint_data, nctc_config):
 
 class NctcConfig(object):
     def __init__(self, config_file):
-        self.data = yaml.load(config_file)
+        self.data = load_yaml(config_file)
         self.type = self.data['metadata']['type']
         if self.type != 'nctc':
             message = "Expected %s to contain nctc config, got %s; skipping" % (config_file.name, self.type)
@@ -277,7 +280,7 @@ def generate_nctc_data(global_config, nctc_config):
         cache = reload_cache_data(cache_path, nctc_config.nctc_name)
         project_ssids = data['project_ssids']
         ena_run_details = data['ena_run_details']
-        lane_details = data['lane_details']
+        lane_details = pd.DataFrame(data['lane_details'])
         studies = data['ss_studies']
         automatic_gffs = pd.Dataframe(data['automatic_gffs'])
         manual_embls = pd.Dataframe(data['manual_embls'])
@@ -288,14 +291,21 @@ def generate_nctc_data(global_config, nctc_config):
         vrtrack_db_details_list = get_vrtrack_db_details_list(global_config,
                                                          nctc_config.databases)
         sequencescape_db_details = get_sequencescape_db_details(global_config)
+        ena = get_ena_details(global_config)
+        sequencescape_options = get_sequencescape_options(global_config)
+        connection_options = get_connection_options(global_config)
+        lane_snapshots = get_lane_snapshots(global_config)
         lane_details, ena_run_details, studies = get_all_data(vrtrack_db_details_list,
-                                                              sequencescape_db_details)
+                                                              sequencescape_db_details,
+                                                              ena, sequencescape_options,
+                                                              connection_options,
+                                                              lane_snapshots)
         automatic_gffs, manual_embls, manual_gffs = file_mappings(nctc_config)
 
     if global_config.get('DATAPAGES_SAVE_CACHE_PATH'):
         cache_path = global_config.get('DATAPAGES_SAVE_CACHE_PATH')
         logging.warn("Saving data to cache in %s" % cache_path)
-        project_ssids = list({lane['project_ssid'] for lane in lane_details})
+        project_ssids = _unique_values(lane_details, 'project_ssid')
         data = {
             'project_ssids': project_ssids,
             'ena_run_details': ena_run_details,
@@ -382,6 +392,8 @@ def main():
     site_dir = config['DATAPAGES_SITE_DATA_DIR']
     logging.info("Preparing updates to %s" % site_dir)
 
+    configure_template_service(config.get('DATAPAGES_TEMPLATE_CACHE_DIR'))
+
     nctc_config = NctcConfig(args.nctc_config)
     logger.info("Processing %s" % args.nctc_config.name)
 
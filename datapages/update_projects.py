@@ -4,7 +4,7 @@ import os
 
 from argparse import ArgumentTypeError, FileType
 
-from .common import _is_dir, _could_write, _could_read
+from .common import _at_least_one, _is_dir, _could_write, _could_read
 
 logger = logging.getLogger('datapages')
 
@@ -20,8 +20,34 @@ def parse():
                         help="Cache database results to this file")
     parser.add_argument('--load-cache', type=_could_read,
                         help="Load cached database results from this file")
+    parser.add_argument('--full-refresh', action='store_true', default=False,
+                        help="Read every lane from vrtrack even if DATAPAGES_VRTRACK_SNAPSHOT_PATH is set, "
+                             "e.g. to pick up deleted lanes")
     parser.add_argument('--html-only', action='store_true', default=False,
                         help="Don't update data, just html")
+    parser.add_argument('--metadata-only', action='store_true', default=False,
+                        help="Don't update data, just html and the species metadata written with --split-metadata")
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help="Only rewrite data for species which have changed")
+    parser.add_argument('--releases', type=_at_least_one, metavar='N',
+                        help="Write data to a new release each run (implies --incremental), "
+                             "keeping the last N")
+    parser.add_argument('--compact', action='store_true', default=False,
+                        help="Write smaller, dictionary encoded data with gzip and brotli copies")
+    parser.add_argument('--shard-size', type=_at_least_one, metavar='ROWS',
+                        help="Split species with more than ROWS rows into files the page loads lazily")
+    parser.add_argument('--split-metadata', action='store_true', default=False,
+                        help="Write each species' description, links and publications to a file of their own")
+    parser.add_argument('--streaming', action='store_true', default=False,
+                        help="Join and write the data one species at a time to use less memory")
+    parser.add_argument('--workers', type=_at_least_one, metavar='N', default=1,
+                        help="Number of processes to write species data with (default: 1)")
+    parser.add_argument('--metrics', metavar='FILE', type=_could_write,
+                        help="Save how long each stage took to FILE (JSON, or a Prometheus textfile if it ends in .prom)")
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help="Keep running, rebuilding domains when their config or the templates change")
+    parser.add_argument('--poll-interval', type=float, metavar='SECONDS', default=2,
+                        help="How often --watch checks for changes (default: 2)")
     parser.add_argument('domain_config', type=FileType(mode='r'), nargs='+',
                         help="One or more domain config files (e.g. viruses.yml)")
 
@@ -43,10 +69,8 @@ def main():
     else:
         logger.setLevel(logging.INFO)
 
-    from .common import get_config, DomainConfig
-    from .write_data import write_domain_data_files
-    from .regenerate_data import generate_data, generate_empty_data
-    from .update_projects_html import write_domain_index
+    from .common import get_config
+    from .metrics import write_metrics
 
     if args.global_config:
         config_file = args.global_config
@@ -76,27 +100,97 @@ def main():
         default_site_directory = os.path.join(os.getcwd, 'site')
         config.setdefault('DATAPAGES_SITE_DATA_DIR', default_site_directory)
 
+    if args.full_refresh:
+        config['DATAPAGES_VRTRACK_FULL_REFRESH_HOURS'] = 0
+
+    if args.metrics:
+        config['DATAPAGES_METRICS_PATH'] = args.metrics
+    metrics_path = config.get('DATAPAGES_METRICS_PATH')
+
     site_dir = config['DATAPAGES_SITE_DATA_DIR']
     logging.info("Preparing updates to %s" % site_dir)
 
+    try:
+        if args.watch:
+            from .watch import watch_domains
+            watch_domains(args, config, site_dir, metrics_path)
+        else:
+            update_domains(args, config, site_dir)
+    finally:
+        if metrics_path:
+            write_metrics(metrics_path)
+
+def update_domains(args, config, site_dir):
+    # Modules which need pandas or database drivers are only imported when
+    # we update data, so --html-only starts quickly
+    from .common import DomainConfig
+    from .templates import configure_template_service
+    from .metrics import measure
+
+    configure_template_service(config.get('DATAPAGES_TEMPLATE_CACHE_DIR'))
+
+    domain_configs = []
     for domain_config_file in args.domain_config:
         try:
-            domain_config = DomainConfig(domain_config_file)
+            domain_config = DomainConfig(domain_config_file,
+                                         config.get('DATAPAGES_CONFIG_CACHE_DIR'))
         except ValueError as e:
             logger.error(e)
             continue
+        domain_configs.append((domain_config_file, domain_config))
+
+    # Domains often share vrtrack databases and studies so we get the data
+    # for all of them at once rather than asking each source once per domain
+    fetched_data = {}
+    domains_with_data = [domain_config for _, domain_config in domain_configs
+                         if domain_config.list_data]
+    if (domains_with_data and not args.html_only and not args.metadata_only and
+            not config.get('DATAPAGES_LOAD_CACHE_PATH')):
+        from .regenerate_data import get_data_for_domains
+        with measure('get_data_for_domains'):
+            fetched_data = get_data_for_domains(config, domains_with_data)
+
+    for domain_config_file, domain_config in domain_configs:
         logger.info("Processing %s from %s" % (domain_config.domain_name,
                                                domain_config_file.name))
-        if not args.html_only:
-          if domain_config.list_data:
-              data = generate_data(config, domain_config)
-          else:
-              data = generate_empty_data(domain_config)
-          write_domain_data_files(data, site_dir, domain_config.domain_name)
-        else:
-            logger.warning("Skipping data regeneration, you specified --html-only")
-        species_list = [species for species in domain_config.species_list if
-                        domain_config.is_visible(species)]
+        with measure('domain', domain=domain_config.domain_name):
+            update_domain(args, config, site_dir, domain_config,
+                          fetched_data.get(domain_config.domain_name))
+
+def update_domain(args, config, site_dir, domain_config, fetched_data):
+    from .update_projects_html import write_domain_index
+    from .metrics import measure, measure_each
+
+    species_list = [species for species in domain_config.species_list if
+                    domain_config.is_visible(species)]
+    if args.metadata_only:
+      from .write_data import write_domain_metadata_files
+      species_metadata = ((species, domain_config.species_metadata(species))
+                          for species in species_list)
+      with measure('write_domain_metadata_files'):
+          write_domain_metadata_files(species_metadata, site_dir, domain_config.domain_name)
+    elif not args.html_only:
+      from .write_data import write_domain_data_files
+      from .regenerate_data import generate_data, generate_empty_data
+      if domain_config.list_data:
+          with measure('generate_data'):
+              data = generate_data(config, domain_config, fetched_data,
+                                   streaming=args.streaming)
+          # Most of the joining and routing happens as each species is written
+          data = measure_each('generate_data', data)
+      else:
+          data = generate_empty_data(domain_config)
+      with measure('write_domain_data_files'):
+          write_domain_data_files(data, site_dir, domain_config.domain_name,
+                                  incremental=args.incremental,
+                                  keep_releases=args.releases,
+                                  compact=args.compact,
+                                  shard_size=args.shard_size,
+                                  workers=args.workers,
+                                  split_metadata=args.split_metadata)
+    else:
+        logger.warning("Skipping data regeneration, you specified --html-only")
+    with measure('write_domain_index'):
         write_domain_index(species_list, site_dir, domain_config)
 
 if __name__ == '__main__':
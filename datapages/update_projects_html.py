@@ -1,31 +1,40 @@
+import json
 import logging
 import os
 
-from jinja2 import Environment, FileSystemLoader
-
-from .common import species_filename, get_config, DomainConfig
+from .common import species_filename
+from .templates import get_template_service
 
 logger = logging.getLogger(__name__)
 
 def get_template(filename):
-    datapages_dir = os.path.dirname(os.path.realpath(__file__))
-    parent_dir = os.path.dirname(datapages_dir)
-    templates_dir = os.path.join(parent_dir, 'templates')
-    loader = FileSystemLoader(templates_dir)
-    env = Environment(loader=loader)
-    template = env.get_template(filename)
-    logger.info('Using %s template from %s' % (filename, templates_dir))
+    template_service = get_template_service()
+    template = template_service.get_template(filename)
+    logger.info('Using %s template from %s' % (filename, template_service.templates_dir))
     return template
 
+def _metadata_urls(output_dir, domain_name):
+    """Returns the URL of each species' metadata file, if it has one"""
+    summary_path = os.path.join(output_dir, domain_name, 'data', '_data_summary.json')
+    try:
+        with open(summary_path, 'r') as summary_file:
+            summary = json.load(summary_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {species: "data/%s" % entry['metadata'] for species, entry in
+            summary.get('species', {}).items() if 'metadata' in entry}
+
 def write_domain_index(species_list, output_dir, domain_config):
     domain_name = domain_config.domain_name
     def species_url(species):
         return "data/%s" % species_filename(species)
     species_urls = {species: species_url(species) for species in
                     species_list}
+    metadata_urls = _metadata_urls(output_dir, domain_name)
     index_path = os.path.join(output_dir, domain_name, 'index.html')
     content = get_template('index.html').render(
         species_urls=species_urls,
+        metadata_urls=metadata_urls,
         domain_title=domain_config.domain_title,
         domain_description=domain_config.render_domain_description()
     )
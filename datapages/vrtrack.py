@@ -1,20 +1,121 @@
+import collections
 import logging
+import pandas as pd
 import pymysql
+import sqlite3
+import time
+
+from .cache import CacheStore
+from .connections import ConnectionManager
+from .metrics import measure
+
+LANE_COLUMNS = ['internal_project_name', 'internal_sample_name', 'lane_name',
+                'run_accession', 'withdrawn', 'project_ssid', 'sample_accession',
+                'study_accession', 'species_name']
+
+# Changing a lane, library, sample or project adds a new version of its row
+# with a higher row_id, so rows past the highest row_id we have seen in each
+# of these tables are the ones which changed.  The condition is written in
+# terms of the tables in the lanes query.
+VERSIONED_TABLES = [('lane', 'latest_lane'), ('library', 'library'),
+                    ('sample', 'latest_sample'), ('project', 'latest_project')]
+
+# Individuals, studies and species are changed in place, so their rows are
+# compared with the ones seen last time instead.  Each is (table, id column,
+# the columns used in the lanes query).
+UNVERSIONED_TABLES = [('individual', 'individual_id', ['acc', 'species_id']),
+                      ('study', 'study_id', ['acc']),
+                      ('species', 'species_id', ['name'])]
+
+# Asking for the lanes of more changed rows than this takes longer than
+# reading every lane
+MAX_CHANGED_ROWS = 10000
+
+def merge_lane_changes(lanes, changed_lanes):
+    """Replaces the lanes which have changed and adds the new ones, keeping
+    the lanes in the same order as get_lanes_dataframe"""
+    unchanged_lanes = lanes[~lanes['lane_name'].isin(changed_lanes['lane_name'])]
+    merged = pd.concat([unchanged_lanes, changed_lanes], ignore_index=True)
+    return merged.sort_values('lane_name', kind='stable', ignore_index=True)
+
+def changed_row_ids(previous_rows, rows):
+    """Returns the ids of rows which are new or different, for each table"""
+    return {table: [row_id for row_id, values in table_rows.items()
+                    if previous_rows.get(table, {}).get(row_id) != values]
+            for table, table_rows in rows.items()}
+
+class LaneSnapshots(object):
+    """Keeps the lanes last found in each vrtrack database, with the highest
+    row_id of each of its versioned tables and the rows of its unversioned
+    ones, in a CacheStore
+
+    A snapshot older than full_refresh_seconds isn't used, so everything is
+    read again every so often in case of changes we can't see, like deleted
+    lanes."""
+    def __init__(self, path, full_refresh_seconds=7*24*60*60):
+        self.path = path
+        self.full_refresh_seconds = full_refresh_seconds
+
+    def _name(self, host, port, database):
+        return "vrtrack %s:%s/%s" % (host, port, database)
+
+    def load(self, host, port, database):
+        """Returns (lanes, high_water_marks, unversioned_rows, refreshed) or
+        None if there isn't a snapshot recent enough to use"""
+        try:
+            store = CacheStore(self.path)
+        except sqlite3.DatabaseError:
+            raise ValueError("%s isn't a cache store" % self.path)
+        try:
+            name = self._name(host, port, database)
+            # Snapshots saved before unversioned rows were kept aren't used
+            if 'unversioned_rows' not in store.sources(name):
+                return None
+            refreshed = store.load(name, 'refreshed')
+            if time.time() - refreshed > self.full_refresh_seconds:
+                return None
+            return (store.load(name, 'lanes'), store.load(name, 'high_water_marks'),
+                    store.load(name, 'unversioned_rows'), refreshed)
+        finally:
+            store.close()
+
+    def save(self, host, port, database, lanes, high_water_marks, unversioned_rows, refreshed):
+        store = CacheStore(self.path)
+        try:
+            store.save(self._name(host, port, database), {
+                'lanes': lanes,
+                'high_water_marks': high_water_marks,
+                'unversioned_rows': unversioned_rows,
+                'refreshed': refreshed
+            })
+        finally:
+            store.close()
 
 class Vrtrack(object):
-    def __init__(self, host, port, database, user):
+    """Reads lanes from a vrtrack database
+
+    Pass a ConnectionManager to share connections with other databases on
+    the same host; otherwise Vrtrack keeps its own until close() is called"""
+    def __init__(self, host, port, database, user, connection_manager=None):
         self.logger = logging.getLogger(__name__)
-        self.logger.info("Connecting to vrtrack on %s:%s" % (host, port))
-        self.connection = pymysql.connect(
-            host=host,
-            port=port,
-            user=user,
-            db=database
-        )
+        self.host = host
+        self.port = port
+        self.user = user
         self.database = database
+        self.owns_connection_manager = connection_manager is None
+        if connection_manager is None:
+            connection_manager = ConnectionManager(max_connections_per_host=1)
+        self.connection_manager = connection_manager
+        self.chunk_size = 10000
 
-    def get_lanes(self):
-        self.logger.info("Getting vrtrack details from %s" % self.database)
+    def _connection(self):
+        return self.connection_manager.connection(self.host, self.port, self.user, self.database)
+
+    def close(self):
+        if self.owns_connection_manager:
+            self.connection_manager.close()
+
+    def _lanes_query(self, condition=None):
         query = """SELECT DISTINCT latest_project.name as internal_project_name,
                 latest_sample.name as internal_sample_name,
                 latest_lane.name as lane_name,
@@ -37,8 +138,133 @@ WHERE           latest_lane.library_id = library.library_id AND
                 latest_sample.project_id = latest_project.project_id AND
                 species.species_id = individual.species_id AND
                 study.study_id = latest_project.study_id"""
-        with self.connection.cursor(pymysql.cursors.DictCursor) as cursor:
+        if condition:
+            query += " AND (%s)" % condition
+        return query
+
+    def get_lanes(self):
+        self.logger.info("Getting vrtrack details from %s" % self.database)
+        query = self._lanes_query()
+        with self._connection() as connection, \
+                connection.cursor(pymysql.cursors.DictCursor) as cursor:
             cursor.execute(query)
             lane_details = cursor.fetchall()
 
         return lane_details
+
+    def _lane_rows(self, condition=None, parameters=None):
+        """Yields the column names then lists of at most chunk_size rows
+
+        Rows are streamed from the server as tuples rather than being
+        buffered on the client as one dict per lane"""
+        self.logger.info("Streaming vrtrack details from %s" % self.database)
+        query = self._lanes_query(condition)
+        with self._connection() as connection, \
+                connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(query, parameters)
+            yield [description[0] for description in cursor.description]
+            while True:
+                rows = cursor.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def get_lane_chunks(self, condition=None, parameters=None):
+        """Yields DataFrames of at most chunk_size lanes"""
+        lane_rows = self._lane_rows(condition, parameters)
+        columns = next(lane_rows)
+        for rows in lane_rows:
+            yield pd.DataFrame.from_records(rows, columns=columns)
+
+    def get_lanes_dataframe(self, condition=None, parameters=None, stage='vrtrack query'):
+        """Reads the lanes into one DataFrame, sorted by lane name
+
+        Each chunk of rows is split into a Series per column as it arrives.
+        The columns are then put together and sorted, and their pieces
+        dropped, one at a time so that only one column is held twice rather
+        than every lane.  The server returns rows in whatever order its plan
+        happens to produce, so sorting them means lanes merged into a
+        snapshot end up in the same order as when every lane is read."""
+        with measure(stage, database=self.database) as record:
+            record.requests += 1
+            lane_rows = self._lane_rows(condition, parameters)
+            columns = next(lane_rows)
+            column_chunks = collections.OrderedDict((column, []) for column in columns)
+            for rows in lane_rows:
+                for column, values in zip(columns, zip(*rows)):
+                    column_chunks[column].append(pd.Series(values))
+                record.rows += len(rows)
+                del(rows)
+        if not record.rows:
+            return pd.DataFrame(columns=LANE_COLUMNS)
+        lane_names = pd.concat(column_chunks['lane_name'], ignore_index=True)
+        order = lane_names.argsort(kind='stable').to_numpy()
+        del(lane_names)
+        lane_details = pd.DataFrame(index=pd.RangeIndex(record.rows))
+        for column in list(column_chunks):
+            values = pd.concat(column_chunks.pop(column), ignore_index=True)
+            lane_details[column] = values.take(order).reset_index(drop=True)
+        self.logger.info("Found %s lanes in %s" % (len(lane_details.index), self.database))
+        return lane_details
+
+    def get_high_water_marks(self):
+        """Returns the highest row_id in each versioned table"""
+        query = "SELECT %s" % ", ".join("(SELECT COALESCE(MAX(row_id), 0) FROM %s)" % table
+                                        for table, _ in VERSIONED_TABLES)
+        with self._connection() as connection, connection.cursor() as cursor:
+            cursor.execute(query)
+            row = cursor.fetchone()
+        return {table: int(row_id) for (table, _), row_id in zip(VERSIONED_TABLES, row)}
+
+    def get_unversioned_rows(self):
+        """Returns {table: {id: values}} for each unversioned table"""
+        unversioned_rows = {}
+        with self._connection() as connection, connection.cursor() as cursor:
+            for table, id_column, columns in UNVERSIONED_TABLES:
+                cursor.execute("SELECT %s, %s FROM %s" % (id_column, ", ".join(columns), table))
+                unversioned_rows[table] = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+        return unversioned_rows
+
+    def get_changed_lanes(self, high_water_marks, changed_ids=None):
+        """Returns the lanes which have changed since the high water marks,
+        or which use one of the changed_ids ({table: [id, ...]}) of an
+        unversioned table"""
+        conditions = ["%s.row_id > %%s" % alias for _, alias in VERSIONED_TABLES]
+        parameters = [high_water_marks.get(table, 0) for table, _ in VERSIONED_TABLES]
+        for table, id_column, _ in UNVERSIONED_TABLES:
+            ids = (changed_ids or {}).get(table)
+            if ids:
+                conditions.append("%s.%s IN (%s)" % (table, id_column, ", ".join(["%s"] * len(ids))))
+                parameters.extend(ids)
+        return self.get_lanes_dataframe(" OR ".join(conditions), parameters,
+                                        stage='vrtrack changes query')
+
+    def get_lanes_incrementally(self, snapshots):
+        """Returns the same lanes as get_lanes_dataframe, only reading the
+        lanes which changed since the last snapshot if there is one"""
+        # The marks and unversioned rows are read first so that anything which
+        # changes while we read the lanes is read again next time
+        high_water_marks = self.get_high_water_marks()
+        unversioned_rows = self.get_unversioned_rows()
+        snapshot = snapshots.load(self.host, self.port, self.database)
+        changed_ids = None
+        if snapshot is not None:
+            previous_lanes, previous_marks, previous_rows, refreshed = snapshot
+            changed_ids = changed_row_ids(previous_rows, unversioned_rows)
+            changed_rows = sum(len(ids) for ids in changed_ids.values())
+            if changed_rows > MAX_CHANGED_ROWS:
+                self.logger.info("%s individuals, studies or species have changed in %s" %
+                                 (changed_rows, self.database))
+                snapshot = None
+        if snapshot is None:
+            self.logger.info("Reading every lane in %s" % self.database)
+            lanes = self.get_lanes_dataframe()
+            refreshed = time.time()
+        else:
+            changed_lanes = self.get_changed_lanes(previous_marks, changed_ids)
+            self.logger.info("%s lanes have changed in %s since the last run" %
+                             (len(changed_lanes.index), self.database))
+            lanes = merge_lane_changes(previous_lanes, changed_lanes)
+        snapshots.save(self.host, self.port, self.database, lanes, high_water_marks,
+                       unversioned_rows, refreshed)
+        return lanes
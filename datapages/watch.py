@@ -0,0 +1,244 @@
+"""Keeps a site up to date while its domain configs and templates are edited
+
+Every domain is built once and the rows exported for it, its parsed config
+and which rows went to each species are kept in memory.  The config files
+and templates are then checked every few seconds.  When a domain's config
+changes only that domain is rebuilt: its rows are routed to species again
+and only species whose config or rows changed are written, the rest are
+linked from the previous data.  Data is only fetched again if the domain's
+databases change.  A changed template rewrites every index page.
+
+Changes to the global config need a restart."""
+import logging
+import os
+import time
+
+import numpy as np
+
+from datetime import datetime
+
+from .common import DomainConfig
+from .metrics import measure, measure_each, write_metrics
+from .templates import configure_template_service
+from .update_projects_html import write_domain_index
+
+logger = logging.getLogger(__name__)
+
+class WatchedFiles(object):
+    """Tells you which of some files have changed since it last looked"""
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.signatures = {path: self._signature(path) for path in self.paths}
+
+    def _signature(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def changed(self):
+        changed = []
+        for path in self.paths:
+            signature = self._signature(path)
+            if signature != self.signatures[path]:
+                self.signatures[path] = signature
+                changed.append(path)
+        return changed
+
+class DomainBuild(object):
+    """What was last built for a domain
+
+    exported is None for domains which don't list data (or with
+    --html-only), otherwise the domain's rows before they are split up by
+    species; species_rows are the positions of each species' rows."""
+    def __init__(self, domain_config):
+        self.domain_config = domain_config
+        self.exported = None
+        self.species_rows = {}
+
+def _same_sources(previous_config, domain_config):
+    return (previous_config.domain_name == domain_config.domain_name and
+            previous_config.list_data == domain_config.list_data and
+            previous_config.databases == domain_config.databases)
+
+def _visible_species(domain_config):
+    return [species for species in domain_config.species_list if
+            domain_config.is_visible(species)]
+
+class Watcher(object):
+    def __init__(self, args, config, site_dir, metrics_path=None):
+        self.args = args
+        self.config = config
+        self.site_dir = site_dir
+        self.metrics_path = metrics_path
+        self.config_cache_dir = config.get('DATAPAGES_CONFIG_CACHE_DIR')
+        self.config_paths = [domain_config_file.name for domain_config_file in args.domain_config]
+        self.builds = {}
+        template_service = configure_template_service(config.get('DATAPAGES_TEMPLATE_CACHE_DIR'))
+        templates_dir = template_service.templates_dir
+        self.config_files = WatchedFiles(self.config_paths)
+        self.template_files = WatchedFiles(os.path.join(templates_dir, filename)
+                                           for filename in sorted(os.listdir(templates_dir)))
+
+    def _load_config(self, path):
+        with open(path, 'r') as config_file:
+            return DomainConfig(config_file, self.config_cache_dir)
+
+    def build_all(self):
+        domain_configs = []
+        for path in self.config_paths:
+            try:
+                domain_configs.append((path, self._load_config(path)))
+            except ValueError as e:
+                logger.error(e)
+
+        fetched_data = {}
+        domains_with_data = [domain_config for _, domain_config in domain_configs
+                             if domain_config.list_data]
+        if (domains_with_data and not self.args.html_only and not self.args.metadata_only and
+                not self.config.get('DATAPAGES_LOAD_CACHE_PATH')):
+            from .regenerate_data import get_data_for_domains
+            with measure('get_data_for_domains'):
+                fetched_data = get_data_for_domains(self.config, domains_with_data)
+
+        for path, domain_config in domain_configs:
+            logger.info("Processing %s from %s" % (domain_config.domain_name, path))
+            with measure('domain', domain=domain_config.domain_name):
+                self.builds[path] = self._build_domain(domain_config,
+                                                       fetched_data=fetched_data.get(domain_config.domain_name))
+        self._write_metrics()
+
+    def _build_domain(self, domain_config, previous=None, fetched_data=None):
+        build = DomainBuild(domain_config)
+        if self.args.metadata_only:
+            from .write_data import write_domain_metadata_files
+            species_metadata = ((species, domain_config.species_metadata(species))
+                                for species in _visible_species(domain_config))
+            with measure('write_domain_metadata_files'):
+                write_domain_metadata_files(species_metadata, self.site_dir, domain_config.domain_name)
+        elif not self.args.html_only:
+            if domain_config.list_data:
+                if (previous is not None and previous.exported is not None and
+                        _same_sources(previous.domain_config, domain_config)):
+                    build.exported = previous.exported
+                else:
+                    from .regenerate_data import exported_rows
+                    with measure('generate_data'):
+                        build.exported = exported_rows(self.config, domain_config, fetched_data)
+            with measure('write_domain_data_files'):
+                self._write_data(build, previous)
+        with measure('write_domain_index'):
+            write_domain_index(_visible_species(domain_config), self.site_dir, domain_config)
+        return build
+
+    def _changed_species(self, previous, build):
+        """Returns the species which need writing again, or None for all of them"""
+        if previous is None or previous.exported is not build.exported:
+            return None
+        previous_config, domain_config = previous.domain_config, build.domain_config
+        changed = set()
+        for species in _visible_species(domain_config):
+            if (species not in previous.species_rows or
+                    previous_config.data['species'].get(species) != domain_config.data['species'].get(species) or
+                    not np.array_equal(previous.species_rows[species], build.species_rows[species])):
+                changed.add(species)
+        if not self._previous_files_exist(domain_config.domain_name,
+                                          set(_visible_species(domain_config)) - changed):
+            logger.warning("Some of the data for %s has gone, writing all of it again" %
+                           domain_config.domain_name)
+            return None
+        return changed
+
+    def _previous_files_exist(self, domain_name, species_list):
+        from .write_data import _load_summary
+        data_dir = os.path.join(self.site_dir, domain_name, 'data')
+        previous_species = _load_summary(data_dir)['species']
+        return all(species in previous_species and
+                   os.path.isfile(os.path.join(data_dir, previous_species[species]['filename']))
+                   for species in species_list)
+
+    def _relevant_data(self, build, changed):
+        from .regenerate_data import _species_data
+        now = datetime.now()
+        domain_config = build.domain_config
+        for species in _visible_species(domain_config):
+            if changed is not None and species not in changed:
+                yield (species, None)
+                continue
+            rows = build.exported.iloc[build.species_rows[species]].values.tolist()
+            yield (species, _species_data(species, rows, domain_config, now))
+
+    def _write_data(self, build, previous):
+        from .regenerate_data import generate_empty_data, route_species_rows
+        from .write_data import write_domain_data_files
+        domain_config = build.domain_config
+        workers = self.args.workers
+        if build.exported is None:
+            data = generate_empty_data(domain_config)
+        else:
+            build.species_rows = route_species_rows(build.exported, domain_config)
+            changed = self._changed_species(previous, build)
+            if changed is not None:
+                logger.info("Writing %s of %s species in %s" %
+                            (len(changed), len(build.species_rows), domain_config.domain_name))
+                # A few species are quicker to write than starting worker processes
+                workers = 1
+            data = measure_each('generate_data', self._relevant_data(build, changed))
+        write_domain_data_files(data, self.site_dir, domain_config.domain_name,
+                                incremental=self.args.incremental or previous is not None,
+                                keep_releases=self.args.releases,
+                                compact=self.args.compact,
+                                shard_size=self.args.shard_size,
+                                workers=workers,
+                                split_metadata=self.args.split_metadata)
+
+    def _write_metrics(self):
+        if self.metrics_path:
+            write_metrics(self.metrics_path)
+
+    def poll(self):
+        """Rebuilds whatever has changed since the last poll"""
+        changed_configs = self.config_files.changed()
+        changed_templates = self.template_files.changed()
+        for path in changed_configs:
+            logger.info("%s has changed, rebuilding its domain" % path)
+            start = time.time()
+            try:
+                domain_config = self._load_config(path)
+                with measure('domain', domain=domain_config.domain_name):
+                    self.builds[path] = self._build_domain(domain_config, self.builds.get(path))
+            except Exception:
+                logger.exception("Could not rebuild the domain in %s, keeping what was there" % path)
+                continue
+            logger.info("Rebuilt %s in %.1fs" % (domain_config.domain_name, time.time() - start))
+        if changed_templates:
+            logger.info("Templates have changed, rewriting the index pages")
+            for build in self.builds.values():
+                try:
+                    with measure('write_domain_index', domain=build.domain_config.domain_name):
+                        write_domain_index(_visible_species(build.domain_config), self.site_dir,
+                                           build.domain_config)
+                except Exception:
+                    logger.exception("Could not rewrite the index page for %s" %
+                                     build.domain_config.domain_name)
+        if changed_configs or changed_templates:
+            self._write_metrics()
+
+    def watch(self, interval):
+        logger.info("Watching %s domain configs and %s templates for changes" %
+                    (len(self.config_files.paths), len(self.template_files.paths)))
+        while True:
+            time.sleep(interval)
+            self.poll()
+
+def watch_domains(args, config, site_dir, metrics_path=None):
+    """Builds every domain then rebuilds them as their configs change, until interrupted"""
+    if args.streaming:
+        logger.warning("Ignoring --streaming, --watch keeps every domain's data in memory")
+    watcher = Watcher(args, config, site_dir, metrics_path)
+    watcher.build_all()
+    try:
+        watcher.watch(args.poll_interval)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
@@ -1,15 +1,32 @@
+import collections
+import gzip
+import hashlib
 import json
 import logging
-import markdown
 import os
 import shutil
 import sys
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-from .common import species_filename
+from .common import species_filename, species_metadata_filename
+from .metrics import measure
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
+COMPRESSED_SUFFIXES = ['.gz', '.br']
+# Kept in a file of their own with split_metadata
+METADATA_KEYS = ['description', 'published_data_description', 'pubmed_ids', 'links']
 
 def _make_temp_dir(data_dir_temp):
     os.makedirs(data_dir_temp, mode=0o755)
@@ -28,37 +45,380 @@ def _backup(output_dir_root, output_dir_backup):
 
 def _update_data(output_dir_temp, data_dir_temp, data_dir):
     try:
-        shutil.rmtree(data_dir)
+        if os.path.islink(data_dir):
+            # Left over from writing releases
+            os.remove(data_dir)
+        else:
+            shutil.rmtree(data_dir)
     except FileNotFoundError:
         pass
     shutil.move(data_dir_temp, data_dir)
     shutil.rmtree(output_dir_temp)
 
-def _write_species_to_folder(data_dir_temp, species, data):
+def _dictionary_encode(data):
+    """Stores rows column by column, replacing values in columns with
+    lots of repeats (e.g. Species, Study Name) by their index in a list
+    of distinct values.  datapages.js decodes this back into rows."""
+    rows = data['data']
+    encoded_columns = []
+    for index, column in enumerate(data['columns']):
+        # NaN isn't equal to itself, or valid JSON, so missing values are
+        # stored as null and share one code
+        values = [None if row[index] != row[index] else row[index] for row in rows]
+        distinct_values = {}
+        codes = [distinct_values.setdefault(value, len(distinct_values)) for value in values]
+        if len(distinct_values) * 2 <= len(values):
+            encoded_columns.append({'dictionary': list(distinct_values), 'codes': codes})
+        else:
+            encoded_columns.append({'values': values})
+    encoded = {key: value for key, value in data.items() if key != 'data'}
+    encoded['format'] = 'columnar'
+    encoded['encoded_data'] = encoded_columns
+    return encoded
+
+def _write_compressed_copies(output_filepath, content):
+    """Writes .gz (and .br if brotli is installed) copies for the web
+    server to send to browsers which accept them"""
+    with open(output_filepath + '.gz', 'wb') as output_file:
+        output_file.write(gzip.compress(content, compresslevel=9))
+    if brotli is not None:
+        with open(output_filepath + '.br', 'wb') as output_file:
+            output_file.write(brotli.compress(content))
+
+def _encode_json(data):
+    if orjson is not None:
+        # Several times faster and writes NaN as null, like JSON.parse expects
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+def _write_json(output_filepath, data, compact=False):
+    if compact:
+        content = _encode_json(data)
+        with open(output_filepath, 'wb') as output_file:
+            output_file.write(content)
+        _write_compressed_copies(output_filepath, content)
+    elif orjson is not None:
+        with open(output_filepath, 'wb') as output_file:
+            output_file.write(_encode_json(data))
+    else:
+        with open(output_filepath, 'w') as output_file:
+            json.dump(data, output_file)
+
+def _replace_json(output_filepath, data, compact=False):
+    """Writes the file and its compressed copies then renames them over the
+    old ones, so that copies hard linked into other releases are unchanged"""
+    temp_filepath = "%s.%s.tmp" % (output_filepath, os.getpid())
+    _write_json(temp_filepath, data, compact)
+    for suffix in [''] + COMPRESSED_SUFFIXES:
+        if os.path.exists(temp_filepath + suffix):
+            os.replace(temp_filepath + suffix, output_filepath + suffix)
+
+def _split_metadata(species, data):
+    """Returns (rows, metadata), the species' data without the details from
+    its config and those details on their own"""
+    rows = {key: value for key, value in data.items() if key not in METADATA_KEYS}
+    metadata = {key: data[key] for key in METADATA_KEYS}
+    metadata['species'] = species
+    return rows, metadata
+
+def _shard_filename(output_filename, shard_number):
+    base, extension = os.path.splitext(output_filename)
+    return "%s.shard%s%s" % (base, shard_number, extension)
+
+def _shard(output_filename, data, shard_size):
+    """Splits a species into a manifest with the first shard_size rows
+    and files with the rest of the rows
+
+    Rows are grouped by project so that the manifest can list the
+    offset and number of rows for each one.  Returns a list of
+    (filename, data) with the manifest first."""
+    project_index = data['columns'].index('Study Name')
+    rows = sorted(data['data'], key=lambda row: str(row[project_index]))
+    projects = collections.OrderedDict()
+    for offset, row in enumerate(rows):
+        project = projects.setdefault(row[project_index], {'offset': offset, 'count': 0})
+        project['count'] += 1
+    shards = []
+    for shard_number, offset in enumerate(range(shard_size, len(rows), shard_size), 1):
+        shard_rows = rows[offset:offset+shard_size]
+        shards.append((_shard_filename(output_filename, shard_number),
+                       {'columns': data['columns'], 'count': len(shard_rows),
+                        'offset': offset, 'data': shard_rows}))
+    manifest = dict(data)
+    manifest['data'] = rows[:shard_size]
+    manifest['projects'] = projects
+    manifest['shards'] = [{'filename': filename, 'count': shard['count'], 'offset': shard['offset']}
+                          for filename, shard in shards]
+    return [(output_filename, manifest)] + shards
+
+def _species_files(species, data, shard_size=None, compact=False):
     output_filename = species_filename(species)
-    output_filepath = os.path.join(data_dir_temp, output_filename)
-    with open(output_filepath, 'w') as output_file:
-        json.dump(data, output_file)
-    return output_filename
+    if shard_size and data['count'] > shard_size:
+        files = _shard(output_filename, data, shard_size)
+    else:
+        files = [(output_filename, data)]
+    if compact:
+        files = [(filename, _dictionary_encode(file_data)) for filename, file_data in files]
+    return files
+
+def _payload_hash(data):
+    # The updated timestamp changes every run even if the data doesn't
+    payload = {key: value for key, value in data.items() if key != 'updated'}
+    if orjson is not None:
+        content = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    else:
+        content = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+def _files_hash(files):
+    if len(files) == 1:
+        _, data = files[0]
+        return _payload_hash(data)
+    content = "\n".join("%s %s" % (filename, _payload_hash(data)) for filename, data in files)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def _load_summary(data_dir):
+    summary_path = os.path.join(data_dir, '_data_summary.json')
+    try:
+        with open(summary_path, 'r') as summary_file:
+            return json.load(summary_file)
+    except (FileNotFoundError, ValueError):
+        return {'species': {}}
+
+def _link_or_copy(previous_filepath, output_filepath):
+    try:
+        os.link(previous_filepath, output_filepath)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        shutil.copy2(previous_filepath, output_filepath)
+    return True
+
+def _reuse_species_files(data_dir, data_dir_temp, filenames):
+    # Check first so that we never write over files linked to the previous data
+    if not all(os.path.isfile(os.path.join(data_dir, filename)) for filename in filenames):
+        return False
+    for filename in filenames:
+        for suffix in [''] + COMPRESSED_SUFFIXES:
+            _link_or_copy(os.path.join(data_dir, filename + suffix),
+                          os.path.join(data_dir_temp, filename + suffix))
+    return True
+
+def _previous_filenames(previous):
+    filenames = [previous['filename']] + previous.get('shards', [])
+    if 'metadata' in previous:
+        filenames.append(previous['metadata'])
+    return filenames
+
+def _write_species(species, data, data_dir_temp, previous_data_dir, previous, compact,
+                   shard_size, split_metadata=False, incremental=True):
+    """Writes, or links, one species' files and returns its entry in the
+    summary and whether the previous files were reused
+
+    This is run in a worker process if there is more than one.  If data
+    is None the species is known not to have changed, so its previous
+    files are reused without being checked.
+
+    With split_metadata the details from the species' config are written
+    to a metadata file of their own, so they don't change the rows' hash.
 
-def write_domain_data_files(relevant_data, output_dir_root, domain_name):
+    Hashing the data takes longer than writing it, so it is only hashed
+    (and the hash recorded for the next run) when writing incrementally."""
+    if data is None:
+        if not (previous and _reuse_species_files(previous_data_dir, data_dir_temp,
+                                                  _previous_filenames(previous))):
+            raise ValueError("Cannot reuse the previous data for %s, it needs writing again" % species)
+        return species, previous, True
+    if split_metadata:
+        data, metadata = _split_metadata(species, data)
+    files = _species_files(species, data, shard_size, compact)
+    filenames = [filename for filename, _ in files]
+    payload_hash = _files_hash(files) if incremental else None
+    if (previous and payload_hash is not None and previous.get('hash') == payload_hash and
+            _reuse_species_files(previous_data_dir, data_dir_temp,
+                                 [previous['filename']] + previous.get('shards', []))):
+        reused = True
+    else:
+        for filename, file_data in files:
+            _write_json(os.path.join(data_dir_temp, filename), file_data, compact)
+        reused = False
+    entry = {'filename': filenames[0],
+             'count': data['count']}
+    if payload_hash is not None:
+        entry['hash'] = payload_hash
+    if len(filenames) > 1:
+        entry['shards'] = filenames[1:]
+    if split_metadata:
+        entry['metadata'] = species_metadata_filename(species)
+        _write_json(os.path.join(data_dir_temp, entry['metadata']), metadata, compact)
+    return species, entry, reused
+
+def _map_in_order(executor, function, arguments, max_pending):
+    """Like executor.map but only takes max_pending arguments at a time
+    from the iterable, so that we don't hold every species in memory"""
+    pending = collections.deque()
+    for function_arguments in arguments:
+        pending.append(executor.submit(function, *function_arguments))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def _write_species_files(relevant_data, data_dir_temp, previous_data_dir, incremental,
+                         domain_name, compact=False, shard_size=None, workers=1,
+                         split_metadata=False):
     now = datetime.now()
     summary = {'species': {},
                'created': now.isoformat()}
-    timestamp = now.strftime("%Y%m%d%H%M%S")
+    previous_species = _load_summary(previous_data_dir)['species'] if incremental else {}
+    reused = 0
+    if compact and brotli is None:
+        logger.warning("Install brotli to also write .br copies of the data")
+    arguments = ((species, data, data_dir_temp, previous_data_dir, previous_species.get(species),
+                  compact, shard_size, split_metadata, incremental) for species, data in relevant_data)
+    with measure('write species files') as record:
+        if workers > 1:
+            # Encoding JSON is CPU bound so it is spread across processes;
+            # results come back in the order of the species so the summary
+            # is the same whatever the number of workers
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = _map_in_order(executor, _write_species, arguments, workers * 2)
+        else:
+            executor = None
+            results = (_write_species(*species_arguments) for species_arguments in arguments)
+        try:
+            for species, entry, species_reused in results:
+                summary['species'][species] = entry
+                reused += species_reused
+                record.rows += entry['count']
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    if incremental:
+        logger.info("Data for %s of %s species in %s was unchanged" %
+                    (reused, len(summary['species']), domain_name))
+    summary_path = os.path.join(data_dir_temp, '_data_summary.json')
+    with open(summary_path, 'w') as summary_file:
+        json.dump(summary, summary_file)
+
+def _make_release_dir(releases_dir, timestamp):
+    release_dir = os.path.join(releases_dir, timestamp)
+    suffix = 1
+    while os.path.exists(release_dir):
+        release_dir = os.path.join(releases_dir, "%s_%s" % (timestamp, suffix))
+        suffix += 1
+    os.makedirs(release_dir, mode=0o755)
+    return release_dir
+
+def _switch_release(data_dir, release_dir, timestamp):
+    if os.path.isdir(data_dir) and not os.path.islink(data_dir):
+        # The first release replaces a plain data folder; keep it as a release
+        # so that it can be linked from and rolled back to
+        releases_dir = os.path.dirname(release_dir)
+        shutil.move(data_dir, os.path.join(releases_dir, "%s_previous" % timestamp))
+    link_temp = "%s_%s_link" % (data_dir, timestamp)
+    os.symlink(os.path.relpath(release_dir, os.path.dirname(data_dir)), link_temp)
+    # Renaming over the old link is atomic so readers see one release or the other
+    os.replace(link_temp, data_dir)
+
+def _remove_old_releases(releases_dir, data_dir, keep_releases):
+    current_release = os.path.realpath(data_dir)
+    release_dirs = [os.path.join(releases_dir, release) for release in os.listdir(releases_dir)]
+    # Releases aren't modified once written so this puts them in the order they were made
+    release_dirs.sort(key=lambda release_dir: (os.path.getmtime(release_dir), release_dir))
+    for release_dir in release_dirs[:-keep_releases]:
+        if os.path.realpath(release_dir) != current_release:
+            logger.info("Removing old release %s" % release_dir)
+            shutil.rmtree(release_dir)
+
+def _write_domain_release(relevant_data, output_dir_root, domain_name, keep_releases,
+                          compact, shard_size, workers, split_metadata):
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    domain_dir = os.path.join(output_dir_root, domain_name)
+    data_dir = os.path.join(domain_dir, 'data')
+    releases_dir = os.path.join(output_dir_root, "%s_releases" % domain_name)
+    os.makedirs(domain_dir, mode=0o755, exist_ok=True)
+    release_dir = _make_release_dir(releases_dir, timestamp)
+    logger.info("About to write a new release of %s to %s" % (data_dir, release_dir))
+    _write_species_files(relevant_data, release_dir, data_dir, True, domain_name, compact,
+                         shard_size, workers, split_metadata)
+    _switch_release(data_dir, release_dir, timestamp)
+    _remove_old_releases(releases_dir, data_dir, keep_releases)
+
+def write_domain_data_files(relevant_data, output_dir_root, domain_name, incremental=False,
+                            keep_releases=None, compact=False, shard_size=None, workers=1,
+                            split_metadata=False):
+    """Writes a JSON file per species and a summary to the domain's data folder
+
+    In incremental mode, species whose data hasn't changed since the last
+    run (according to the hashes in the previous summary) are hard linked
+    from the previous data folder rather than being written again.
+
+    If keep_releases is set, each run's data is written (incrementally) to
+    a new folder in <domain_name>_releases and the data folder becomes a
+    symlink to it, replacing the copy of the whole site made as a backup.
+    Only the last keep_releases releases are kept.
+
+    If compact is set, rows are stored column by column with repeated
+    values dictionary encoded and precompressed copies are written too.
+
+    Species with more than shard_size rows are split into a manifest,
+    holding the first shard_size rows, and shard files with the rest.
+
+    With more than one worker, species are encoded and written by a pool
+    of that many processes.
+
+    If split_metadata is set, each species' description, links and
+    publications are written to a small metadata file next to its rows so
+    they can be updated with write_domain_metadata_files.
+
+    When writing incrementally, relevant_data can give None instead of a
+    species' data if the caller knows it hasn't changed since the last run;
+    its previous files are then reused without being encoded and hashed."""
+    if workers < 1:
+        raise ValueError("Expected at least one worker, not %s" % workers)
+    if shard_size is not None and shard_size < 1:
+        raise ValueError("Expected shards of at least one row, not %s" % shard_size)
+    if keep_releases is not None:
+        if keep_releases < 1:
+            raise ValueError("Expected to keep at least one release, not %s" % keep_releases)
+        _write_domain_release(relevant_data, output_dir_root, domain_name, keep_releases,
+                              compact, shard_size, workers, split_metadata)
+        return
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     output_dir_temp = os.path.join(output_dir_root, "%s_%s_temp" % (domain_name, timestamp))
     data_dir_temp = os.path.join(output_dir_temp, 'data')
     data_dir = os.path.join(output_dir_root, domain_name, 'data')
     logger.info("About to write data to %s" % data_dir)
     output_dir_backup = "%s_backup" % os.path.abspath(output_dir_root)
     _make_temp_dir(data_dir_temp)
-    for species, data in relevant_data:
-        output_filename = _write_species_to_folder(data_dir_temp, species, data)
-        summary['species'][species] = {'filename': output_filename,
-                                       'count': data['count']}
-    summary_path = os.path.join(data_dir_temp, '_data_summary.json')
-    with open(summary_path, 'w') as summary_file:
-        json.dump(summary, summary_file)
+    _write_species_files(relevant_data, data_dir_temp, data_dir, incremental, domain_name,
+                         compact, shard_size, workers, split_metadata)
     _remove_old_backup(output_dir_backup)
     _backup(output_dir_root, output_dir_backup)
     _update_data(output_dir_temp, data_dir_temp, data_dir)
+
+def write_domain_metadata_files(species_metadata, output_dir_root, domain_name):
+    """Rewrites the metadata file of each species, leaving its rows alone
+
+    species_metadata is an iterable of (species, metadata).  Only species
+    whose data was written with split_metadata have a metadata file; others,
+    like species added to the config since, are skipped.  Returns the number
+    of files written."""
+    data_dir = os.path.join(output_dir_root, domain_name, 'data')
+    previous_species = _load_summary(data_dir)['species']
+    written = 0
+    for species, metadata in species_metadata:
+        entry = previous_species.get(species, {})
+        if 'metadata' not in entry:
+            logger.warning("No metadata file for %s in %s, its data needs writing with --split-metadata" %
+                           (species, data_dir))
+            continue
+        metadata_filepath = os.path.join(data_dir, entry['metadata'])
+        metadata = dict(metadata, species=species)
+        compact = os.path.exists(metadata_filepath + '.gz')
+        _replace_json(metadata_filepath, metadata, compact)
+        written += 1
+    logger.info("Wrote metadata for %s of %s species in %s" %
+                (written, len(previous_species), domain_name))
+    return written
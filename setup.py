@@ -14,6 +14,10 @@ setup(
         'PyYAML',
         'requests'
     ],
+    extras_require={
+        'brotli': ['brotli'],
+        'fast': ['orjson']
+    },
     entry_points='''
         [console_scripts]
         datapages_update_projects=datapages.update_projects:main
@@ -39,6 +39,25 @@
     });
   }
 
+  function decode_columnar_data(json) {
+    // Data written with --compact is stored column by column; columns with
+    // lots of repeated values list each value once and refer to it by index
+    var columns = json['encoded_data'].map(function (column) {
+      if (column['dictionary']) {
+        var dictionary = column['dictionary'];
+        return column['codes'].map(function (code) { return dictionary[code]; });
+      }
+      return column['values'];
+    });
+    // Sharded species only have some of their rows in each file
+    var number_of_rows = columns.length ? columns[0].length : 0;
+    var rows = [];
+    for (var i = 0; i < number_of_rows; i++) {
+      rows.push(columns.map(function (column) { return column[i]; }));
+    }
+    return rows;
+  }
+
   function _show_spinner_hide_content(){
     $('#data-div').hide();
     $('#title').hide();
@@ -104,6 +123,53 @@
     }
   }
 
+  function _get_metadata(metadata_url) {
+    // Species written with --split-metadata keep their description, links
+    // and publications in a small file of their own, fetched alongside the
+    // rows; otherwise they are in the rows' file
+    if (!metadata_url) {
+      return $.Deferred().resolve({}).promise();
+    }
+    return $.getJSON(metadata_url).then(null, function () {
+      return $.Deferred().resolve({'pubmed_ids': []}).promise();
+    });
+  }
+
+  function _shard_url(data_url, filename) {
+    return data_url.replace(/[^\/]*$/, filename);
+  }
+
+  // Counts the times the table has been loaded with another species, so
+  // that responses for an earlier load can be told apart even if the same
+  // species has been chosen again since
+  var table_loads = 0;
+
+  function load_remaining_shards(table, load, data_url, data) {
+    // Big species are split into shards; the first is in the species' own
+    // file so the table can be shown straight away, the rest are added as
+    // they arrive
+    var shards = data['shards'] || [];
+    var shards_remaining = shards.length;
+    shards.forEach(function (shard) {
+      $.getJSON(_shard_url(data_url, shard['filename']), function (shard_data) {
+        if (load != table_loads) {
+          return;
+        }
+        var rows = shard_data['format'] == 'columnar' ? decode_columnar_data(shard_data) : shard_data['data'];
+        table.rows.add(rows).draw(false);
+        shards_remaining -= 1;
+        if (shards_remaining == 0) {
+          $('#data-more').hide();
+        }
+      });
+    });
+    if (shards.length) {
+      $('#data-more').text("Loading " + (data['count'] - _number_of_rows(table)) + " more rows...").show();
+    } else {
+      $('#data-more').hide();
+    }
+  }
+
   function _show_table_and_project_list() {
     $('#data-div').show();
     $('#projects').show();
@@ -134,6 +200,7 @@
     // have javascript, they still have a working link to the full json blob.
     _show_spinner_hide_content();
     var data_url = get_species_urls()[species];
+    var metadata_url = get_species_metadata_urls()[species];
     $('#species_selector').text(species);
     var current_species = $('#species_selector').data('species');
     if (current_species && current_species == species) {
@@ -145,27 +212,36 @@
         _show_table_and_project_list();
       }
     } else if (data_url && table.ajax.url(data_url)) {
+      var load = ++table_loads;
+      var metadata_request = _get_metadata(metadata_url);
       table.load(function (data) {
         var new_columns = data['columns'];
         var column_lookup = {};
         new_columns.forEach((name, index) => $(table.columns(index).header()).text(name));
 
-        _update_content(data)
-        _show_content_hide_spinner();
-        $('#species_selector').data('species', species);
-        if (_number_of_rows(table) == 0) {
-          _hide_table_and_project_list();
-        } else {
-          update_project_lists_from_table(table, species, project);
-          add_ena_links(table);
-          _show_table_and_project_list();
-        }
+        metadata_request.done(function (metadata) {
+          if (load != table_loads) {
+            return;
+          }
+          _update_content($.extend({}, data, metadata));
+          _show_content_hide_spinner();
+          $('#species_selector').data('species', species);
+          if (_number_of_rows(table) == 0) {
+            _hide_table_and_project_list();
+          } else {
+            update_project_lists_from_table(table, species, project, data['projects']);
+            add_ena_links(table);
+            _show_table_and_project_list();
+          }
+          load_remaining_shards(table, load, data_url, data);
+        });
       });
       $("#data-table").on('draw.dt', function() {
         add_ena_links(table);
       });
     } else {
       // There was an issue updating the table, maybe the species doesn't exist
+      table_loads += 1;
       table.clear();
       _show_content_hide_spinner();
       $('#species_selector').data('species', species);
@@ -173,14 +249,15 @@
     }
   }
 
-  function update_project_lists_from_table(table, species, default_project) {
+  function update_project_lists_from_table(table, species, default_project, all_projects) {
     table.column(1).search('').draw();
     $('#project_selector').text(default_project);
-    var projects = table.column(1).data().unique().sort();
+    // Sharded species list all their projects, even those still loading
+    var projects = all_projects ? Object.keys(all_projects).sort() : table.column(1).data().unique().sort().toArray();
     var project_list = $('#project_list');
     project_list.empty();
     project_list.append('<li><a href="#">All Projects</a></li>');
-    projects.each ( function (d) {
+    projects.forEach( function (d) {
       project_list.append('<li><a href="#">' + d + '</a></li>');
     });
     filter_by_project(table, default_project);
@@ -220,6 +297,14 @@
     return links;
   }
 
+  function get_species_metadata_urls() {
+    var links = {};
+    $('#species_list a[data-metadata]').each( function () {
+      links[$(this).text()] = $(this).attr('data-metadata');
+    });
+    return links;
+  }
+
   function update_url_params(species, project, push_state) {
     var param_string = '?species=' + encodeURIComponent(species);
     if (project) {
@@ -251,6 +336,11 @@
     var species = params['species'] || first_species;
     var project = params['project'] || 'All Projects';
     var table = $("#data-table").DataTable();
+    $("#data-table").on('xhr.dt', function (event, settings, json) {
+      if (json && json['format'] == 'columnar') {
+        json['data'] = decode_columnar_data(json);
+      }
+    });
     update_table_for_species(table, species, project);
     update_url_params(species, project, false);
     $('#species_list a').click(function (event){
@@ -0,0 +1,78 @@
+import os
+import shutil
+
+import pytest
+
+from datapages import templates
+from datapages.common import DomainConfig
+from datapages.templates import TemplateService
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+CONFIG = """\
+metadata:
+  type: domain
+  name: bacteria
+  title: Bacteria
+  description: Some *bacteria*
+  list_data: true
+databases:
+  - pathogen_prok_track
+species:
+  Salmonella:
+    description: A description
+    links:
+      - url: http://example.org
+        text: %s
+"""
+
+@pytest.fixture
+def templates_dir(tmp_path, monkeypatch):
+    templates_dir = tmp_path / 'templates'
+    shutil.copytree(os.path.join(PACKAGE_DIR, 'templates'), str(templates_dir))
+    monkeypatch.setattr(templates, '_template_service',
+                        TemplateService(str(tmp_path / 'bytecode'), str(templates_dir)))
+    return templates_dir
+
+def load(path, cache_dir, link_text=None):
+    if link_text is not None:
+        path.write_text(CONFIG % link_text)
+    with open(str(path)) as config_file:
+        return DomainConfig(config_file, str(cache_dir))
+
+def compiled_files(cache_dir):
+    return sorted(filename for filename in os.listdir(str(cache_dir)) if filename.endswith('.pickle'))
+
+def test_compiled_config_is_reused(tmp_path, templates_dir):
+    cache_dir = tmp_path / 'cache'
+    config_path = tmp_path / 'bacteria.yml'
+    domain_config = load(config_path, cache_dir, 'Example')
+    assert 'Example' in domain_config.render_links('Salmonella')
+    assert len(compiled_files(cache_dir)) == 1
+    assert load(config_path, cache_dir).render_links('Salmonella') == domain_config.render_links('Salmonella')
+
+def test_overriding_a_fragment_renders_again(tmp_path, templates_dir):
+    cache_dir = tmp_path / 'cache'
+    config_path = tmp_path / 'bacteria.yml'
+    load(config_path, cache_dir, 'Example')
+    (templates_dir / 'fragments').mkdir()
+    (templates_dir / 'fragments' / 'links.html').write_text(
+        "{% for link in links %}<p>{{ link['text'] }}</p>{% endfor %}")
+    templates._template_service = TemplateService(None, str(templates_dir))
+    assert load(config_path, cache_dir).render_links('Salmonella') == '<p>Example</p>'
+
+def test_stale_compiled_configs_are_removed(tmp_path, templates_dir):
+    cache_dir = tmp_path / 'cache'
+    load(tmp_path / 'viruses.yml', cache_dir, 'Virus')
+    load(tmp_path / 'viruses_old.yml', cache_dir, 'Old')
+    (cache_dir / 'domain_config_v1_0123abcd.pickle').write_bytes(b'')
+    config_path = tmp_path / 'bacteria.yml'
+    for link_text in ['One', 'Two', 'Three']:
+        load(config_path, cache_dir, link_text)
+    compiled = compiled_files(cache_dir)
+    assert len(compiled) == 3
+    assert len([filename for filename in compiled if '_bacteria_yml_' in filename]) == 1
+    assert 'Three' in load(config_path, cache_dir).render_links('Salmonella')
+    # Other config files keep their compiled copies
+    assert len([filename for filename in compiled if '_viruses_yml_' in filename]) == 1
+    assert len([filename for filename in compiled if '_viruses_old_yml_' in filename]) == 1
@@ -0,0 +1,111 @@
+import pytest
+
+from datapages.enametadata import ENACache, ENADetails, XMLViewTransport, parse_run_ids
+
+RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<ROOT request="ERP000001,ERP000002,ERP000003">
+<STUDY accession="ERP000001" center_name="SC">
+  <IDENTIFIERS><PRIMARY_ID>ERP000001</PRIMARY_ID><SECONDARY_ID>PRJEB0001</SECONDARY_ID></IDENTIFIERS>
+  <DESCRIPTOR><STUDY_TITLE>Streptococcus pneumoniae, café samples</STUDY_TITLE>
+    <STUDY_ABSTRACT>%s</STUDY_ABSTRACT></DESCRIPTOR>
+  <STUDY_LINKS>
+    <STUDY_LINK><URL_LINK><LABEL>Project</LABEL><URL>http://example.org</URL></URL_LINK></STUDY_LINK>
+    <STUDY_LINK><XREF_LINK><DB>ENA-SAMPLE</DB><ID>ERS000001-ERS000009</ID></XREF_LINK></STUDY_LINK>
+    <STUDY_LINK><XREF_LINK><DB>ENA-RUN</DB><ID>ERR000010-ERR000012,ERR000020</ID></XREF_LINK></STUDY_LINK>
+  </STUDY_LINKS>
+  <STUDY_ATTRIBUTES><STUDY_ATTRIBUTE><TAG>ENA-FIRST-PUBLIC</TAG><ID>ERR999999</ID></STUDY_ATTRIBUTE></STUDY_ATTRIBUTES>
+</STUDY>
+<STUDY accession="ERP000002">
+  <IDENTIFIERS><PRIMARY_ID>ERP000002</PRIMARY_ID></IDENTIFIERS>
+  <STUDY_LINKS>
+    <STUDY_LINK><XREF_LINK><DB>ENA-SUBMISSION</DB><ID>ERA000001</ID></XREF_LINK></STUDY_LINK>
+  </STUDY_LINKS>
+</STUDY>
+<STUDY accession="ERP000003">
+  <STUDY_LINKS>
+    <STUDY_LINK><XREF_LINK><DB>ENA-EXPERIMENT</DB><ID>ERX000001</ID></XREF_LINK></STUDY_LINK>
+    <STUDY_LINK><XREF_LINK><DB>ENA-RUN</DB><ID>ERR000030</ID></XREF_LINK></STUDY_LINK>
+  </STUDY_LINKS>
+</STUDY>
+</ROOT>
+""" % ("Lorem ipsum " * 1000)
+
+EXPECTED = [
+    {'study_accession': 'ERP000001', 'run_accession': 'ERR000010'},
+    {'study_accession': 'ERP000001', 'run_accession': 'ERR000011'},
+    {'study_accession': 'ERP000001', 'run_accession': 'ERR000012'},
+    {'study_accession': 'ERP000001', 'run_accession': 'ERR000020'},
+    {'study_accession': 'ERP000003', 'run_accession': 'ERR000030'}
+]
+
+def chunked(content, size):
+    return [content[i:i+size] for i in range(0, len(content), size)]
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 64 * 1024])
+def test_parse_chunked_response(chunk_size):
+    # Small chunks split tags, text and the multibyte character in the title
+    chunks = chunked(RESPONSE.encode('utf-8'), chunk_size)
+    assert list(XMLViewTransport()._parse(chunks)) == EXPECTED
+
+def test_parse_empty_response():
+    chunks = [b'<?xml version="1.0" encoding="UTF-8"?>\n', b'<ROOT request="ERP000004"></ROOT>\n']
+    assert list(XMLViewTransport()._parse(chunks)) == []
+
+def test_parse_run_ids():
+    assert parse_run_ids('ERR000098-ERR000101,SRR5') == ['ERR000098', 'ERR000099', 'ERR000100',
+                                                       'ERR000101', 'SRR5']
+
+def test_parse_runs_for_the_accession_asked_for():
+    chunks = [RESPONSE.encode('utf-8')]
+    runs = list(XMLViewTransport()._parse(chunks, {'PRJEB0001', 'ERP000003'}))
+    assert runs == [dict(run, study_accession='PRJEB0001') if run['study_accession'] == 'ERP000001'
+                    else run for run in EXPECTED]
+
+class FakeTransport(object):
+    """Answers with the runs in runs_by_study, under the accession given in
+    answered_as if there is one"""
+    max_accessions = 2
+
+    def __init__(self, runs_by_study, answered_as=None):
+        self.runs_by_study = runs_by_study
+        self.answered_as = answered_as or {}
+        self.requested = []
+
+    def get_run_accessions(self, study_accessions):
+        self.requested += study_accessions
+        return [{'study_accession': self.answered_as.get(accession, accession),
+                 'run_accession': run_accession}
+                for accession in study_accessions
+                for run_accession in self.runs_by_study.get(accession, [])]
+
+def ena_details(tmp_path, transport):
+    cache = ENACache(str(tmp_path / 'ena.db'), ttl=3600)
+    return ENADetails(requests_per_second=1000, cache=cache, transport=transport)
+
+def test_cache_entries_are_keyed_by_the_accession_asked_for(tmp_path):
+    transport = FakeTransport({'ERP000001': ['ERR000001', 'ERR000002'], 'PRJEB0002': ['ERR000003']})
+    runs = ena_details(tmp_path, transport).get_run_accessions(['ERP000001', 'PRJEB0002', 'ERP000004'])
+    assert [run['run_accession'] for run in runs] == ['ERR000001', 'ERR000002', 'ERR000003']
+
+    transport = FakeTransport({})
+    cached = ena_details(tmp_path, transport).get_run_accessions(['ERP000001', 'PRJEB0002', 'ERP000004'])
+    assert transport.requested == []
+    by_run = lambda run: (run['study_accession'], run['run_accession'])
+    assert sorted(cached, key=by_run) == sorted(runs, key=by_run)
+    fresh, _ = ENACache(str(tmp_path / 'ena.db'), ttl=3600).get(['ERP000001', 'PRJEB0002', 'ERP000004'])
+    assert fresh == {'ERP000001': ['ERR000001', 'ERR000002'], 'PRJEB0002': ['ERR000003'],
+                     'ERP000004': []}
+
+def test_runs_answered_under_another_accession_are_not_cached_as_none(tmp_path):
+    transport = FakeTransport({'PRJEB0002': ['ERR000003'], 'ERP000001': ['ERR000001']},
+                              answered_as={'PRJEB0002': 'ERP000002'})
+    ena_details(tmp_path, transport).get_run_accessions(['ERP000001', 'PRJEB0002', 'ERP000004'])
+    fresh, _ = ENACache(str(tmp_path / 'ena.db'), ttl=3600).get(['ERP000001', 'PRJEB0002',
+                                                                 'ERP000002', 'ERP000004'])
+    assert fresh == {'ERP000001': ['ERR000001']}
+
+    # So they are asked for again next time
+    transport = FakeTransport({'PRJEB0002': ['ERR000003']})
+    runs = ena_details(tmp_path, transport).get_run_accessions(['ERP000001', 'PRJEB0002', 'ERP000004'])
+    assert transport.requested == ['PRJEB0002', 'ERP000004']
+    assert {'study_accession': 'PRJEB0002', 'run_accession': 'ERR000003'} in runs
@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+
+from datapages.regenerate_data import (SAMPLE_COLUMNS, _join_samples_by_merging,
+                                       join_vrtrack_sequencescape)
+from datapages.synthetic import SyntheticData
+
+def join_by_merging(vrtrack, sequencescape):
+    """How join_vrtrack_sequencescape used to join every lane"""
+    sequencescape_study_data = sequencescape[['project_ssid', 'study_title', 'study_name']].drop_duplicates()
+    joint_data = pd.merge(vrtrack, sequencescape_study_data, how='left',
+                          on='project_ssid', sort=False, suffixes=('_v', '_ss'))
+    sequencescape_sample_data = sequencescape[SAMPLE_COLUMNS].drop_duplicates()
+    return _join_samples_by_merging(joint_data, sequencescape_sample_data).reset_index(drop=True)
+
+@pytest.mark.parametrize('synthetic_options', [
+    {'duplicate_rate': 0.0, 'missing_rate': 0.0},
+    {'duplicate_rate': 0.05, 'missing_rate': 0.2},
+    {'duplicate_rate': 0.3, 'missing_rate': 0.5, 'seed': 2}
+])
+def test_join_matches_merging(synthetic_options):
+    lane_details, _, studies = SyntheticData(['Salmonella', 'Streptococcus'], samples_per_study=20,
+                                             **synthetic_options).generate(5000)
+    expected = join_by_merging(lane_details, studies)
+    joined = join_vrtrack_sequencescape(lane_details, studies)
+    pd.testing.assert_frame_equal(joined, expected, check_dtype=False)
+
+def test_join_with_ambiguous_and_unmatched_samples():
+    vrtrack = pd.DataFrame({
+        'internal_project_name': ['project 1'] * 5,
+        'internal_sample_name': ['a', 'b', 'c', 'd', 'e'],
+        'lane_name': ['1_1#1', '1_1#2', '1_1#3', '1_1#4', '1_1#5'],
+        'run_accession': ['ERR1', 'ERR2', 'ERR3', 'ERR4', 'ERR5'],
+        'withdrawn': [0, 0, 0, 0, 0],
+        'project_ssid': [1, 1, 1, 1, 1],
+        'sample_accession': ['ERS1', None, 'ERS3', 'ERS4', None],
+        'study_accession': ['ERP1'] * 5,
+        'species_name': ['Salmonella enterica'] * 5
+    })
+    studies = pd.DataFrame({
+        'project_ssid': [1, 1, 1, 1],
+        'study_accession': ['ERP1'] * 4,
+        'study_title': ['A study'] * 4,
+        'study_name': ['project_1'] * 4,
+        # ERS3 is shared by two samples, so lane c becomes two rows
+        'sample_strain': ['strain a', 'strain b', 'strain c', 'other strain c'],
+        'sample_public_name': ['public a', None, 'public c', 'public c2'],
+        'sample_name': ['a', 'b', 'c', 'c2'],
+        'sample_common_name': ['Salmonella enterica'] * 4,
+        'sample_organism': ['Salmonella enterica'] * 4,
+        'sample_supplier_name': [None, 'supplier b', None, None],
+        'sample_accession': ['ERS1', 'ERS2', 'ERS3', 'ERS3']
+    })
+    expected = join_by_merging(vrtrack, studies)
+    joined = join_vrtrack_sequencescape(vrtrack, studies)
+    pd.testing.assert_frame_equal(joined, expected, check_dtype=False)
+    assert list(joined['internal_sample_name']) == ['a', 'b', 'c', 'c', 'd', 'e']
+    assert joined.loc[1, 'sample_accession_ss'] == 'ERS2'
+    assert pd.isnull(joined.loc[4, 'sample_strain'])
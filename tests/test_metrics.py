@@ -0,0 +1,36 @@
+import time
+
+from datapages.metrics import measure, measure_each, reset_metrics
+from datapages.stages import StageGraph
+
+def stages_by_name(metrics):
+    return {(stage['stage'], tuple(sorted(stage['labels'].items()))): stage
+            for stage in metrics.as_dict()['stages']}
+
+def test_stages_run_in_threads_keep_labels():
+    metrics = reset_metrics()
+    graph = StageGraph()
+    graph.add('first', lambda inputs: 1)
+    graph.add('second', lambda inputs: inputs['first'] + 1, depends_on=['first'])
+    with measure('domain', domain='bacteria'):
+        assert graph.run() == {'first': 1, 'second': 2}
+    stages = stages_by_name(metrics)
+    for name in ['domain', 'first', 'second']:
+        assert (name, (('domain', 'bacteria'),)) in stages
+
+def test_measure_each_records_time_spent_in_a_generator():
+    metrics = reset_metrics()
+
+    def slow_items():
+        for item in range(3):
+            time.sleep(0.02)
+            yield item
+
+    with measure('domain', domain='bacteria'):
+        items = measure_each('generate_data', slow_items())
+        with measure('write'):
+            assert list(items) == [0, 1, 2]
+    stage = stages_by_name(metrics)[('generate_data', (('domain', 'bacteria'),))]
+    assert stage['rows'] == 3
+    assert stage['calls'] == 4
+    assert stage['wall_seconds'] >= 0.06
@@ -0,0 +1,115 @@
+import json
+import os
+
+from argparse import ArgumentTypeError
+
+import pytest
+
+from datapages.common import _at_least_one
+from datapages.write_data import _remove_old_releases, write_domain_data_files
+
+def species_data(count):
+    return {'columns': ['Run', 'Study Name'],
+            'data': [["ERR%s" % i, 'project'] for i in range(count)],
+            'count': count,
+            'updated': '2020-01-01'}
+
+def write(site_dir, count, keep_releases=None):
+    write_domain_data_files([('Salmonella', species_data(count))], str(site_dir), 'bacteria',
+                            keep_releases=keep_releases)
+
+def summary(data_dir):
+    with open(os.path.join(str(data_dir), '_data_summary.json')) as summary_file:
+        return json.load(summary_file)
+
+def releases(site_dir):
+    return sorted(os.listdir(str(site_dir / 'bacteria_releases')))
+
+def test_first_release_replaces_data_folder(tmp_path):
+    site_dir = tmp_path / 'site'
+    write(site_dir, 1)
+    data_dir = site_dir / 'bacteria' / 'data'
+    assert data_dir.is_dir() and not data_dir.is_symlink()
+
+    write(site_dir, 2, keep_releases=3)
+    assert data_dir.is_symlink()
+    assert summary(data_dir)['species']['Salmonella']['count'] == 2
+    live_release = os.path.realpath(str(data_dir))
+    assert os.path.dirname(live_release) == os.path.realpath(str(site_dir / 'bacteria_releases'))
+    # The plain data folder is kept as a release to roll back to
+    previous = [release for release in releases(site_dir) if release.endswith('_previous')]
+    assert len(previous) == 1
+    assert summary(site_dir / 'bacteria_releases' / previous[0])['species']['Salmonella']['count'] == 1
+
+def test_old_releases_are_removed(tmp_path):
+    site_dir = tmp_path / 'site'
+    for count in range(1, 6):
+        write(site_dir, count, keep_releases=2)
+    data_dir = site_dir / 'bacteria' / 'data'
+    assert len(releases(site_dir)) == 2
+    assert os.path.basename(os.path.realpath(str(data_dir))) == releases(site_dir)[-1]
+    assert summary(data_dir)['species']['Salmonella']['count'] == 5
+
+def test_live_release_is_never_removed(tmp_path):
+    site_dir = tmp_path / 'site'
+    for count in range(1, 4):
+        write(site_dir, count, keep_releases=3)
+    releases_dir = site_dir / 'bacteria_releases'
+    data_dir = site_dir / 'bacteria' / 'data'
+    oldest, middle, newest = releases(site_dir)
+    for age, release in enumerate([newest, middle, oldest]):
+        os.utime(str(releases_dir / release), (1000000 - age, 1000000 - age))
+    # Roll back to the oldest release
+    os.remove(str(data_dir))
+    os.symlink(os.path.join('..', 'bacteria_releases', oldest), str(data_dir))
+
+    _remove_old_releases(str(releases_dir), str(data_dir), 1)
+    assert releases(site_dir) == [oldest, newest]
+    assert summary(data_dir)['species']['Salmonella']['count'] == 1
+
+def test_writing_without_releases_after_releases(tmp_path):
+    site_dir = tmp_path / 'site'
+    write(site_dir, 1, keep_releases=2)
+    data_dir = site_dir / 'bacteria' / 'data'
+    release = os.path.realpath(str(data_dir))
+
+    write(site_dir, 2)
+    assert data_dir.is_dir() and not data_dir.is_symlink()
+    assert summary(data_dir)['species']['Salmonella']['count'] == 2
+    # Only the link is replaced, not the release it pointed to
+    assert summary(release)['species']['Salmonella']['count'] == 1
+    assert not [name for name in os.listdir(str(site_dir)) if name.endswith('_temp')]
+
+def test_releases_must_be_positive(tmp_path):
+    assert _at_least_one('3') == 3
+    for value in ['0', '-1', 'two']:
+        with pytest.raises(ArgumentTypeError):
+            _at_least_one(value)
+    with pytest.raises(ValueError):
+        write(tmp_path / 'site', 1, keep_releases=0)
+
+def data_files(data_dir):
+    files = {}
+    for filename in sorted(os.listdir(str(data_dir))):
+        with open(os.path.join(str(data_dir), filename), 'rb') as data_file:
+            files[filename] = data_file.read()
+    return files
+
+def test_workers_write_the_same_files(tmp_path):
+    relevant_data = [('Species %s' % number, species_data(number * 10))
+                     for number in range(1, 8)]
+    for workers in [1, 3]:
+        write_domain_data_files(relevant_data, str(tmp_path / str(workers)), 'bacteria',
+                                incremental=True, shard_size=25, workers=workers)
+    files = [data_files(tmp_path / str(workers) / 'bacteria' / 'data') for workers in [1, 3]]
+    summaries = [json.loads(species_files.pop('_data_summary.json')) for species_files in files]
+    for species_summary in summaries:
+        del species_summary['created']
+    assert summaries[0] == summaries[1]
+    assert 'species_7.shard2.json' in files[0]
+    assert files[0] == files[1]
+
+def test_workers_must_be_positive(tmp_path):
+    with pytest.raises(ValueError):
+        write_domain_data_files([('Salmonella', species_data(1))], str(tmp_path / 'site'),
+                                'bacteria', workers=0)
@@ -0,0 +1,71 @@
+from contextlib import contextmanager
+
+from datapages.sequencescape import Sfind
+
+def samples(project_ssid, count=2):
+    return [{'project_ssid': project_ssid, 'study_accession': 'ERP%s' % project_ssid,
+             'sample_name': 'sample_%s_%s' % (project_ssid, number)}
+            for number in range(count)]
+
+class FakeCursor(object):
+    """Returns the samples of the studies asked for, a study at a time in
+    the order of the ssids for batches and in order of ssid for the
+    temporary table, like a server using a different plan for each"""
+    def __init__(self, server):
+        self.server = server
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, parameters=None):
+        self.server.queries.append(query)
+        if 'datapages_project_ssids)' in query:
+            project_ssids = sorted(self.server.temporary_table, reverse=True)
+        elif parameters is not None:
+            project_ssids, = parameters
+        else:
+            return
+        self.results = [sample for project_ssid in project_ssids
+                        for sample in self.server.samples.get(project_ssid, [])]
+
+    def executemany(self, query, parameters):
+        self.server.temporary_table.update(parameters)
+
+    def fetchall(self):
+        return self.results
+
+class FakeServer(object):
+    def __init__(self, samples):
+        self.samples = samples
+        self.temporary_table = set()
+        self.queries = []
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    @contextmanager
+    def connection(self, host, port, user, database):
+        yield self
+
+def sfind_with(studies, bulk, connections=1):
+    sfind = Sfind('localhost', 3306, 'sequencescape', 'reader', bulk=bulk,
+                  connections=connections, connection_manager=FakeServer(studies))
+    sfind.wait = 0
+    sfind.max_ssids = 3
+    return sfind
+
+def test_bulk_studies_in_the_same_order_as_batches():
+    studies = {project_ssid: samples(project_ssid) for project_ssid in range(10)}
+    project_ssids = [4, 9, 1, 7, 0, 3, 8, 11, 2]
+    batched = sfind_with(studies, bulk=False).get_studies(project_ssids)
+    bulk_sfind = sfind_with(studies, bulk=True)
+    bulk = bulk_sfind.get_studies(project_ssids)
+    assert any('datapages_project_ssids)' in query for query in bulk_sfind.connection_manager.queries)
+    assert bulk == batched
+    assert [study['project_ssid'] for study in bulk[:4]] == [4, 4, 9, 9]
+
+def test_no_studies_in_bulk():
+    assert sfind_with({}, bulk=True).get_studies([]) == []
@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+from datapages.write_data import write_domain_data_files
+
+def species_data(count):
+    return {'columns': ['Run', 'Study Name'],
+            'data': [["ERR%s" % i, 'project %s' % (i % 4)] for i in range(count)],
+            'count': count,
+            'updated': '2020-01-01'}
+
+def load(data_dir, filename):
+    with open(os.path.join(str(data_dir), filename)) as data_file:
+        return json.load(data_file)
+
+def write(site_dir, data, **options):
+    write_domain_data_files([('Salmonella', data)], str(site_dir), 'bacteria', **options)
+    return site_dir / 'bacteria' / 'data'
+
+def test_shards_hold_the_unsharded_rows(tmp_path):
+    data = species_data(23)
+    unsharded = load(write(tmp_path / 'unsharded', data), 'salmonella.json')
+    data_dir = write(tmp_path / 'sharded', data, shard_size=5)
+    manifest = load(data_dir, 'salmonella.json')
+    assert len(manifest['data']) == 5
+    assert [shard['count'] for shard in manifest['shards']] == [5, 5, 5, 3]
+
+    rows = list(manifest['data'])
+    for shard in manifest['shards']:
+        shard_data = load(data_dir, shard['filename'])
+        assert shard_data['offset'] == shard['offset'] == len(rows)
+        rows += shard_data['data']
+    assert rows == sorted(unsharded['data'], key=lambda row: row[1])
+    for project, position in manifest['projects'].items():
+        project_rows = rows[position['offset']:position['offset']+position['count']]
+        assert {row[1] for row in project_rows} == {project}
+    assert sum(position['count'] for position in manifest['projects'].values()) == 23
+
+    summary = load(data_dir, '_data_summary.json')['species']['Salmonella']
+    assert summary['shards'] == [shard['filename'] for shard in manifest['shards']]
+
+def test_small_species_are_not_sharded(tmp_path):
+    data_dir = write(tmp_path / 'site', species_data(5), shard_size=5)
+    assert 'shards' not in load(data_dir, 'salmonella.json')
+    assert sorted(os.listdir(str(data_dir))) == ['_data_summary.json', 'salmonella.json']
+
+def test_unchanged_shards_are_reused(tmp_path):
+    site_dir = tmp_path / 'site'
+    data_dir = write(site_dir, species_data(12), incremental=True, shard_size=5)
+    filenames = ['salmonella.json', 'salmonella.shard1.json', 'salmonella.shard2.json']
+    inodes = [os.stat(str(data_dir / filename)).st_ino for filename in filenames]
+
+    write(site_dir, species_data(12), incremental=True, shard_size=5)
+    assert [os.stat(str(data_dir / filename)).st_ino for filename in filenames] == inodes
+
+    write(site_dir, species_data(13), incremental=True, shard_size=5)
+    assert load(data_dir, 'salmonella.json')['count'] == 13
+    assert load(data_dir, 'salmonella.shard2.json')['count'] == 3
+
+def test_shard_size_must_be_positive(tmp_path):
+    for shard_size in [0, -1]:
+        with pytest.raises(ValueError):
+            write(tmp_path / 'site', species_data(3), shard_size=shard_size)
@@ -0,0 +1,56 @@
+"""Checks that the update script only imports what each mode needs, so
+that -h and --html-only start quickly"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+HEAVY_MODULES = ['pandas', 'numpy', 'pymysql', 'requests']
+TEMPLATE_MODULES = ['jinja2', 'markdown', 'yaml']
+
+# Runs the module as python -m would and prints the modules it imported
+SCRIPT = """
+import json, runpy, sys
+sys.argv = ['datapages.update_projects'] + json.loads(sys.argv[1])
+try:
+    runpy.run_module('datapages.update_projects', run_name='__main__', alter_sys=True)
+except SystemExit as e:
+    if e.code:
+        raise
+print(json.dumps(sorted(sys.modules)))
+"""
+
+def imported_modules(arguments):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [PACKAGE_DIR,
+                                                                  os.environ.get('PYTHONPATH')])))
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT, json.dumps(arguments)],
+                                     env=env, cwd=PACKAGE_DIR)
+    return set(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+@pytest.fixture
+def global_config_path(tmp_path):
+    path = tmp_path / 'global_config.yml'
+    path.write_text("DATAPAGES_VRTRACK_HOST: unused\n"
+                    "DATAPAGES_VRTRACK_PORT: 1\n"
+                    "DATAPAGES_VRTRACK_RO_USER: unused\n"
+                    "DATAPAGES_SEQUENCESCAPE_HOST: unused\n"
+                    "DATAPAGES_SEQUENCESCAPE_PORT: 1\n"
+                    "DATAPAGES_SEQUENCESCAPE_DATABASE: unused\n"
+                    "DATAPAGES_SEQUENCESCAPE_RO_USER: unused\n")
+    return str(path)
+
+def test_help_imports_nothing_heavy():
+    modules = imported_modules(['-h'])
+    assert 'datapages' in modules
+    assert [module for module in HEAVY_MODULES + TEMPLATE_MODULES if module in modules] == []
+
+def test_html_only_imports_no_data_libraries(tmp_path, global_config_path):
+    site_dir = tmp_path / 'site'
+    (site_dir / 'viruses').mkdir(parents=True)
+    modules = imported_modules(['--global-config', global_config_path, '-q', '-d', str(site_dir),
+                                '--html-only', os.path.join(PACKAGE_DIR, 'page_config', 'viruses.yml')])
+    assert (site_dir / 'viruses' / 'index.html').exists()
+    assert [module for module in HEAVY_MODULES if module in modules] == []
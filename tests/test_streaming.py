@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from datapages.common import DomainConfig
+from datapages.regenerate_data import (SpeciesRouter, _species_batches, build_relevant_data,
+                                       merge_data, stream_relevant_data)
+from datapages.synthetic import SyntheticData
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+@pytest.fixture(scope='module')
+def domain_config():
+    with open(os.path.join(PACKAGE_DIR, 'page_config', 'prokaryotes.yml')) as config_file:
+        return DomainConfig(config_file)
+
+def without_updated(data):
+    return {key: value for key, value in data.items() if key != 'updated'}
+
+@pytest.mark.parametrize('duplicate_rate,batch_size', [(0.0, 2000), (0.05, 500), (0.3, 3000)])
+def test_streamed_data_matches_joining_everything(domain_config, duplicate_rate, batch_size):
+    lane_details, ena_run_details, studies = SyntheticData(
+        domain_config.species_list, samples_per_study=20, duplicate_rate=duplicate_rate).generate(20000)
+    expected = [(species, without_updated(data)) for species, data in
+                build_relevant_data(merge_data(lane_details, ena_run_details, studies), domain_config)]
+    streamed = [(species, without_updated(data)) for species, data in
+                stream_relevant_data(lane_details, ena_run_details, studies, domain_config,
+                                     batch_size=batch_size)]
+    assert streamed == expected
+
+def test_species_batches_are_at_most_batch_size(domain_config):
+    lane_details, _, _ = SyntheticData(domain_config.species_list).generate(20000)
+    species_rows = SpeciesRouter(domain_config).route(lane_details['species_name'])
+    batches = list(_species_batches(domain_config, species_rows, 1000))
+    assert [species for batch in batches for species in batch] == \
+        [species for species in domain_config.species_list if domain_config.is_visible(species)]
+    for batch in batches:
+        lanes = sum(len(species_rows[species]) for species in batch)
+        assert lanes <= 1000 or len(batch) == 1
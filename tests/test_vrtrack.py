@@ -0,0 +1,246 @@
+import time
+
+from contextlib import contextmanager
+
+import pandas as pd
+
+from datapages.vrtrack import LANE_COLUMNS, LaneSnapshots, Vrtrack, merge_lane_changes
+
+def lane(number, **details):
+    row = {
+        'internal_project_name': 'project %s' % (number % 3),
+        'internal_sample_name': 'sample_%s' % number,
+        'lane_name': '1234_1#%s' % number,
+        'run_accession': 'ERR%s' % number,
+        'withdrawn': 0,
+        'project_ssid': number % 3,
+        'sample_accession': 'ERS%s' % number,
+        'study_accession': 'ERP%s' % (number % 3),
+        'species_name': 'Salmonella enterica'
+    }
+    row.update(details)
+    return tuple(row[column] for column in LANE_COLUMNS)
+
+class FakeCursor(object):
+    """Answers queries from the rows of the FakeConnectionManager
+
+    The high water marks query gets its high_water_marks, queries of an
+    unversioned table its rows from unversioned_rows, queries for lanes
+    which changed get its changed_rows and any other query its rows"""
+    def __init__(self, manager):
+        self.manager = manager
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, parameters=None):
+        self.manager.queries.append((query, parameters))
+        self.position = 0
+        if 'MAX(row_id)' in query:
+            self.description = [('row_id',)] * len(self.manager.high_water_marks)
+            self.results = [tuple(self.manager.high_water_marks)]
+        elif query.split()[-2] == 'FROM':
+            self.results = self.manager.unversioned_rows.get(query.split()[-1], [])
+        else:
+            self.description = [(column,) for column in LANE_COLUMNS]
+            self.results = self.manager.changed_rows if 'row_id >' in query else self.manager.rows
+
+    def fetchone(self):
+        return self.results[0]
+
+    def fetchall(self):
+        return self.results
+
+    def fetchmany(self, size):
+        rows = self.results[self.position:self.position+size]
+        self.position += size
+        return rows
+
+class FakeConnection(object):
+    def __init__(self, manager):
+        self.manager = manager
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self.manager)
+
+class FakeConnectionManager(object):
+    def __init__(self, rows, changed_rows=(), high_water_marks=(0, 0, 0, 0),
+                 unversioned_rows=None):
+        self.rows = rows
+        self.changed_rows = list(changed_rows)
+        self.high_water_marks = high_water_marks
+        self.unversioned_rows = unversioned_rows or {}
+        self.queries = []
+
+    @contextmanager
+    def connection(self, host, port, user, database):
+        yield FakeConnection(self)
+
+def vrtrack_with(rows, chunk_size=3, **changes):
+    vrtrack = Vrtrack('localhost', 3306, 'pathogen_track', 'reader',
+                      connection_manager=FakeConnectionManager(rows, **changes))
+    vrtrack.chunk_size = chunk_size
+    return vrtrack
+
+def test_lanes_dataframe_matches_reading_all_rows():
+    rows = [lane(number) for number in range(10)]
+    rows[4] = lane(4, sample_accession=None, withdrawn=1)
+    expected = pd.DataFrame.from_records(rows, columns=LANE_COLUMNS)
+    lanes = vrtrack_with(rows).get_lanes_dataframe()
+    pd.testing.assert_frame_equal(lanes, expected)
+
+def test_lanes_dataframe_with_a_chunk_of_missing_values():
+    rows = [lane(number, sample_accession=None) if number < 3 else lane(number)
+            for number in range(7)]
+    lanes = vrtrack_with(rows).get_lanes_dataframe()
+    assert list(lanes.columns) == LANE_COLUMNS
+    assert lanes['sample_accession'].isnull().tolist() == [True] * 3 + [False] * 4
+    assert lanes['run_accession'].tolist() == ['ERR%s' % number for number in range(7)]
+
+def test_lanes_dataframe_sorted_by_lane_name():
+    rows = [lane(number) for number in [3, 1, 4, 0, 2]]
+    lanes = vrtrack_with(rows, chunk_size=2).get_lanes_dataframe()
+    assert lanes['lane_name'].tolist() == ['1234_1#%s' % number for number in range(5)]
+    assert lanes['run_accession'].tolist() == ['ERR%s' % number for number in range(5)]
+    assert lanes.index.tolist() == list(range(5))
+
+def test_no_lanes():
+    lanes = vrtrack_with([]).get_lanes_dataframe()
+    assert list(lanes.columns) == LANE_COLUMNS
+    assert len(lanes.index) == 0
+
+def lanes_frame(rows):
+    return pd.DataFrame.from_records(rows, columns=LANE_COLUMNS)
+
+def by_lane_name(lanes):
+    return lanes.sort_values('lane_name').reset_index(drop=True)
+
+def test_merge_withdrawn_lane_replaces_its_old_row():
+    lanes = lanes_frame([lane(number) for number in range(3)])
+    merged = merge_lane_changes(lanes, lanes_frame([lane(1, withdrawn=1)]))
+    assert len(merged.index) == 3
+    assert merged.set_index('lane_name')['withdrawn'].to_dict() == {
+        '1234_1#0': 0, '1234_1#1': 1, '1234_1#2': 0}
+
+def test_merge_adds_new_lanes_in_order():
+    lanes = lanes_frame([lane(number) for number in [0, 2, 4]])
+    merged = merge_lane_changes(lanes, lanes_frame([lane(3), lane(1)]))
+    assert merged['lane_name'].tolist() == ['1234_1#%s' % number for number in range(5)]
+
+def test_merge_nothing_changed():
+    lanes = lanes_frame([lane(number) for number in range(3)])
+    merged = merge_lane_changes(lanes, lanes_frame([]))
+    pd.testing.assert_frame_equal(merged, lanes, check_dtype=False)
+
+def test_snapshot_round_trip(tmp_path):
+    snapshots = LaneSnapshots(str(tmp_path / 'snapshots.db'))
+    assert snapshots.load('localhost', 3306, 'pathogen_track') is None
+    lanes = lanes_frame([lane(number) for number in range(3)])
+    marks = {'lane': 10, 'library': 5, 'sample': 4, 'project': 1}
+    unversioned_rows = {'individual': {1: ('ERS1', 1)}, 'study': {1: ('ERP1',)},
+                        'species': {1: ('Salmonella enterica',)}}
+    snapshots.save('localhost', 3306, 'pathogen_track', lanes, marks, unversioned_rows, 1234.5)
+    loaded_lanes, loaded_marks, loaded_rows, refreshed = LaneSnapshots(
+        str(tmp_path / 'snapshots.db'), float('inf')).load('localhost', 3306, 'pathogen_track')
+    pd.testing.assert_frame_equal(loaded_lanes, lanes)
+    assert loaded_marks == marks
+    assert loaded_rows == unversioned_rows
+    assert refreshed == 1234.5
+    # Each database has a snapshot of its own
+    assert snapshots.load('localhost', 3306, 'pathogen_prok_track') is None
+
+def test_snapshot_older_than_full_refresh_is_not_used(tmp_path):
+    path = str(tmp_path / 'snapshots.db')
+    LaneSnapshots(path).save('localhost', 3306, 'pathogen_track', lanes_frame([lane(0)]),
+                             {'lane': 1}, {}, time.time())
+    assert LaneSnapshots(path).load('localhost', 3306, 'pathogen_track') is not None
+    assert LaneSnapshots(path, full_refresh_seconds=0).load('localhost', 3306, 'pathogen_track') is None
+
+def test_lanes_incrementally(tmp_path):
+    snapshots = LaneSnapshots(str(tmp_path / 'snapshots.db'))
+    rows = [lane(number) for number in range(5)]
+    vrtrack = vrtrack_with(rows, high_water_marks=(5, 5, 5, 1))
+    lanes = vrtrack.get_lanes_incrementally(snapshots)
+    pd.testing.assert_frame_equal(by_lane_name(lanes), by_lane_name(lanes_frame(rows)))
+    # The marks are read before the lanes so that changes made while the
+    # lanes are read are read again next time
+    queries = vrtrack.connection_manager.queries
+    assert 'MAX(row_id)' in queries[0][0]
+    assert not any('row_id >' in query for query, _ in queries)
+
+    # Lane 2 is withdrawn and lane 5 added
+    vrtrack = vrtrack_with([], changed_rows=[lane(2, withdrawn=1), lane(5)],
+                           high_water_marks=(7, 6, 5, 1))
+    lanes = vrtrack.get_lanes_incrementally(snapshots)
+    expected = [lane(number) for number in range(6)]
+    expected[2] = lane(2, withdrawn=1)
+    pd.testing.assert_frame_equal(by_lane_name(lanes), by_lane_name(lanes_frame(expected)))
+    changes_query = [(query, parameters) for query, parameters in vrtrack.connection_manager.queries
+                     if 'row_id >' in query]
+    assert [parameters for _, parameters in changes_query] == [[5, 5, 5, 1]]
+
+    # Nothing has changed; the new marks were saved with the lanes
+    vrtrack = vrtrack_with([], high_water_marks=(7, 6, 5, 1))
+    unchanged = vrtrack.get_lanes_incrementally(snapshots)
+    pd.testing.assert_frame_equal(by_lane_name(unchanged), by_lane_name(lanes), check_dtype=False)
+    assert [parameters for query, parameters in vrtrack.connection_manager.queries
+            if 'row_id >' in query] == [[7, 6, 5, 1]]
+
+def test_lanes_incrementally_with_full_refresh(tmp_path):
+    path = str(tmp_path / 'snapshots.db')
+    rows = [lane(number) for number in range(3)]
+    vrtrack_with(rows, high_water_marks=(3, 3, 3, 1)).get_lanes_incrementally(LaneSnapshots(path))
+    rows.append(lane(3))
+    vrtrack = vrtrack_with(rows, high_water_marks=(4, 4, 4, 1))
+    lanes = vrtrack.get_lanes_incrementally(LaneSnapshots(path, full_refresh_seconds=0))
+    assert not any('row_id >' in query for query, _ in vrtrack.connection_manager.queries)
+    pd.testing.assert_frame_equal(by_lane_name(lanes), by_lane_name(lanes_frame(rows)))
+
+def test_incremental_lanes_match_reading_every_lane(tmp_path):
+    snapshots = LaneSnapshots(str(tmp_path / 'snapshots.db'))
+    vrtrack_with([lane(number) for number in [5, 0, 3, 1]],
+                 high_water_marks=(4, 4, 4, 1)).get_lanes_incrementally(snapshots)
+    changed_rows = [lane(4), lane(3, withdrawn=1), lane(2)]
+    # The server returns the lanes in its own order
+    rows = [lane(2), lane(5), lane(0), lane(4), lane(3, withdrawn=1), lane(1)]
+    lanes = vrtrack_with([], changed_rows=changed_rows,
+                         high_water_marks=(7, 7, 7, 1)).get_lanes_incrementally(snapshots)
+    pd.testing.assert_frame_equal(lanes, vrtrack_with(rows).get_lanes_dataframe())
+
+def test_lanes_with_changed_accessions_read_again(tmp_path):
+    snapshots = LaneSnapshots(str(tmp_path / 'snapshots.db'))
+    unversioned_rows = {'individual': [(1, 'ERS1', 1), (2, 'ERS2', 1)],
+                        'study': [(1, 'ERP1')],
+                        'species': [(1, 'Salmonella enterica'), (2, 'Escherichia coli')]}
+    vrtrack_with([lane(1), lane(2)], high_water_marks=(2, 2, 2, 1),
+                 unversioned_rows=unversioned_rows).get_lanes_incrementally(snapshots)
+
+    # A sample gets a new accession and a species is renamed
+    unversioned_rows = {'individual': [(1, 'ERS1', 1), (2, 'ERS22', 1)],
+                        'study': [(1, 'ERP1')],
+                        'species': [(1, 'Salmonella enterica'), (2, 'Escherichia coli K-12')]}
+    vrtrack = vrtrack_with([], changed_rows=[lane(2, sample_accession='ERS22')],
+                           high_water_marks=(2, 2, 2, 1), unversioned_rows=unversioned_rows)
+    lanes = vrtrack.get_lanes_incrementally(snapshots)
+    assert lanes['sample_accession'].tolist() == ['ERS1', 'ERS22']
+    changes_query, parameters = [(query, parameters) for query, parameters
+                                 in vrtrack.connection_manager.queries if 'row_id >' in query][0]
+    assert 'individual.individual_id IN (%s)' in changes_query
+    assert 'species.species_id IN (%s)' in changes_query
+    assert 'study.study_id IN' not in changes_query
+    assert parameters == [2, 2, 2, 1, 2, 2]
+
+def test_lanes_with_many_changed_accessions_all_read_again(tmp_path, monkeypatch):
+    monkeypatch.setattr('datapages.vrtrack.MAX_CHANGED_ROWS', 1)
+    snapshots = LaneSnapshots(str(tmp_path / 'snapshots.db'))
+    rows = [lane(1), lane(2)]
+    vrtrack_with(rows, unversioned_rows={'individual': [(1, 'ERS1', 1), (2, 'ERS2', 1)]}
+                 ).get_lanes_incrementally(snapshots)
+    rows = [lane(1, sample_accession='ERS11'), lane(2, sample_accession='ERS22')]
+    vrtrack = vrtrack_with(rows, unversioned_rows={'individual': [(1, 'ERS11', 1), (2, 'ERS22', 1)]})
+    lanes = vrtrack.get_lanes_incrementally(snapshots)
+    assert not any('row_id >' in query for query, _ in vrtrack.connection_manager.queries)
+    pd.testing.assert_frame_equal(lanes, lanes_frame(rows))